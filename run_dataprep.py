@@ -12,7 +12,8 @@ def run_all(config_yaml):
     labels_stage = ComplexStage([CreateLabelsCrossValStage(config_dict), CreateLabelsHeldoutStage(config_dict)],
                                 "labels")
 
-    dataprep_stages = [prep_stage, align_stage, labels_stage]
+    # The export stage does nothing unless ONNX export is enabled (see is_onnx_export_enabled)
+    dataprep_stages = [prep_stage, ExportAcousticModelStage(config_dict), align_stage, labels_stage]
 
     dataprep = ComplexStage(dataprep_stages, "dataprep")
 
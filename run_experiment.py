@@ -25,7 +25,15 @@ def get_scores_stage(config_dict, epoch, is_swa=False):
         return GenerateScoresCrossValStage(config_dict, epoch=epoch, is_swa=is_swa)
 
 
-def get_scores_and_eval_stages_for_many_epochs(config_dict, step):
+def get_export_stage(config_dict, epoch, is_swa=False):
+    if config_dict.get("held-out"):
+        return ExportModelsHeldoutStage(config_dict, epoch=epoch, is_swa=is_swa)
+    else:
+        return ExportModelsCrossValStage(config_dict, epoch=epoch, is_swa=is_swa)
+
+
+def get_export_scores_and_eval_stages_for_many_epochs(config_dict, step):
+    export_stages = []
     scores_stages = []
     eval_stages = []
 
@@ -35,17 +43,20 @@ def get_scores_and_eval_stages_for_many_epochs(config_dict, step):
     swa_start = epochs - swa_epochs
 
     for epoch in range(0, epochs + 1, step):
+        export_stages.append(get_export_stage(config_dict, epoch))
         scores_stages.append(get_scores_stage(config_dict, epoch))
         eval_stages.append(get_eval_stage(config_dict, epoch))
 
         if epoch >= swa_start and swa_epochs != 0:
+            export_stages.append(get_export_stage(config_dict, epoch, is_swa=True))
             scores_stages.append(get_scores_stage(config_dict, epoch, is_swa=True))
             eval_stages.append(get_eval_stage(config_dict, epoch, is_swa=True))
 
+    export_stage = ComplexStage(export_stages, "export")
     scores_stage = ComplexStage(scores_stages, "scores")
     eval_stage = ComplexStage(eval_stages, "evaluate")
 
-    return scores_stage, eval_stage
+    return export_stage, scores_stage, eval_stage
 
 
 def run_all(config_yaml, from_stage, to_stage, device_name, use_heldout):
@@ -55,9 +66,12 @@ def run_all(config_yaml, from_stage, to_stage, device_name, use_heldout):
 
     prep_stage = get_prep_stage(config_dict)
     train_stage = get_train_stage(config_dict)
-    scores_stage, eval_stage = get_scores_and_eval_stages_for_many_epochs(config_dict, checkpoint_step)
+    export_stage, scores_stage, eval_stage = get_export_scores_and_eval_stages_for_many_epochs(config_dict,
+                                                                                               checkpoint_step)
 
-    experiment_stages = [prep_stage, train_stage, scores_stage, eval_stage]
+    # The models are exported to ONNX between training and scoring. The stage does nothing unless ONNX export is
+    # enabled (see is_onnx_export_enabled), but is always there so that --from and --to accept it
+    experiment_stages = [prep_stage, train_stage, export_stage, scores_stage, eval_stage]
 
     experiment = ComplexStage(experiment_stages, "experiment")
 
@@ -67,9 +81,10 @@ def run_all(config_yaml, from_stage, to_stage, device_name, use_heldout):
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--config', dest='config_yaml', help='Path .yaml config file for experiment', default=None)
-    parser.add_argument('--from', dest='from_stage', help='First stage to run (prep, train, scores, evaluate)',
+    parser.add_argument('--from', dest='from_stage', help='First stage to run (prep, train, export, scores, evaluate)',
+                        default=None)
+    parser.add_argument('--to', dest='to_stage', help='Last stage to run (prep, train, export, scores, evaluate)',
                         default=None)
-    parser.add_argument('--to', dest='to_stage', help='Last stage to run (prep, train, scores, evaluate)', default=None)
     parser.add_argument('--device', dest='device_name', help='Device name to use, such as cpu or cuda', default=None)
     parser.add_argument('--heldout', action='store_true', help='Use this option to test on heldout set', default=False)
 
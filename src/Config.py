@@ -34,6 +34,7 @@ class ExperimentConfig:
         config_dict["device"] = device_name
         config_dict["phone-count"] = get_phone_count(config_dict["phones-list-path"])
         config_dict["state-dict-dir"] = config_dict["experiment-dir-path"] + "state_dicts/"
+        config_dict["onnx-dir"] = config_dict["experiment-dir-path"] + "onnx/"
         config_dict["test-sample-list-dir"] = config_dict["experiment-dir-path"] + "test_sample_lists/"
         config_dict["train-sample-list-dir"] = config_dict["experiment-dir-path"] + "train_sample_lists/"
 
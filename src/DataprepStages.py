@@ -1,5 +1,6 @@
 import src.dataprep.align as align
 import src.dataprep.create_kaldi_labels as create_kaldi_labels
+import src.dataprep.export_acoustic_model as export_acoustic_model
 import src.dataprep.prepare_data as prepare_data
 from src.Stages import *
 
@@ -11,6 +12,13 @@ class PrepareFeaturesAndModelsStage(AtomicStage):
         prepare_data.main(self._config_dict)
 
 
+class ExportAcousticModelStage(AtomicStage):
+    _name = "export"
+
+    def run(self):
+        export_acoustic_model.main(self._config_dict)
+
+
 class AlignCrossValStage(AtomicStage):
     _name = "align_crossval"
 
@@ -1,6 +1,7 @@
 import os
 
 import src.dataprep.convert_chain_to_pytorch_for_finetuning as convert_chain_to_pytorch_for_finetuning
+import src.evaluate.export_pronscorer as export_pronscorer
 import src.evaluate.generate_data_for_eval as generate_data_for_eval
 import src.evaluate.generate_score_txt as generate_score_txt
 import src.train.generate_kfold_utt_lists as generate_kfold_utt_lists
@@ -122,6 +123,37 @@ class TrainHeldoutStage(AtomicStage):
         train.main(config_dict)
 
 
+class ExportModelsCrossValStage(AtomicStage):
+    _name = "export"
+
+    def __init__(self, config_dict, epoch=None, is_swa=False):
+        super().__init__(config_dict)
+        self._epoch = epoch
+        self._is_swa = is_swa
+
+    def run(self):
+        config_dict = self._config_dict
+        for fold in range(config_dict["folds"]):
+            config_dict["model-name"] = get_model_name(config_dict, fold, epoch=self._epoch, use_heldout=False,
+                                                       swa=self._is_swa)
+            export_pronscorer.main(config_dict)
+
+
+class ExportModelsHeldoutStage(AtomicStage):
+    _name = "export"
+
+    def __init__(self, config_dict, epoch=None, is_swa=False):
+        super().__init__(config_dict)
+        self._epoch = epoch
+        self._is_swa = is_swa
+
+    def run(self):
+        config_dict = self._config_dict
+        config_dict["model-name"] = get_model_name(config_dict, 0, epoch=self._epoch, use_heldout=True,
+                                                   swa=self._is_swa)
+        export_pronscorer.main(config_dict)
+
+
 class GenerateScoresCrossValStage(AtomicStage):
     _name = "scores"
 
@@ -6,8 +6,12 @@ from kaldi.lat.align import WordBoundaryInfoNewOpts, WordBoundaryInfo
 from kaldi.matrix import Matrix
 from kaldi.util.table import DoubleMatrixWriter
 
+from src.pytorch_models.ChunkedModel import ChunkedModel
+from src.pytorch_models.CompiledModel import CompiledModel, get_compiled_model_key
 from src.pytorch_models.FTDNNAcoustic import *
-from src.utils.FeatureManager import FeatureManager
+from src.pytorch_models.inference_optimization import optimize_for_inference
+from src.pytorch_models.quantization import quantize_for_inference
+from src.utils.FeatureManager import FeatureManager, get_feature_manager_kwargs
 from src.utils.utils import makedirs_for_file
 
 
@@ -39,6 +43,12 @@ def main(config_dict):
     loglikes_path = config_dict['loglikes-path']
     align_path = config_dict['alignments-path']
     epadb_root_path = config_dict['data-root-path']
+    native_rate_ivectors = config_dict.get('native-rate-ivectors', False)
+    optimize_model = config_dict.get('optimize-for-inference', False)
+    quantization = config_dict.get('quantization', 'none')
+    compiled_model_cache_dir = config_dict.get('compiled-model-cache-dir', None)
+    inference_backend = config_dict.get('inference-backend', 'pytorch')
+    chunk_size = config_dict.get('chunk-size', None)
 
     mfccs_rspec = "ark:" + features_path + "/mfccs.ark"
     ivectors_rspec = "ark:" + features_path + "/ivectors.ark"
@@ -51,25 +61,56 @@ def main(config_dict):
     wb_info = WordBoundaryInfo.from_file(WordBoundaryInfoNewOpts(),
                                          word_boundary_path)
 
-    # Instantiate the PyTorch acoustic model (subclass of torch.nn.Module)
-    model = FTDNNAcoustic()
-    model.load_state_dict(torch.load(acoustic_model_path))
-    model.eval()
-
     # Create feature manager
-    feature_manager = FeatureManager(epadb_root_path, features_path, conf_path)
+    feature_manager = FeatureManager(epadb_root_path, features_path, conf_path,
+                                     **get_feature_manager_kwargs(config_dict))
+    ivector_period = feature_manager.get_ivector_period()
+
+    if inference_backend == 'onnxruntime':
+        # Run the ONNX export of the acoustic model (see ExportAcousticModelStage) with ONNX Runtime
+        if optimize_model or quantization != 'none' or compiled_model_cache_dir is not None or chunk_size is not None:
+            raise Exception('The onnxruntime backend cannot be used with optimize-for-inference, quantization, '
+                            'compiled-model-cache-dir or chunk-size')
+        from src.pytorch_models.OnnxModel import OnnxModel
+        model = OnnxModel(config_dict['acoustic-onnx-path'])
+    elif inference_backend == 'pytorch':
+        # Instantiate the PyTorch acoustic model (subclass of torch.nn.Module)
+        model = FTDNNAcoustic(ivector_period=ivector_period)
+        state_dict = torch.load(acoustic_model_path)
+        model.load_state_dict(state_dict)
+        model.eval()
+        if optimize_model:
+            model = optimize_for_inference(model)
+        model = quantize_for_inference(model, quantization)
+        ftdnn = model.ftdnn
+        # Run the model through traces, loaded from the cache on repeated runs
+        if compiled_model_cache_dir is not None:
+            model = CompiledModel(model, compiled_model_cache_dir, get_compiled_model_key(
+                state_dict, 'FTDNNAcoustic:optimize-for-inference=' + str(optimize_model) + ':quantization=' +
+                quantization + ':ivector-period=' + str(ivector_period)))
+        # Run long utterances in chunks of chunk_size frames, so that their activations fit in memory
+        if chunk_size is not None:
+            model = ChunkedModel(model, chunk_size, ftdnn)
+    else:
+        raise Exception('Unsupported inference backend ' + inference_backend)
 
     makedirs_for_file(align_path)
     align_out_file = open(align_path, "w+")
     # Decode and write output lattices
+    logids = [line.split()[0] for line in open(sample_list_path, 'r').readlines()]
+    feature_manager.prefetch(logids, native_rate_ivectors=native_rate_ivectors)
     with DoubleMatrixWriter(loglikes_wspec) as loglikes_writer:
-        for line in tqdm.tqdm(open(sample_list_path, 'r').readlines()):
-            logid = line.split()[0]
-            feats = feature_manager.get_features_for_logid(logid)
+        for logid in tqdm.tqdm(logids):
+            if native_rate_ivectors:
+                feats, ivectors = feature_manager.get_mfccs_and_ivectors_for_logid(logid)
+                ivectors = torch.unsqueeze(ivectors, 0)
+            else:
+                feats = feature_manager.get_features_for_logid(logid)
+                ivectors = None
             text = feature_manager.get_transcription_for_logid(logid)
             text = text.upper()
             feats = torch.unsqueeze(feats, 0)
-            loglikes = model(feats)  # Compute log-likelihoods
+            loglikes = model(feats, ivectors=ivectors)  # Compute log-likelihoods
             loglikes = Matrix(loglikes.detach().numpy()[0])  # Convert to PyKaldi matrix
             loglikes_writer[logid] = loglikes
             out = aligner.align(loglikes, text)
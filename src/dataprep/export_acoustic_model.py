@@ -0,0 +1,24 @@
+import torch
+
+from src.pytorch_models.FTDNNAcoustic import FTDNNAcoustic
+from src.pytorch_models.onnx_export import export_to_onnx, check_onnx_parity, is_onnx_export_enabled
+from src.utils.FeatureManager import FeatureManager
+
+
+# Exports the acoustic model to ONNX for the onnxruntime alignment backend, and checks its outputs
+def main(config_dict):
+    if not is_onnx_export_enabled(config_dict):
+        return
+
+    acoustic_model_path = config_dict['acoustic-model-path']
+    acoustic_onnx_path = config_dict['acoustic-onnx-path']
+    native_rate_ivectors = config_dict.get('native-rate-ivectors', False)
+    ivector_period = FeatureManager("", config_dict['features-path'],
+                                    config_dict['features-conf-path']).get_ivector_period()
+
+    model = FTDNNAcoustic(ivector_period=ivector_period)
+    model.load_state_dict(torch.load(acoustic_model_path, map_location='cpu'))
+    export_to_onnx(model, acoustic_onnx_path, native_rate_ivectors=native_rate_ivectors)
+    max_diff = check_onnx_parity(model, acoustic_onnx_path, native_rate_ivectors=native_rate_ivectors,
+                                 tolerance=config_dict.get('onnx-parity-tolerance', 1e-3))
+    print('Exported ' + acoustic_onnx_path + ', max abs diff with PyTorch ' + str(max_diff))
@@ -111,6 +111,10 @@ def main(config_dict):
     test_list_path = config_dict['test-list-path']
     reference_path = config_dict['reference-trans-path']
     dataprep_output_path = config_dict['output-dir']
+    feature_extraction_jobs = config_dict.get('feature-extraction-jobs', 1)
+    mfcc_engine = config_dict.get('mfcc-engine', 'kaldi')
+    pack_features = config_dict.get('pack-features', False)
+    packed_features_dtype = config_dict.get('packed-features-dtype', 'float32')
 
     # Download librispeech models and extract them into librispeech-models-path
     download_librispeech_models(librispeech_models_path)
@@ -120,7 +124,10 @@ def main(config_dict):
 
     # Extract features
     feature_manager = FeatureManager(data_root_path, features_path, conf_path)
-    feature_manager.extract_features_using_kaldi()
+    feature_manager.extract_features_using_kaldi(num_jobs=feature_extraction_jobs, mfcc_engine=mfcc_engine)
+    if pack_features:
+        feature_manager.pack_features(dtype=packed_features_dtype,
+                                      native_rate_ivectors=config_dict.get('native-rate-ivectors', False))
 
     # Create links to utterance lists in data folder
     create_epadb_full_sample_list(data_root_path, train_list_path)
@@ -0,0 +1,39 @@
+import torch
+from torch.optim.swa_utils import AveragedModel
+
+from src.pytorch_models.FTDNNPronscorer import FTDNNPronscorer
+from src.pytorch_models.onnx_export import export_to_onnx, check_onnx_parity, is_onnx_export_enabled
+from src.utils.FeatureManager import FeatureManager
+from src.utils.finetuning_utils import get_phone_dictionaries
+
+
+def get_onnx_path(config_dict, model_name):
+    return config_dict['onnx-dir'] + model_name + '.onnx'
+
+
+# Exports a trained pronscoring model to ONNX for the onnxruntime scoring backend, and checks its outputs
+def main(config_dict):
+    if not is_onnx_export_enabled(config_dict):
+        return
+
+    state_dict_dir = config_dict['state-dict-dir']
+    model_name = config_dict['model-name']
+    phone_list_path = config_dict['phones-list-path']
+    batchnorm = config_dict['batchnorm']
+    native_rate_ivectors = config_dict.get('native-rate-ivectors', False)
+    ivector_period = FeatureManager("", config_dict['features-path'],
+                                    config_dict['features-conf-path']).get_ivector_period()
+
+    phone_count = len(get_phone_dictionaries(phone_list_path)[0])
+    model = FTDNNPronscorer(out_dim=phone_count, batchnorm=batchnorm, ivector_period=ivector_period)
+    if model_name.split("_")[-1] == "swa":
+        model = AveragedModel(model)
+    state_dict = torch.load(state_dict_dir + '/' + model_name + '.pth', map_location='cpu')
+    model.load_state_dict(state_dict['model_state_dict'])
+    model = model.module if isinstance(model, AveragedModel) else model
+
+    onnx_path = get_onnx_path(config_dict, model_name)
+    export_to_onnx(model, onnx_path, native_rate_ivectors=native_rate_ivectors)
+    max_diff = check_onnx_parity(model, onnx_path, native_rate_ivectors=native_rate_ivectors,
+                                 tolerance=config_dict.get('onnx-parity-tolerance', 1e-3))
+    print('Exported ' + onnx_path + ', max abs diff with PyTorch ' + str(max_diff))
@@ -1,8 +1,15 @@
 # from utils import *
 from torch.optim.swa_utils import AveragedModel
 
+from src.evaluate.export_pronscorer import get_onnx_path
+from src.pytorch_models.ChunkedModel import ChunkedModel
+from src.pytorch_models.CompiledModel import CompiledModel, get_compiled_model_key
+from src.pytorch_models.ConvFTDNN import ConvFTDNNPronscorer
 from src.pytorch_models.FTDNNPronscorer import *
+from src.pytorch_models.inference_optimization import optimize_for_inference
+from src.pytorch_models.quantization import quantize_for_inference
 from src.train.dataset import *
+from src.utils.EmbeddingCache import EmbeddingCache, get_embedding_cache_key
 
 
 def removeSymbols(string, symbols):
@@ -50,20 +57,27 @@ def generate_scores_for_sample(phone_times, frame_level_scores):
     return scores
 
 
-def generate_scores_for_testset(model, testloader):
+# With tail_layers, batches hold cached trunk embeddings and only the tail of the model is run
+def generate_scores_for_testset(model, testloader, tail_layers=None):
     print('Generating scores for testset')
     scores = {}
     for i, batch in enumerate(testloader, 0):
         print('Batch ' + str(i + 1) + '/' + str(len(testloader)))
         logids = unpack_logids_from_batch(batch)
         features = unpack_features_from_batch(batch)
-        labels = unpack_labels_from_batch(batch)
+        ivectors = unpack_ivectors_from_batch(batch)
+        frame_nodes = unpack_frame_nodes_from_batch(batch)
         phone_times = unpack_phone_times_from_batch(batch)
-        outputs = (-1) * model(features)
+        sequence_offsets = unpack_sequence_offsets_from_batch(batch)
+        if tail_layers is not None:
+            outputs = (-1) * model.forward_tail(features, tail_layers=tail_layers)
+        else:
+            outputs = (-1) * model(features, ivectors=ivectors, sequence_offsets=sequence_offsets)
 
-        frame_level_scores = get_scores_for_canonic_phones(outputs, labels)
+        frame_level_scores = gather_scores_for_canonic_phones(outputs, frame_nodes)
         for i, logid in enumerate(logids):
-            current_sample_scores = generate_scores_for_sample(phone_times[i], frame_level_scores[i])
+            current_sample_scores = generate_scores_for_sample(phone_times[i],
+                                                               batch.get_sample_frames(frame_level_scores, i))
             scores[logid] = current_sample_scores
     return scores
 
@@ -95,15 +109,27 @@ def main(config_dict):
     conf_path = config_dict['features-conf-path']
     device_name = config_dict['device']
     batchnorm = config_dict['batchnorm']
-
-    testset = EpaDB(sample_list, phone_list_path, labels_dir, features_path, conf_path)
-    testloader = torch.utils.data.DataLoader(testset, batch_size=batch_size,
-                                             shuffle=False, num_workers=0, collate_fn=collate_fn_padd)
+    native_rate_ivectors = config_dict.get('native-rate-ivectors', False)
+    embedding_cache_dir = config_dict.get('embedding-cache-dir', None)
+    channel_first_model = config_dict.get('channel-first-model', False)
+    optimize_model = config_dict.get('optimize-for-inference', False)
+    quantization = config_dict.get('quantization', 'none')
+    compiled_model_cache_dir = config_dict.get('compiled-model-cache-dir', None)
+    inference_backend = config_dict.get('inference-backend', 'pytorch')
+    chunk_size = config_dict.get('chunk-size', None)
+
+    feature_manager = FeatureManager("", features_path, conf_path, **get_feature_manager_kwargs(config_dict))
+    testset = EpaDB(sample_list, phone_list_path, labels_dir, features_path, conf_path, feature_manager=feature_manager,
+                    native_rate_ivectors=native_rate_ivectors)
+    testloader = create_data_loader(testset, batch_size, pin_memory=config_dict.get('pin-memory', False),
+                                    **get_data_loader_kwargs(config_dict))
 
     phone_count = testset.phone_count()
 
     # Get pronscoring model to test
-    model = FTDNNPronscorer(out_dim=phone_count, device_name=device_name, batchnorm=batchnorm)
+    ivector_period = feature_manager.get_ivector_period()
+    model = FTDNNPronscorer(out_dim=phone_count, device_name=device_name, batchnorm=batchnorm,
+                            ivector_period=ivector_period)
     if model_name.split("_")[-1] == "swa":
         model = AveragedModel(model)
 
@@ -111,8 +137,72 @@ def main(config_dict):
     state_dict = torch.load(state_dict_dir + '/' + model_name + '.pth')
     model.load_state_dict(state_dict['model_state_dict'])
 
+    # Score the cached trunk embeddings with the tail of the model, when fine-tuning kept the trunk frozen
+    tail_layers = None
+    if embedding_cache_dir is not None:
+        tail_layers = config_dict['layers']
+        scoring_model = model.module if isinstance(model, AveragedModel) else model
+        embedding_cache = EmbeddingCache(embedding_cache_dir, get_embedding_cache_key(
+            scoring_model, tail_layers, feature_manager, native_rate_ivectors))
+        embedding_cache.fill(scoring_model, testset, tail_layers)
+        testset.use_embedding_cache(embedding_cache)
+        model = scoring_model
+
+    # Score with the Conv1d based version of the model, which runs without per layer transposes
+    if channel_first_model:
+        if tail_layers is not None:
+            raise Exception('channel-first-model cannot be used with embedding-cache-dir')
+        linear_model = model.module if isinstance(model, AveragedModel) else model
+        model = ConvFTDNNPronscorer(out_dim=phone_count, batchnorm=batchnorm, ivector_period=ivector_period)
+        model.load_ftdnn_state_dict(linear_model.state_dict())
+        model.eval()
+
+    # Score with batchnorms folded and linear layers merged
+    if optimize_model:
+        if tail_layers is not None or channel_first_model:
+            raise Exception('optimize-for-inference cannot be used with embedding-cache-dir or channel-first-model')
+        model = optimize_for_inference(model.module if isinstance(model, AveragedModel) else model)
+
+    # Run the linear layers in int8 on the CPU
+    if quantization != 'none':
+        if tail_layers is not None or channel_first_model:
+            raise Exception('quantization cannot be used with embedding-cache-dir or channel-first-model')
+        model = quantize_for_inference(model.module if isinstance(model, AveragedModel) else model, quantization)
+
+    ftdnn = (model.module if isinstance(model, AveragedModel) else model).ftdnn
+
+    # Run the model through traces, loaded from the cache on repeated runs
+    if compiled_model_cache_dir is not None:
+        if tail_layers is not None or config_dict.get('packed-sequences', False):
+            raise Exception('compiled-model-cache-dir cannot be used with embedding-cache-dir or packed-sequences')
+        description = (type(model.module if isinstance(model, AveragedModel) else model).__name__ +
+                       ':optimize-for-inference=' + str(optimize_model) + ':quantization=' + quantization +
+                       ':ivector-period=' + str(ivector_period))
+        model = CompiledModel(model.module if isinstance(model, AveragedModel) else model, compiled_model_cache_dir,
+                              get_compiled_model_key(state_dict['model_state_dict'], description))
+
+    # Score long utterances in chunks of chunk_size frames, so that their activations fit in memory
+    if chunk_size is not None:
+        if tail_layers is not None or config_dict.get('packed-sequences', False):
+            raise Exception('chunk-size cannot be used with embedding-cache-dir or packed-sequences')
+        model = ChunkedModel(model, chunk_size, ftdnn)
+
+    # Score with the ONNX export of the model (see ExportModelsHeldoutStage) in ONNX Runtime
+    if inference_backend == 'onnxruntime':
+        if (tail_layers is not None or channel_first_model or optimize_model or quantization != 'none' or
+                compiled_model_cache_dir is not None or chunk_size is not None or
+                config_dict.get('packed-sequences', False)):
+            raise Exception('The onnxruntime backend cannot be used with embedding-cache-dir, channel-first-model, '
+                            'optimize-for-inference, quantization, compiled-model-cache-dir, chunk-size or '
+                            'packed-sequences')
+        from src.pytorch_models.OnnxModel import OnnxModel
+        model = OnnxModel(get_onnx_path(config_dict, model_name))
+    elif inference_backend != 'pytorch':
+        raise Exception('Unsupported inference backend ' + inference_backend)
+
     phone_dict = testset._phone_sym2int_dict
 
-    scores = generate_scores_for_testset(model, testloader)
+    scores = generate_scores_for_testset(model, testloader, tail_layers=tail_layers)
     score_log_fh = open(gop_txt_dir + '/' + gop_txt_name, 'w+')
     log_testset_scores_to_txt(scores, score_log_fh, phone_dict)
+    feature_manager.log_cache_stats()
@@ -0,0 +1,48 @@
+import math
+
+import torch
+
+
+class ChunkedModel:
+    """
+    Runs an FTDNNPronscorer, FTDNNAcoustic (or a wrapper of them, like CompiledModel) in eval mode over chunks of
+    chunk_size frames, each padded with the left and right context of ftdnn (see FTDNN.left_context), and stitches
+    the outputs of the chunks together. Every output frame is computed from the same input frames as in a full
+    sequence forward, so the outputs match it (up to the rounding of the matrix products), while the activations
+    of the 1536 dim layers only take memory for one padded chunk at a time. Runs without gradients.
+
+    With native rate iVectors, chunks must start on iVector periods: chunk_size must be a multiple of the
+    iVector period, and the left context is rounded up to one.
+    """
+
+    def __init__(self, model, chunk_size, ftdnn):
+        if chunk_size % ftdnn.ivector_period != 0:
+            raise Exception('chunk-size must be a multiple of the iVector period (' + str(ftdnn.ivector_period) +
+                            '), got ' + str(chunk_size))
+        self.model = model
+        self.chunk_size = chunk_size
+        self.ivector_period = ftdnn.ivector_period
+        self.left_context = math.ceil(ftdnn.left_context / ftdnn.ivector_period) * ftdnn.ivector_period
+        self.right_context = ftdnn.right_context
+
+    def __call__(self, x, ivectors=None, sequence_offsets=None):
+        if sequence_offsets is not None:
+            raise Exception('Packed sequences are not supported by chunked inference')
+
+        seq_len = x.shape[1]
+        with torch.no_grad():
+            if seq_len <= self.chunk_size:
+                return self.model(x, ivectors=ivectors)
+
+            outputs = []
+            for chunk_start in range(0, seq_len, self.chunk_size):
+                chunk_end = min(chunk_start + self.chunk_size, seq_len)
+                # Chunks at the start or the end of the sequence keep its edges, which the model pads itself
+                start = max(chunk_start - self.left_context, 0)
+                end = min(chunk_end + self.right_context, seq_len)
+                chunk_ivectors = None
+                if ivectors is not None:
+                    chunk_ivectors = ivectors[:, start // self.ivector_period:math.ceil(end / self.ivector_period), :]
+                chunk_outputs = self.model(x[:, start:end, :], ivectors=chunk_ivectors)
+                outputs.append(chunk_outputs[:, chunk_start - start:chunk_end - start, :])
+            return torch.cat(outputs, dim=1)
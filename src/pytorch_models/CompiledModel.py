@@ -0,0 +1,91 @@
+import hashlib
+import math
+import os
+import warnings
+
+import torch
+
+
+class CompiledModel:
+    """
+    Runs an FTDNNPronscorer, FTDNNAcoustic or channel first model in eval mode through TorchScript traces, which
+    replay the layers without going through their Python code. The model is traced once per shape bucket (the
+    input layout, device and dtype: see get_shape_bucket) and the trace is stored under cache_dir/<key>, so later
+    runs with the same key (see get_compiled_model_key) load it instead of tracing again.
+
+    Traces hold for any batch size and any sequence longer than the largest time offset of the model, which is
+    checked when tracing. Shorter sequences run through the model itself. Packed sequences are not supported.
+    """
+
+    def __init__(self, model, cache_dir, key):
+        self.model = model.eval()
+        self.compiled_dir = os.path.join(os.fspath(cache_dir), key)
+        os.makedirs(self.compiled_dir, exist_ok=True)
+        self.traced_models = {}
+        self.min_traced_length = max([1] + [module.time_offset for module in model.modules()
+                                            if hasattr(module, 'time_offset')]) + 1
+        self.ivector_period = max([1] + [module.ivector_period for module in model.modules()
+                                         if hasattr(module, 'ivector_period')])
+
+    def __call__(self, x, ivectors=None, sequence_offsets=None):
+        if sequence_offsets is not None:
+            raise Exception('Packed sequences are not supported by compiled models')
+        if x.shape[1] < self.min_traced_length:
+            return self.model(x, ivectors=ivectors)
+
+        traced_model = self._get_traced_model(x, ivectors)
+        if ivectors is None:
+            return traced_model(x)
+        return traced_model(x, ivectors)
+
+    def _get_traced_model(self, x, ivectors):
+        bucket = get_shape_bucket(x, ivectors)
+        if bucket in self.traced_models:
+            return self.traced_models[bucket]
+
+        path = os.path.join(self.compiled_dir, bucket + '.pt')
+        if os.path.isfile(path):
+            traced_model = torch.jit.load(path, map_location=x.device)
+        else:
+            traced_model = self._trace(x, ivectors)
+            # Written to a temporary file first, so that concurrent runs never load a partial trace
+            tmp_path = path + '.' + str(os.getpid()) + '.tmp'
+            torch.jit.save(traced_model, tmp_path)
+            os.replace(tmp_path, path)
+        self.traced_models[bucket] = traced_model
+        return traced_model
+
+    # Traces the model on the given inputs. The trace is checked against a shorter sequence and a larger
+    # batch, so that sizes that would have been frozen into it raise here instead of giving wrong outputs.
+    def _trace(self, x, ivectors):
+        example_inputs = (x,) if ivectors is None else (x, ivectors)
+        shorter_inputs = (x[:, :-1, :],)
+        if ivectors is not None:
+            # The model takes exactly one iVector per started iVector period
+            shorter_inputs += (ivectors[:, :math.ceil((x.shape[1] - 1) / self.ivector_period), :],)
+        check_inputs = [shorter_inputs, tuple(torch.cat([tensor, tensor]) for tensor in example_inputs)]
+        with torch.no_grad(), warnings.catch_warnings():
+            # The time offsets are compared with the sequence length, which the tracer warns about
+            warnings.simplefilter('ignore', torch.jit.TracerWarning)
+            return torch.jit.trace(self.model, example_inputs, check_inputs=check_inputs)
+
+
+# Name of the trace used for an input: frame rate features or MFCCs plus native rate iVectors, with their
+# dimensions, on a given device and dtype
+def get_shape_bucket(x, ivectors=None):
+    if ivectors is None:
+        layout = 'frame-rate-' + str(x.shape[2])
+    else:
+        layout = 'native-rate-' + str(x.shape[2]) + '-' + str(ivectors.shape[2])
+    return layout + '_' + x.device.type + '_' + str(x.dtype).replace('torch.', '')
+
+
+# Key of the traces of a model, hashing its state dict as loaded (before any inference transform), a description
+# of the model class and transforms applied to it, and the torch version the traces are saved with
+def get_compiled_model_key(state_dict, description):
+    hasher = hashlib.sha1()
+    hasher.update((description + ':torch=' + torch.__version__).encode())
+    for name, tensor in state_dict.items():
+        hasher.update(name.encode())
+        hasher.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+    return hasher.hexdigest()[:16]
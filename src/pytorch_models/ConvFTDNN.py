@@ -0,0 +1,244 @@
+import math
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+class ConvFTDNNLayer(nn.Module):
+
+    def __init__(self, in_dim, semi_orth_dim, out_dim, time_offset, dropout_p=0):
+        """
+        Channel first FTDNNLayer. The time context is part of the (dilated) convolutions, so no splicing
+        or transposes are needed: sorth sees frames t - time_offset and t, affine frames t and t + time_offset.
+        """
+        super(ConvFTDNNLayer, self).__init__()
+        self.time_offset = time_offset
+        kernel_size = 1 if time_offset == 0 else 2
+        dilation = max(time_offset, 1)
+
+        self.sorth = nn.Conv1d(in_dim, semi_orth_dim, kernel_size, dilation=dilation, bias=False)
+        self.affine = nn.Conv1d(semi_orth_dim, out_dim, kernel_size, dilation=dilation, bias=True)
+        self.nl = nn.ReLU()
+        self.bn = nn.BatchNorm1d(out_dim, affine=False, eps=0.001)
+        self.dropout = nn.Dropout(p=dropout_p)
+
+    def forward(self, x):
+        '''
+        x is (batch_size, in_dim, seq_len)
+        '''
+        time_offset = self.time_offset
+        if time_offset != 0:
+            # Past context replicates the first frame, future context is zero filled, as in FTDNNLayer
+            x = F.pad(x, (time_offset, 0), mode='replicate')
+        x = self.sorth(x)
+        if time_offset != 0:
+            x = F.pad(x, (0, time_offset))
+        x = self.affine(x)
+        x = self.nl(x)
+        x = self.bn(x)
+        x = self.dropout(x)
+        return x
+
+
+class ConvInputLayer(nn.Module):
+
+    def __init__(self, mfcc_dim=40, ivector_dim=100, output_dim=1536, dropout_p=0):
+        """
+        Channel first InputLayer. The lda transform is split into a convolution over frames t - 1, t and t + 1
+        of the MFCCs and a projection of the iVectors.
+        """
+        super(ConvInputLayer, self).__init__()
+        lda_dim = 3 * mfcc_dim + ivector_dim
+        self.mfcc_dim = mfcc_dim
+
+        self.lda_mfccs = nn.Conv1d(mfcc_dim, lda_dim, 3, bias=True)
+        self.lda_ivectors = nn.Conv1d(ivector_dim, lda_dim, 1, bias=False)
+        self.kernel = nn.Conv1d(lda_dim, output_dim, 1, bias=True)
+
+        self.nonlinearity = nn.ReLU()
+        self.bn = nn.BatchNorm1d(output_dim, affine=False, eps=0.001)
+        self.drop = nn.Dropout(p=dropout_p)
+
+    def forward(self, x, ivectors=None, ivector_period=10):
+        '''
+        x is either (batch_size, 140, seq_len) MFCCs+iVectors at frame rate, or (batch_size, 40, seq_len) MFCCs
+        if the iVectors are given separately at their native rate as (batch_size, 100, ceil(seq_len/ivector_period))
+        '''
+        seq_len = x.shape[2]
+        mfccs = x[:, :self.mfcc_dim, :]
+        if ivectors is not None:
+            ivector_count = math.ceil(seq_len / ivector_period)
+            # An iVector count other than this means the features were extracted with another iVector period
+            if ivectors.shape[2] != ivector_count:
+                raise Exception('Expected ' + str(ivector_count) + ' iVectors for ' + str(seq_len) + ' frames with '
+                                'an iVector period of ' + str(ivector_period) + ', got ' + str(ivectors.shape[2]) +
+                                '. Does the iVector period of the model match the one of the features?')
+            # The iVector projection is computed once per iVector period and repeated over its frames
+            ivector_projection = self.lda_ivectors(ivectors)
+            ivector_projection = torch.repeat_interleave(ivector_projection, ivector_period, dim=2)[:, :, :seq_len]
+        else:
+            ivector_projection = self.lda_ivectors(x[:, self.mfcc_dim:, :])
+        x = self.lda_mfccs(F.pad(mfccs, (1, 1), mode='replicate')) + ivector_projection
+        x = self.kernel(x)
+        x = self.nonlinearity(x)
+        x = self.bn(x)
+        x = self.drop(x)
+        return x
+
+
+class ConvFTDNN(nn.Module):
+
+    def __init__(self, batchnorm=None, dropout_p=0, ivector_period=10):
+        """
+        Channel first (batch_size, channels, seq_len) version of FTDNN built on Conv1d, whose batchnorms need no
+        transposes. Loads the state dicts of FTDNN through load_ftdnn_state_dict.
+        """
+        super(ConvFTDNN, self).__init__()
+        self.ivector_period = ivector_period
+
+        self.layer01 = ConvInputLayer(output_dim=1536)
+        self.layer02 = ConvFTDNNLayer(1536, 160, 1536, 1, dropout_p=dropout_p)
+        self.layer03 = ConvFTDNNLayer(1536, 160, 1536, 1, dropout_p=dropout_p)
+        self.layer04 = ConvFTDNNLayer(1536, 160, 1536, 1, dropout_p=dropout_p)
+        self.layer05 = ConvFTDNNLayer(1536, 160, 1536, 0, dropout_p=dropout_p)
+        self.layer06 = ConvFTDNNLayer(1536, 160, 1536, 3, dropout_p=dropout_p)
+        self.layer07 = ConvFTDNNLayer(1536, 160, 1536, 3, dropout_p=dropout_p)
+        self.layer08 = ConvFTDNNLayer(1536, 160, 1536, 3, dropout_p=dropout_p)
+        self.layer09 = ConvFTDNNLayer(1536, 160, 1536, 3, dropout_p=dropout_p)
+        self.layer10 = ConvFTDNNLayer(1536, 160, 1536, 3, dropout_p=dropout_p)
+        self.layer11 = ConvFTDNNLayer(1536, 160, 1536, 3, dropout_p=dropout_p)
+        self.layer12 = ConvFTDNNLayer(1536, 160, 1536, 3, dropout_p=dropout_p)
+        self.layer13 = ConvFTDNNLayer(1536, 160, 1536, 3, dropout_p=dropout_p)
+        self.layer14 = ConvFTDNNLayer(1536, 160, 1536, 3, dropout_p=dropout_p)
+        self.layer15 = ConvFTDNNLayer(1536, 160, 1536, 3, dropout_p=dropout_p)
+        self.layer16 = ConvFTDNNLayer(1536, 160, 1536, 3, dropout_p=dropout_p)
+        self.layer17 = ConvFTDNNLayer(1536, 160, 1536, 3, dropout_p=dropout_p)
+        self.layer18 = nn.Conv1d(1536, 256, 1, bias=False)  # This is the prefinal-l layer
+
+        # Same context as FTDNN: the convolutions see the same frames as its spliced linear layers
+        time_offsets = [layer.time_offset for layer in self.children() if isinstance(layer, ConvFTDNNLayer)]
+        self.left_context = 1 + sum(time_offsets)
+        self.right_context = 1 + sum(time_offsets)
+
+    def forward(self, x, ivectors=None):
+        '''
+        Input must be (batch_size, in_dim, seq_len), or (batch_size, 40, seq_len) MFCCs plus
+        native rate iVectors (batch_size, 100, ceil(seq_len/ivector_period)). Output is (batch_size, 256, seq_len).
+        '''
+        x = self.layer01(x, ivectors=ivectors, ivector_period=self.ivector_period)
+        x_2 = self.layer02(x)
+        for layer in [self.layer03, self.layer04, self.layer05, self.layer06, self.layer07, self.layer08,
+                      self.layer09, self.layer10, self.layer11, self.layer12, self.layer13, self.layer14,
+                      self.layer15, self.layer16, self.layer17, self.layer18]:
+            x = x * 0.75 + x_2
+            x_2 = layer(x)
+        return x_2
+
+
+class ConvPronscorerOutputLayer(nn.Module):
+
+    def __init__(self, in_dim, out_dim, use_bn=False):
+        super(ConvPronscorerOutputLayer, self).__init__()
+        self.use_bn = use_bn
+
+        if use_bn:
+            self.bn = nn.BatchNorm1d(in_dim, affine=False)
+        self.linear = nn.Conv1d(in_dim, out_dim, 1, bias=True)
+
+    def forward(self, x):
+        if self.use_bn:
+            x = self.bn(x)
+        return self.linear(x)
+
+
+class ConvAcousticOutputLayer(nn.Module):
+
+    def __init__(self, linear1_in_dim, linear2_in_dim, linear3_in_dim, out_dim):
+        super(ConvAcousticOutputLayer, self).__init__()
+        self.linear1 = nn.Conv1d(linear1_in_dim, linear2_in_dim, 1, bias=True)
+        self.nl = nn.ReLU()
+        self.bn1 = nn.BatchNorm1d(linear2_in_dim, affine=False)
+        self.linear2 = nn.Conv1d(linear2_in_dim, linear3_in_dim, 1, bias=False)
+        self.bn2 = nn.BatchNorm1d(linear3_in_dim, affine=False)
+        self.linear3 = nn.Conv1d(linear1_in_dim, out_dim, 1, bias=True)
+
+    def forward(self, x):
+        x = self.linear1(x)
+        x = self.nl(x)
+        x = self.bn1(x)
+        x = self.linear2(x)
+        x = self.bn2(x)
+        x = self.linear3(x)
+        return x
+
+
+class ConvFTDNNModel(nn.Module):
+    """
+    Base of the channel first models. forward takes and returns (batch_size, seq_len, dim) tensors like the
+    original models, transposing only at the input and the output; forward_channel_first skips even those.
+    """
+
+    def forward(self, x, ivectors=None, sequence_offsets=None):
+        if sequence_offsets is not None:
+            raise Exception('Packed sequences are not supported by the channel first models')
+        if ivectors is not None:
+            ivectors = ivectors.transpose(1, 2)
+        return self.forward_channel_first(x.transpose(1, 2), ivectors=ivectors).transpose(1, 2)
+
+    def forward_channel_first(self, x, ivectors=None):
+        x = self.ftdnn(x, ivectors=ivectors)
+        return self.output_layer(x)
+
+    # Loads a state dict of the original (nn.Linear based) model
+    def load_ftdnn_state_dict(self, state_dict):
+        self.load_state_dict(convert_ftdnn_state_dict(state_dict, self.state_dict()))
+
+
+class ConvFTDNNPronscorer(ConvFTDNNModel):
+
+    def __init__(self, out_dim=40, batchnorm=None, dropout_p=0, ivector_period=10):
+        super(ConvFTDNNPronscorer, self).__init__()
+        use_final_bn = batchnorm in ["final", "last", "firstlast"]
+
+        self.ftdnn = ConvFTDNN(batchnorm=batchnorm, dropout_p=dropout_p, ivector_period=ivector_period)
+        self.output_layer = ConvPronscorerOutputLayer(256, out_dim, use_bn=use_final_bn)
+
+
+class ConvFTDNNAcoustic(ConvFTDNNModel):
+
+    def __init__(self, ivector_period=10):
+        super(ConvFTDNNAcoustic, self).__init__()
+        self.ftdnn = ConvFTDNN(ivector_period=ivector_period)
+        self.output_layer = ConvAcousticOutputLayer(256, 1536, 256, 6024)
+
+
+# Maps a state dict of FTDNN, FTDNNPronscorer or FTDNNAcoustic to the keys and shapes of conv_state_dict,
+# the state dict of the matching channel first model
+def convert_ftdnn_state_dict(state_dict, conv_state_dict):
+    converted = {}
+    for key, value in state_dict.items():
+        if key.endswith('layer01.lda.weight'):
+            prefix = key[:-len('lda.weight')]
+            mfcc_weight = conv_state_dict[prefix + 'lda_mfccs.weight']
+            lda_dim, mfcc_dim, context_size = mfcc_weight.shape
+            # Columns of lda are ordered as frames t - 1, t and t + 1 of the MFCCs, then the iVectors
+            converted[prefix + 'lda_mfccs.weight'] = _linear_to_conv_weight(value[:, :mfcc_dim * context_size],
+                                                                            context_size)
+            converted[prefix + 'lda_ivectors.weight'] = value[:, mfcc_dim * context_size:].unsqueeze(2)
+        elif key.endswith('layer01.lda.bias'):
+            converted[key[:-len('lda.bias')] + 'lda_mfccs.bias'] = value
+        elif key in conv_state_dict and value.dim() == 2:
+            # Linear weights of spliced frames, ordered as the frames the convolution sees
+            converted[key] = _linear_to_conv_weight(value, conv_state_dict[key].shape[2])
+        elif key in conv_state_dict:
+            converted[key] = value
+        else:
+            raise Exception('Unexpected key in FTDNN state dict: ' + key)
+    return converted
+
+
+# (out_dim, kernel_size * in_dim) linear weight to (out_dim, in_dim, kernel_size) convolution weight
+def _linear_to_conv_weight(weight, kernel_size):
+    out_dim = weight.shape[0]
+    return weight.reshape(out_dim, kernel_size, -1).permute(0, 2, 1).contiguous()
@@ -1,5 +1,21 @@
+import math
+
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
+
+
+# Returns x delayed by time_offset frames, replicating the first frame: frame t holds x[:, max(t - time_offset, 0)]
+def get_past_context(x, time_offset):
+    seq_len = x.shape[1]
+    replicated_frames = min(time_offset, seq_len)
+    return torch.cat([x[:, :1, :].expand(-1, replicated_frames, -1), x[:, :seq_len - replicated_frames, :]], axis=1)
+
+
+# Returns x advanced by time_offset frames, zero filled: frame t holds x[:, t + time_offset], or zeros past the end.
+# The zeros are created by F.pad with the device and dtype of x.
+def get_future_context(x, time_offset):
+    return F.pad(x[:, time_offset:, :], (0, 0, 0, min(time_offset, x.shape[1])))
 
 
 class FTDNNLayer(nn.Module):
@@ -24,22 +40,28 @@ class FTDNNLayer(nn.Module):
         self.bn = nn.BatchNorm1d(out_dim, affine=False, eps=0.001)
         self.dropout = nn.Dropout(p=self.dropout_p)
 
-    def forward(self, x):
+    def forward(self, x, frame_boundaries=None):
+        '''
+        x is (batch_size, seq_len, in_dim), or (1, total_frames, in_dim) for packed sequences, in which case
+        frame_boundaries holds the first and one past the last frame of the utterance of each frame
+        '''
         time_offset = self.time_offset
-        if time_offset != 0:
-            padding = x[:, 0, :][:, None, :]
-            xd = torch.cat([padding] * time_offset + [x], axis=1)
-            xd = xd[:, :-time_offset, :]
+        if time_offset != 0 and frame_boundaries is not None:
+            # Same context as below, but gathered without crossing utterance boundaries
+            frame_starts, frame_ends = frame_boundaries
+            frames = torch.arange(x.shape[1], device=x.device)
+            xd = x[:, torch.maximum(frames - time_offset, frame_starts), :]
             x = torch.cat([xd, x], axis=2)
+        elif time_offset != 0:
+            x = torch.cat([get_past_context(x, time_offset), x], axis=2)
         x = self.sorth(x)
-        if time_offset != 0:
-            padding = x[:, -1, :][:, None, :]
-            padding = torch.zeros(padding.shape)
-            if self.device == 'cuda':
-                padding = padding.cuda()
-            xd = torch.cat([x] + [padding] * time_offset, axis=1)
-            xd = xd[:, time_offset:, :]
+        if time_offset != 0 and frame_boundaries is not None:
+            next_frames = frames + time_offset
+            next_frame_exists = (next_frames < frame_ends)[None, :, None]
+            xd = x[:, torch.minimum(next_frames, frame_ends - 1), :] * next_frame_exists
             x = torch.cat([x, xd], axis=2)
+        elif time_offset != 0:
+            x = torch.cat([x, get_future_context(x, time_offset)], axis=2)
         x = self.affine(x)
         x = self.nl(x)
         x = x.transpose(1, 2)
@@ -68,16 +90,44 @@ class InputLayer(nn.Module):
         self.bn = nn.BatchNorm1d(output_dim, affine=False, eps=0.001)
         self.drop = nn.Dropout(p=self.dropout_p)
 
-    def forward(self, x):
-        mfccs = x[:, :, :40]
-        ivectors = x[:, :, -100:]
-        padding_first = mfccs[:, 0, :][:, None, :]
-        padding_last = mfccs[:, -1, :][:, None, :]
-        context_first = torch.cat([padding_first, mfccs[:, :-1, :]], axis=1)
-        context_last = torch.cat([mfccs[:, 1:, :], padding_last], axis=1)
-        x = torch.cat([context_first, mfccs, context_last, ivectors], axis=2)
-        x = self.lda(x)
-        x = self.kernel(x)
+        # Product of kernel and lda for native rate iVectors, kept while the layer is frozen
+        self._folded_weights = None
+        self._folded_weights_version = None
+
+    def forward(self, x, ivectors=None, ivector_period=10, frame_boundaries=None):
+        '''
+        x is either (batch_size, seq_len, 140) MFCCs+iVectors at frame rate, or (batch_size, seq_len, 40) MFCCs
+        if the iVectors are given separately at their native rate as (batch_size, ceil(seq_len/ivector_period), 100)
+        For packed sequences batch_size is 1, frame_boundaries holds the first and one past the last frame of the
+        utterance of each frame, and native rate iVectors hold the ceil(length/ivector_period) iVectors of each
+        utterance one after the other
+        '''
+        native_rate_ivectors = ivectors is not None
+        if native_rate_ivectors:
+            mfccs = x
+        else:
+            mfccs = x[:, :, :40]
+            ivectors = x[:, :, -100:]
+        if frame_boundaries is not None:
+            frame_starts, frame_ends = frame_boundaries
+            frames = torch.arange(mfccs.shape[1], device=mfccs.device)
+            context_first = mfccs[:, torch.maximum(frames - 1, frame_starts), :]
+            context_last = mfccs[:, torch.minimum(frames + 1, frame_ends - 1), :]
+        else:
+            padding_first = mfccs[:, 0, :][:, None, :]
+            padding_last = mfccs[:, -1, :][:, None, :]
+            context_first = torch.cat([padding_first, mfccs[:, :-1, :]], axis=1)
+            context_last = torch.cat([mfccs[:, 1:, :], padding_last], axis=1)
+        if native_rate_ivectors and frame_boundaries is not None:
+            x = torch.cat([context_first, mfccs, context_last], axis=2)
+            x = self._lda_and_kernel_with_packed_native_rate_ivectors(x, ivectors, ivector_period, frame_boundaries)
+        elif native_rate_ivectors:
+            x = torch.cat([context_first, mfccs, context_last], axis=2)
+            x = self._lda_and_kernel_with_native_rate_ivectors(x, ivectors, ivector_period)
+        else:
+            x = torch.cat([context_first, mfccs, context_last, ivectors], axis=2)
+            x = self.lda(x)
+            x = self.kernel(x)
         x = self.nonlinearity(x)
 
         x = x.transpose(1, 2)
@@ -85,18 +135,99 @@ class InputLayer(nn.Module):
         x = self.drop(x)
         return x
 
+    def _get_lda_and_kernel_weights(self, mfcc_dim):
+        if isinstance(self.lda, nn.Identity):
+            # Already merged into kernel (see optimize_for_inference)
+            return self.kernel.weight[:, :mfcc_dim], self.kernel.weight[:, mfcc_dim:], self.kernel.bias
+        if self.training and any(param.requires_grad for param in self.parameters()):
+            return self._fold_lda_and_kernel(mfcc_dim)
+
+        # Frozen layer: the product is computed once, and again only when the parameters are updated in place
+        # (loading a state dict, optimizer steps) or moved to another device or dtype
+        params = [self.lda.weight, self.lda.bias, self.kernel.weight, self.kernel.bias]
+        version = (mfcc_dim,) + tuple((param._version, param.data_ptr(), param.dtype) for param in params)
+        if self._folded_weights_version != version:
+            with torch.no_grad():
+                self._folded_weights = self._fold_lda_and_kernel(mfcc_dim)
+            self._folded_weights_version = version
+        return self._folded_weights
+
+    def _fold_lda_and_kernel(self, mfcc_dim):
+        # lda and kernel are both affine with nothing in between, so they are applied as one product
+        mfcc_weight = torch.matmul(self.kernel.weight, self.lda.weight[:, :mfcc_dim])
+        ivector_weight = torch.matmul(self.kernel.weight, self.lda.weight[:, mfcc_dim:])
+        bias = torch.matmul(self.kernel.weight, self.lda.bias) + self.kernel.bias
+        return mfcc_weight, ivector_weight, bias
 
-def sum_outputs_and_feed_to_layer(x, x_2, layer):
+    def _lda_and_kernel_with_native_rate_ivectors(self, spliced_mfccs, ivectors, ivector_period):
+        # The iVector part of the lda and kernel product is computed once per iVector period and repeated
+        # over its frames instead of being recomputed for every frame.
+        mfcc_weight, ivector_weight, bias = self._get_lda_and_kernel_weights(spliced_mfccs.shape[2])
+
+        seq_len = spliced_mfccs.shape[1]
+        ivector_count = math.ceil(seq_len / ivector_period)
+        # An iVector count other than this means the features were extracted with another iVector period
+        if ivectors.shape[1] != ivector_count:
+            raise Exception('Expected ' + str(ivector_count) + ' iVectors for ' + str(seq_len) + ' frames with an '
+                            'iVector period of ' + str(ivector_period) + ', got ' + str(ivectors.shape[1]) +
+                            '. Does the iVector period of the model match the one of the features?')
+
+        x = F.linear(spliced_mfccs, mfcc_weight)
+        ivector_contribution = F.linear(ivectors, ivector_weight, bias)
+        # Only sizes read from the tensors are used here, so that traced models (see CompiledModel) stay valid
+        # for any seq_len
+        ivector_contribution = torch.repeat_interleave(ivector_contribution, ivector_period, dim=1)
+        return x + ivector_contribution[:, :seq_len, :]
+
+    def _lda_and_kernel_with_packed_native_rate_ivectors(self, spliced_mfccs, ivectors, ivector_period,
+                                                         frame_boundaries):
+        # Same as above for packed sequences: the iVector contribution of each frame is gathered from the
+        # iVectors of its own utterance
+        mfcc_weight, ivector_weight, bias = self._get_lda_and_kernel_weights(spliced_mfccs.shape[2])
+
+        frame_starts, frame_ends = frame_boundaries
+        frames = torch.arange(spliced_mfccs.shape[1], device=spliced_mfccs.device)
+        is_first_frame = frames == frame_starts
+        utterance_starts, utterance_ends = frame_starts[is_first_frame], frame_ends[is_first_frame]
+        ivector_counts = torch.div(utterance_ends - utterance_starts + ivector_period - 1, ivector_period,
+                                   rounding_mode='floor')
+        if ivectors.shape[1] != int(ivector_counts.sum()):
+            raise Exception('Expected ' + str(int(ivector_counts.sum())) + ' packed iVectors, got ' +
+                            str(ivectors.shape[1]))
+        ivector_offsets = torch.cumsum(ivector_counts, 0) - ivector_counts
+        utterance_indexes = torch.cumsum(is_first_frame.long(), 0) - 1
+        frame_ivectors = ivector_offsets[utterance_indexes] + torch.div(frames - frame_starts, ivector_period,
+                                                                        rounding_mode='floor')
+
+        ivector_contribution = F.linear(ivectors, ivector_weight, bias)
+        return F.linear(spliced_mfccs, mfcc_weight) + ivector_contribution[:, frame_ivectors, :]
+
+
+def sum_outputs_and_feed_to_layer(x, x_2, layer, frame_boundaries=None):
     x_3 = x * 0.75 + x_2
     x = x_3
-    x_2 = layer(x_3)
+    if frame_boundaries is not None:
+        x_2 = layer(x_3, frame_boundaries=frame_boundaries)
+    else:
+        x_2 = layer(x_3)
     return x, x_2
 
 
+# For packed sequences (utterances concatenated along time, the i-th one in frames
+# [sequence_offsets[i], sequence_offsets[i + 1])), returns for each frame the first frame
+# of its utterance and one past its last frame
+def get_frame_boundaries(sequence_offsets):
+    lengths = sequence_offsets[1:] - sequence_offsets[:-1]
+    frame_starts = torch.repeat_interleave(sequence_offsets[:-1], lengths)
+    frame_ends = torch.repeat_interleave(sequence_offsets[1:], lengths)
+    return frame_starts, frame_ends
+
+
 class FTDNN(nn.Module):
 
-    def __init__(self, in_dim=220, batchnorm=None, dropout_p=0, device_name='cpu'):
+    def __init__(self, in_dim=220, batchnorm=None, dropout_p=0, device_name='cpu', ivector_period=10):
         super(FTDNN, self).__init__()
+        self.ivector_period = ivector_period
 
         self.layer01 = InputLayer(input_dim=in_dim, output_dim=1536)
         self.layer02 = FTDNNLayer(3072, 160, 320, 1536, 1, dropout_p=dropout_p, device=device_name)
@@ -117,26 +248,44 @@ class FTDNN(nn.Module):
         self.layer17 = FTDNNLayer(3072, 160, 320, 1536, 3, dropout_p=dropout_p, device=device_name)
         self.layer18 = nn.Linear(1536, 256, bias=False)  # This is the prefinal-l layer
 
-    def forward(self, x):
+        # Frames of past and future context each output frame depends on: one on each side from the splicing in
+        # the input layer, and time_offset on each side from every FTDNNLayer (before and after sorth)
+        time_offsets = [layer.time_offset for layer in self.children() if isinstance(layer, FTDNNLayer)]
+        self.left_context = 1 + sum(time_offsets)
+        self.right_context = 1 + sum(time_offsets)
+
+    def forward(self, x, ivectors=None, sequence_offsets=None):
         '''
-        Input must be (batch_size, seq_len, in_dim)
+        Input must be (batch_size, seq_len, in_dim), or (batch_size, seq_len, 40) MFCCs plus
+        native rate iVectors (batch_size, ceil(seq_len/ivector_period), 100)
+        With sequence_offsets, input holds packed sequences: (1, total_frames, in_dim) with the utterances one
+        after the other, the i-th one in frames [sequence_offsets[i], sequence_offsets[i + 1]). Each utterance
+        gets the same output as if it was run alone, and no padding is needed.
         '''
-        x = self.layer01(x)
-        x_2 = self.layer02(x)
-        x, x_2 = sum_outputs_and_feed_to_layer(x, x_2, self.layer03)
-        x, x_2 = sum_outputs_and_feed_to_layer(x, x_2, self.layer04)
-        x, x_2 = sum_outputs_and_feed_to_layer(x, x_2, self.layer05)
-        x, x_2 = sum_outputs_and_feed_to_layer(x, x_2, self.layer06)
-        x, x_2 = sum_outputs_and_feed_to_layer(x, x_2, self.layer07)
-        x, x_2 = sum_outputs_and_feed_to_layer(x, x_2, self.layer08)
-        x, x_2 = sum_outputs_and_feed_to_layer(x, x_2, self.layer09)
-        x, x_2 = sum_outputs_and_feed_to_layer(x, x_2, self.layer10)
-        x, x_2 = sum_outputs_and_feed_to_layer(x, x_2, self.layer11)
-        x, x_2 = sum_outputs_and_feed_to_layer(x, x_2, self.layer12)
-        x, x_2 = sum_outputs_and_feed_to_layer(x, x_2, self.layer13)
-        x, x_2 = sum_outputs_and_feed_to_layer(x, x_2, self.layer14)
-        x, x_2 = sum_outputs_and_feed_to_layer(x, x_2, self.layer15)
-        x, x_2 = sum_outputs_and_feed_to_layer(x, x_2, self.layer16)
-        x, x_2 = sum_outputs_and_feed_to_layer(x, x_2, self.layer17)
-        x, x_2 = sum_outputs_and_feed_to_layer(x, x_2, self.layer18)
-        return x_2
+        x = self.forward_to_prefinal_layer(x, ivectors=ivectors, sequence_offsets=sequence_offsets)
+        return self.layer18(x)
+
+    # Runs every layer but the prefinal one (layer18), returning its input
+    def forward_to_prefinal_layer(self, x, ivectors=None, sequence_offsets=None):
+        frame_boundaries = None
+        if sequence_offsets is not None:
+            frame_boundaries = get_frame_boundaries(sequence_offsets)
+
+        x = self.layer01(x, ivectors=ivectors, ivector_period=self.ivector_period, frame_boundaries=frame_boundaries)
+        x_2 = self.layer02(x, frame_boundaries=frame_boundaries)
+        x, x_2 = sum_outputs_and_feed_to_layer(x, x_2, self.layer03, frame_boundaries=frame_boundaries)
+        x, x_2 = sum_outputs_and_feed_to_layer(x, x_2, self.layer04, frame_boundaries=frame_boundaries)
+        x, x_2 = sum_outputs_and_feed_to_layer(x, x_2, self.layer05, frame_boundaries=frame_boundaries)
+        x, x_2 = sum_outputs_and_feed_to_layer(x, x_2, self.layer06, frame_boundaries=frame_boundaries)
+        x, x_2 = sum_outputs_and_feed_to_layer(x, x_2, self.layer07, frame_boundaries=frame_boundaries)
+        x, x_2 = sum_outputs_and_feed_to_layer(x, x_2, self.layer08, frame_boundaries=frame_boundaries)
+        x, x_2 = sum_outputs_and_feed_to_layer(x, x_2, self.layer09, frame_boundaries=frame_boundaries)
+        x, x_2 = sum_outputs_and_feed_to_layer(x, x_2, self.layer10, frame_boundaries=frame_boundaries)
+        x, x_2 = sum_outputs_and_feed_to_layer(x, x_2, self.layer11, frame_boundaries=frame_boundaries)
+        x, x_2 = sum_outputs_and_feed_to_layer(x, x_2, self.layer12, frame_boundaries=frame_boundaries)
+        x, x_2 = sum_outputs_and_feed_to_layer(x, x_2, self.layer13, frame_boundaries=frame_boundaries)
+        x, x_2 = sum_outputs_and_feed_to_layer(x, x_2, self.layer14, frame_boundaries=frame_boundaries)
+        x, x_2 = sum_outputs_and_feed_to_layer(x, x_2, self.layer15, frame_boundaries=frame_boundaries)
+        x, x_2 = sum_outputs_and_feed_to_layer(x, x_2, self.layer16, frame_boundaries=frame_boundaries)
+        x, x_2 = sum_outputs_and_feed_to_layer(x, x_2, self.layer17, frame_boundaries=frame_boundaries)
+        return x * 0.75 + x_2
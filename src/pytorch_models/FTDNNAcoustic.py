@@ -34,15 +34,15 @@ class OutputLayer(nn.Module):
 
 class FTDNNAcoustic(nn.Module):
 
-    def __init__(self):
+    def __init__(self, ivector_period=10):
         super(FTDNNAcoustic, self).__init__()
-        self.ftdnn = FTDNN()
+        self.ftdnn = FTDNN(ivector_period=ivector_period)
         self.output_layer = OutputLayer(256, 1536, 256, 6024)
 
-    def forward(self, x):
+    def forward(self, x, ivectors=None, sequence_offsets=None):
         '''
-        Input must be (batch_size, seq_len, in_dim)
+        Input must be (batch_size, seq_len, in_dim), see FTDNN.forward for native rate iVectors and packed sequences
         '''
-        x = self.ftdnn(x)
+        x = self.ftdnn(x, ivectors=ivectors, sequence_offsets=sequence_offsets)
         x = self.output_layer(x)
         return x
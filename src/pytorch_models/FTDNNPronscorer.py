@@ -28,21 +28,50 @@ class OutputLayer(nn.Module):
 
 class FTDNNPronscorer(nn.Module):
 
-    def __init__(self, out_dim=40, batchnorm=None, dropout_p=0, device_name='cpu'):
+    def __init__(self, out_dim=40, batchnorm=None, dropout_p=0, device_name='cpu', ivector_period=10):
         super(FTDNNPronscorer, self).__init__()
 
         use_final_bn = False
         if batchnorm in ["final", "last", "firstlast"]:
             use_final_bn = True
 
-        self.ftdnn = FTDNN(batchnorm=batchnorm, dropout_p=dropout_p, device_name=device_name)
+        self.ftdnn = FTDNN(batchnorm=batchnorm, dropout_p=dropout_p, device_name=device_name,
+                           ivector_period=ivector_period)
         self.output_layer = OutputLayer(256, out_dim, use_bn=use_final_bn)
 
-    def forward(self, x):
+    def forward(self, x, ivectors=None, sequence_offsets=None):
         """
-        Input must be (batch_size, seq_len, in_dim)
+        Input must be (batch_size, seq_len, in_dim), see FTDNN.forward for native rate iVectors and packed sequences
         """
-        x = self.ftdnn(x)
+        x = self.ftdnn(x, ivectors=ivectors, sequence_offsets=sequence_offsets)
         x = self.output_layer(x)
 
         return x
+
+    # The model is split into a frozen trunk and a trainable tail with the last tail_layers layers:
+    # output_layer for 1, and also ftdnn.layer18 for 2. Outputs of the trunk can then be computed once and cached.
+    def get_trunk_modules(self, tail_layers):
+        if tail_layers == 1:
+            return [self.ftdnn]
+        if tail_layers == 2:
+            return [module for name, module in self.ftdnn.named_children() if name != 'layer18']
+        raise Exception('Only the last 1 or 2 layers can be split from the trunk, got ' + str(tail_layers))
+
+    def forward_trunk(self, x, ivectors=None, sequence_offsets=None, tail_layers=1):
+        """
+        Returns the trunk outputs, (batch_size, seq_len, 256) for tail_layers=1 and (batch_size, seq_len, 1536)
+        for tail_layers=2
+        """
+        if tail_layers == 1:
+            return self.ftdnn(x, ivectors=ivectors, sequence_offsets=sequence_offsets)
+        if tail_layers == 2:
+            return self.ftdnn.forward_to_prefinal_layer(x, ivectors=ivectors, sequence_offsets=sequence_offsets)
+        raise Exception('Only the last 1 or 2 layers can be split from the trunk, got ' + str(tail_layers))
+
+    def forward_tail(self, x, tail_layers=1):
+        """
+        Input must be the trunk outputs for the same tail_layers, see forward_trunk
+        """
+        if tail_layers == 2:
+            x = self.ftdnn.layer18(x)
+        return self.output_layer(x)
@@ -0,0 +1,41 @@
+import numpy as np
+import onnxruntime
+import torch
+
+from src.pytorch_models.onnx_export import MIN_SEQ_LEN
+
+
+class OnnxModel:
+    """
+    ONNX Runtime (CPU) version of a model exported with export_to_onnx, called like the PyTorch models: it takes
+    features and optionally native rate iVectors as tensors and returns the outputs as a tensor. run does the same
+    on numpy arrays. Sequences must have at least MIN_SEQ_LEN frames (see onnx_export).
+    """
+
+    def __init__(self, onnx_path, num_threads=None):
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads is not None:
+            options.intra_op_num_threads = num_threads
+        self.session = onnxruntime.InferenceSession(onnx_path, sess_options=options,
+                                                    providers=['CPUExecutionProvider'])
+        self.input_names = [model_input.name for model_input in self.session.get_inputs()]
+        self.onnx_path = onnx_path
+
+    def __call__(self, x, ivectors=None, sequence_offsets=None):
+        if sequence_offsets is not None:
+            raise Exception('Packed sequences are not supported by ONNX models')
+        ivectors = None if ivectors is None else ivectors.detach().cpu().numpy()
+        return torch.from_numpy(self.run(x.detach().cpu().numpy(), ivectors=ivectors))
+
+    def run(self, features, ivectors=None):
+        if features.shape[1] < MIN_SEQ_LEN:
+            raise Exception(self.onnx_path + ' only holds for sequences of at least ' + str(MIN_SEQ_LEN) +
+                            ' frames, got ' + str(features.shape[1]) + '. Use the pytorch inference backend')
+        if (ivectors is not None) != ('ivectors' in self.input_names):
+            raise Exception(self.onnx_path + ' was exported with' + ('' if 'ivectors' in self.input_names else 'out') +
+                            ' native rate iVectors, export it again to match native-rate-ivectors')
+        inputs = {'features': np.ascontiguousarray(features, dtype=np.float32)}
+        if ivectors is not None:
+            inputs['ivectors'] = np.ascontiguousarray(ivectors, dtype=np.float32)
+        return self.session.run(['outputs'], inputs)[0]
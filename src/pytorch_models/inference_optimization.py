@@ -0,0 +1,147 @@
+import copy
+
+import torch
+import torch.nn as nn
+
+from src.pytorch_models.FTDNNAcoustic import FTDNNAcoustic
+from src.pytorch_models.FTDNNPronscorer import FTDNNPronscorer
+
+
+# Returns a copy of an FTDNNPronscorer or FTDNNAcoustic for inference only, with the same outputs as the model
+# in eval mode (up to rounding) but fewer kernels per frame:
+#   - Dropouts are removed.
+#   - lda and kernel in the input layer are merged into one linear layer.
+#   - Eval mode batchnorms are folded into the linear layers around them. A batchnorm after a ReLU scales by a
+#     positive factor, which is moved before the ReLU into the preceding linear layer, and shifts by a constant,
+#     which is carried along the residual connections into the biases of the layers that read it.
+#   - For the pronscorer, the prefinal layer (layer18) and the output layer are merged into one linear layer.
+# The resulting model cannot be trained nor loaded from the original state dicts.
+def optimize_for_inference(model):
+    if not isinstance(model, (FTDNNPronscorer, FTDNNAcoustic)):
+        raise Exception('Cannot optimize ' + type(model).__name__ + ' for inference')
+
+    model = copy.deepcopy(model)
+    model.eval()
+    with torch.no_grad():
+        _fold_ftdnn(model.ftdnn)
+        if isinstance(model, FTDNNPronscorer):
+            _fold_pronscorer_output_layer(model)
+        else:
+            _fold_acoustic_output_layer(model.output_layer)
+    for param in model.parameters():
+        param.requires_grad = False
+    return model
+
+
+# Folds the batchnorms of the FTDNN layers and merges lda and kernel. The constants left out of the layer
+# outputs end up in the bias of the prefinal layer, so the FTDNN outputs do not change.
+def _fold_ftdnn(ftdnn):
+    input_layer = ftdnn.layer01
+    kernel_weight = input_layer.kernel.weight.double()
+    kernel_bias = kernel_weight @ input_layer.lda.bias.double() + input_layer.kernel.bias.double()
+    kernel_weight = kernel_weight @ input_layer.lda.weight.double()
+    kernel_weight, kernel_bias, input_layer_offset = _fold_batchnorm_after_relu(kernel_weight, kernel_bias,
+                                                                                input_layer.bn)
+    input_layer.lda = nn.Identity()
+    input_layer.kernel = _make_linear(kernel_weight, kernel_bias, input_layer.kernel.weight)
+    input_layer.bn = nn.Identity()
+    input_layer.drop = nn.Identity()
+
+    # Missing constants of x and x_2 as FTDNN.forward sums them
+    x_offset = input_layer_offset
+    x_2_offset = _fold_ftdnn_layer(ftdnn.layer02, x_offset)
+    for layer in [ftdnn.layer03, ftdnn.layer04, ftdnn.layer05, ftdnn.layer06, ftdnn.layer07, ftdnn.layer08,
+                  ftdnn.layer09, ftdnn.layer10, ftdnn.layer11, ftdnn.layer12, ftdnn.layer13, ftdnn.layer14,
+                  ftdnn.layer15, ftdnn.layer16, ftdnn.layer17]:
+        x_offset = x_offset * 0.75 + x_2_offset
+        x_2_offset = _fold_ftdnn_layer(layer, x_offset)
+    x_offset = x_offset * 0.75 + x_2_offset
+
+    prefinal_weight = ftdnn.layer18.weight.double()
+    ftdnn.layer18 = _make_linear(prefinal_weight, prefinal_weight @ x_offset, ftdnn.layer18.weight)
+
+
+# Folds the batchnorm of an FTDNNLayer whose input is missing the constant input_offset.
+# Returns the constant its output is missing.
+def _fold_ftdnn_layer(layer, input_offset):
+    sorth_weight = layer.sorth.weight.double()
+    if layer.time_offset != 0:
+        # The sorth input holds the frames t - time_offset and t, both missing the same constant
+        sorth_input_offset = torch.cat([input_offset, input_offset])
+    else:
+        sorth_input_offset = input_offset
+    layer.sorth = _make_linear(sorth_weight, sorth_weight @ sorth_input_offset, layer.sorth.weight)
+
+    affine_weight, affine_bias, output_offset = _fold_batchnorm_after_relu(layer.affine.weight.double(),
+                                                                           layer.affine.bias.double(), layer.bn)
+    layer.affine = _make_linear(affine_weight, affine_bias, layer.affine.weight)
+    layer.bn = nn.Identity()
+    layer.dropout = nn.Identity()
+    return output_offset
+
+
+def _fold_pronscorer_output_layer(model):
+    output_layer = model.output_layer
+    weight = output_layer.linear.weight.double()
+    bias = output_layer.linear.bias.double()
+    if output_layer.use_bn:
+        weight, bias = _fold_batchnorm_before_linear(output_layer.bn, weight, bias)
+        output_layer.use_bn = False
+        del output_layer.bn
+
+    # The prefinal layer has no nonlinearity after it, so it is merged into the output layer
+    prefinal = model.ftdnn.layer18
+    merged_weight = weight @ prefinal.weight.double()
+    merged_bias = weight @ prefinal.bias.double() + bias
+    output_layer.linear = _make_linear(merged_weight, merged_bias, output_layer.linear.weight)
+    model.ftdnn.layer18 = nn.Identity()
+
+
+def _fold_acoustic_output_layer(output_layer):
+    linear2_weight, linear2_bias = _fold_batchnorm_before_linear(output_layer.bn1,
+                                                                 output_layer.linear2.weight.double(), None)
+    output_layer.linear2 = _make_linear(linear2_weight, linear2_bias, output_layer.linear2.weight)
+    linear3_weight, linear3_bias = _fold_batchnorm_before_linear(output_layer.bn2,
+                                                                 output_layer.linear3.weight.double(),
+                                                                 output_layer.linear3.bias.double())
+    output_layer.linear3 = _make_linear(linear3_weight, linear3_bias, output_layer.linear3.weight)
+    # linear2 and linear3 are kept apart: through the 256 dim bottleneck they take less than a third of the
+    # multiplications of their product
+    output_layer.bn1 = nn.Identity()
+    output_layer.bn2 = nn.Identity()
+
+
+# Eval mode batchnorm as an affine transform: bn(x) = scale * x + shift
+def _get_batchnorm_scale_and_shift(bn):
+    scale = 1 / torch.sqrt(bn.running_var.double() + bn.eps)
+    shift = -bn.running_mean.double() * scale
+    if bn.affine:
+        scale = scale * bn.weight.double()
+        shift = shift * bn.weight.double() + bn.bias.double()
+    return scale, shift
+
+
+# bn(relu(W x + b)) = relu(scale * (W x + b)) + shift, for a positive scale.
+# Returns the scaled weight and bias, and the shift that is left out.
+def _fold_batchnorm_after_relu(weight, bias, bn):
+    scale, shift = _get_batchnorm_scale_and_shift(bn)
+    if torch.any(scale <= 0):
+        raise Exception('Cannot fold a batchnorm with non positive scales across a ReLU')
+    return weight * scale[:, None], bias * scale, shift
+
+
+# W bn(x) + b = (W * scale) x + (W shift + b)
+def _fold_batchnorm_before_linear(bn, weight, bias):
+    scale, shift = _get_batchnorm_scale_and_shift(bn)
+    folded_bias = weight @ shift
+    if bias is not None:
+        folded_bias = folded_bias + bias
+    return weight * scale[None, :], folded_bias
+
+
+# Linear layer with the given (double precision) parameters, in the device and dtype of like
+def _make_linear(weight, bias, like):
+    linear = nn.Linear(weight.shape[1], weight.shape[0], bias=True, device=like.device, dtype=like.dtype)
+    linear.weight.copy_(weight)
+    linear.bias.copy_(bias)
+    return linear
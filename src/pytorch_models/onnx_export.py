@@ -0,0 +1,83 @@
+import math
+import os
+import warnings
+
+import torch
+
+# Values of the inference-backend config key: 'pytorch' runs the models in PyTorch, 'onnxruntime' runs their ONNX
+# export (see export_to_onnx) with ONNX Runtime on the CPU
+INFERENCE_BACKENDS = ['pytorch', 'onnxruntime']
+
+# Frames of the example inputs the models are exported with. Batch and time axes are dynamic, so the outputs
+# hold for other sizes (see check_onnx_parity).
+EXPORT_SEQ_LEN = 50
+# Shortest sequence the exports hold for. The time offsets of the layers (up to 3 frames) are compared with the
+# sequence length when tracing, so shorter sequences would run with the offsets of EXPORT_SEQ_LEN frames.
+MIN_SEQ_LEN = 4
+
+
+# Whether the export stages run: they are needed by the onnxruntime backend, and can be asked for with export-onnx
+def is_onnx_export_enabled(config_dict):
+    inference_backend = config_dict.get('inference-backend', 'pytorch')
+    if inference_backend not in INFERENCE_BACKENDS:
+        raise Exception('Unsupported inference backend ' + inference_backend)
+    return config_dict.get('export-onnx', False) or inference_backend == 'onnxruntime'
+
+
+# ivector_period must be the one of the model (see FTDNN.ivector_period)
+def get_example_inputs(batch_size, seq_len, native_rate_ivectors=False, ivector_period=10, device='cpu'):
+    if not native_rate_ivectors:
+        return (torch.randn(batch_size, seq_len, 140, device=device),)
+    return (torch.randn(batch_size, seq_len, 40, device=device),
+            torch.randn(batch_size, math.ceil(seq_len / ivector_period), 100, device=device))
+
+
+# Exports an FTDNNPronscorer or FTDNNAcoustic in eval mode to onnx_path, with dynamic batch and time axes.
+# The graph takes 'features' (batch_size, seq_len, 140), or 'features' (batch_size, seq_len, 40) and 'ivectors'
+# (batch_size, ceil(seq_len/ivector_period), 100) with native rate iVectors, where ivector_period is the one the
+# model was built with, and returns 'outputs' (batch_size, seq_len, dim).
+def export_to_onnx(model, onnx_path, native_rate_ivectors=False, opset_version=14):
+    model.eval()
+    device = next(model.parameters()).device
+    example_inputs = get_example_inputs(2, EXPORT_SEQ_LEN, native_rate_ivectors, model.ftdnn.ivector_period, device)
+    input_names = ['features', 'ivectors'][:len(example_inputs)]
+    dynamic_axes = {'features': {0: 'batch_size', 1: 'seq_len'},
+                    'ivectors': {0: 'batch_size', 1: 'ivector_count'},
+                    'outputs': {0: 'batch_size', 1: 'seq_len'}}
+
+    os.makedirs(os.path.dirname(os.path.abspath(onnx_path)), exist_ok=True)
+    # Written to a temporary file first, so that a failed export never leaves a partial model behind
+    tmp_path = onnx_path + '.' + str(os.getpid()) + '.tmp'
+    with torch.no_grad(), warnings.catch_warnings():
+        # The time offsets are compared with the sequence length, which the tracer warns about
+        warnings.simplefilter('ignore', torch.jit.TracerWarning)
+        torch.onnx.export(model, example_inputs, tmp_path,
+                          export_params=True,
+                          opset_version=opset_version,
+                          do_constant_folding=True,
+                          input_names=input_names,
+                          output_names=['outputs'],
+                          dynamic_axes={name: dynamic_axes[name] for name in input_names + ['outputs']})
+    os.replace(tmp_path, onnx_path)
+
+
+# Runs the model and its export on random inputs of several batch sizes and lengths, including lengths other
+# than the export one, and raises if their outputs differ by more than tolerance. Returns the max abs diff.
+def check_onnx_parity(model, onnx_path, native_rate_ivectors=False, tolerance=1e-3,
+                      shapes=((2, EXPORT_SEQ_LEN), (1, MIN_SEQ_LEN), (1, 7), (3, 123), (2, 480))):
+    # Imported here, so that exporting and choosing the backend do not need ONNX Runtime
+    from src.pytorch_models.OnnxModel import OnnxModel
+
+    model.eval()
+    onnx_model = OnnxModel(onnx_path)
+    max_diff = 0
+    with torch.no_grad():
+        for batch_size, seq_len in shapes:
+            example_inputs = get_example_inputs(batch_size, seq_len, native_rate_ivectors, model.ftdnn.ivector_period)
+            outputs = model(*[tensor.to(next(model.parameters()).device) for tensor in example_inputs]).cpu()
+            onnx_outputs = onnx_model(*example_inputs)
+            max_diff = max(max_diff, torch.max(torch.abs(outputs - onnx_outputs)).item())
+    if max_diff > tolerance:
+        raise Exception('Outputs of ' + onnx_path + ' differ from the PyTorch ones by ' + str(max_diff) +
+                        ', more than ' + str(tolerance))
+    return max_diff
@@ -0,0 +1,22 @@
+import torch
+import torch.nn as nn
+
+# Values of the quantization config key: 'none' keeps float32, 'dynamic-int8' quantizes the weights of the linear
+# layers to int8 and their activations on the fly, batch by batch
+QUANTIZATION_MODES = ['none', 'dynamic-int8']
+
+
+# Returns the model for CPU inference with its linear layers quantized as given by mode.
+# The input layer stays in float32: it takes a small part of the computation, and with native rate iVectors
+# its weights are read directly instead of running it as a module.
+def quantize_for_inference(model, mode):
+    if mode not in QUANTIZATION_MODES:
+        raise Exception('Unsupported quantization ' + mode)
+    if mode == 'none':
+        return model
+
+    quantized_layers = set(name for name, module in model.named_modules()
+                           if isinstance(module, nn.Linear) and '.layer01.' not in '.' + name + '.')
+    if len(quantized_layers) == 0:
+        raise Exception('No linear layers to quantize in ' + type(model).__name__)
+    return torch.ao.quantization.quantize_dynamic(model, quantized_layers, dtype=torch.qint8)
@@ -0,0 +1,106 @@
+# Compares the channel first (Conv1d) FTDNN models with the original ones: checks that they give the same outputs
+# once the original state dict is loaded through the key and shape mapping, and reports the time per forward and
+# the part of it spent in layout copies (copy_, contiguous, clone). Example, from the repository root:
+#
+#   python -m src.scripts.benchmark_channel_first_ftdnn --model pronscorer --device cuda --batch-size 32
+import argparse
+import time
+
+import torch
+from torch.profiler import ProfilerActivity, profile
+
+from src.pytorch_models.ConvFTDNN import ConvFTDNNAcoustic, ConvFTDNNPronscorer
+from src.pytorch_models.FTDNNAcoustic import FTDNNAcoustic
+from src.pytorch_models.FTDNNPronscorer import FTDNNPronscorer
+
+LAYOUT_COPY_OPS = ['aten::copy_', 'aten::contiguous', 'aten::clone']
+
+
+def create_models(args):
+    if args.model == 'acoustic':
+        model, conv_model = FTDNNAcoustic(), ConvFTDNNAcoustic()
+    else:
+        model = FTDNNPronscorer(out_dim=args.out_dim, batchnorm=args.batchnorm)
+        conv_model = ConvFTDNNPronscorer(out_dim=args.out_dim, batchnorm=args.batchnorm)
+
+    if args.model_path is not None:
+        model.load_state_dict(torch.load(args.model_path, map_location='cpu')['model_state_dict'])
+    else:
+        # Non trivial batchnorm statistics, so that they take part in the comparison
+        for module in model.modules():
+            if isinstance(module, torch.nn.BatchNorm1d):
+                module.running_mean.uniform_(-0.5, 0.5)
+                module.running_var.uniform_(0.5, 2)
+    conv_model.load_ftdnn_state_dict(model.state_dict())
+
+    device = torch.device(args.device)
+    return model.to(device).eval(), conv_model.to(device).eval()
+
+
+def time_forward(forward, x, repetitions):
+    forward(x)
+    if x.is_cuda:
+        torch.cuda.synchronize()
+    start_time = time.time()
+    for _ in range(repetitions):
+        forward(x)
+    if x.is_cuda:
+        torch.cuda.synchronize()
+    return (time.time() - start_time) / repetitions
+
+
+# Returns the number of layout copies in one forward and the CPU time they take, in ms
+def profile_layout_copies(forward, x):
+    activities = [ProfilerActivity.CPU] + ([ProfilerActivity.CUDA] if x.is_cuda else [])
+    with profile(activities=activities) as profiler:
+        forward(x)
+    copy_count = 0
+    copy_time = 0
+    for event in profiler.key_averages():
+        if event.key in LAYOUT_COPY_OPS:
+            copy_count += event.count
+            copy_time += event.self_cpu_time_total
+    return copy_count, copy_time / 1000
+
+
+def main(args):
+    torch.manual_seed(args.seed)
+    model, conv_model = create_models(args)
+    x = torch.randn(args.batch_size, args.seq_len, 140, device=args.device)
+
+    with torch.no_grad():
+        max_diff = torch.max(torch.abs(model(x) - conv_model(x))).item()
+        print('Max abs diff between the original and the channel first outputs: %e' % max_diff)
+
+        channel_first_x = x.transpose(1, 2).contiguous()
+        forwards = [('Original', model),
+                    ('Channel first', conv_model),
+                    ('Channel first (B, C, T) input', conv_model.forward_channel_first)]
+        for name, forward in forwards:
+            inputs = channel_first_x if forward == conv_model.forward_channel_first else x
+            forward_time = time_forward(forward, inputs, args.repetitions)
+            copy_count, copy_time = profile_layout_copies(forward, inputs)
+            print('%s: %.2f ms per forward, %d layout copies taking %.2f ms' % (
+                name, forward_time * 1000, copy_count, copy_time))
+
+    if max_diff > args.tolerance:
+        raise Exception('Channel first outputs differ from the original ones by more than ' + str(args.tolerance))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', dest='model', choices=['pronscorer', 'acoustic'], default='pronscorer')
+    parser.add_argument('--state-dict', dest='model_path', help='State dict of the original model, random if not given',
+                        default=None)
+    parser.add_argument('--out-dim', dest='out_dim', type=int, help='Output dimension of the pronscorer', default=39)
+    parser.add_argument('--batchnorm', dest='batchnorm', help='Batchnorm setting of the pronscorer', default='last')
+    parser.add_argument('--device', dest='device', help='Device to run the models on', default='cpu')
+    parser.add_argument('--batch-size', dest='batch_size', type=int, help='Batch size', default=16)
+    parser.add_argument('--seq-len', dest='seq_len', type=int, help='Frames per sequence', default=500)
+    parser.add_argument('--repetitions', dest='repetitions', type=int, help='Timed runs of each model', default=10)
+    parser.add_argument('--tolerance', dest='tolerance', type=float, help='Maximum allowed abs diff', default=1e-3)
+    parser.add_argument('--seed', dest='seed', type=int, help='Random seed', default=0)
+
+    args = parser.parse_args()
+
+    main(args)
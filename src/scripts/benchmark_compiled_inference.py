@@ -0,0 +1,111 @@
+# Compares CompiledModel with the eager acoustic and pronscoring models: checks that the traced models give the
+# same outputs for utterances of several lengths, with frame rate and native rate iVectors, and reports the time
+# per utterance of both and the startup time of tracing and of loading the cached traces.
+# Uses randomly initialized models unless state dicts are given. Example, from the repository root:
+#
+#   python -m src.scripts.benchmark_compiled_inference --acoustic-model data/pytorch_models/acoustic_model.pt
+import argparse
+import tempfile
+import time
+
+import torch
+
+from src.pytorch_models.CompiledModel import CompiledModel, get_compiled_model_key
+from src.pytorch_models.FTDNNAcoustic import FTDNNAcoustic
+from src.pytorch_models.FTDNNPronscorer import FTDNNPronscorer
+
+
+def randomize_batchnorm_statistics(model):
+    for module in model.modules():
+        if isinstance(module, torch.nn.BatchNorm1d):
+            module.running_mean.uniform_(-0.5, 0.5)
+            module.running_var.uniform_(0.5, 2)
+
+
+def create_models(args):
+    acoustic_model = FTDNNAcoustic()
+    if args.acoustic_model_path is not None:
+        acoustic_model.load_state_dict(torch.load(args.acoustic_model_path, map_location='cpu'))
+    else:
+        randomize_batchnorm_statistics(acoustic_model)
+
+    pronscorer = FTDNNPronscorer(out_dim=args.out_dim, batchnorm=args.batchnorm)
+    if args.pronscorer_path is not None:
+        pronscorer.load_state_dict(torch.load(args.pronscorer_path, map_location='cpu')['model_state_dict'])
+    else:
+        randomize_batchnorm_statistics(pronscorer)
+
+    return {'Acoustic model': acoustic_model.eval(), 'Pronscorer': pronscorer.eval()}
+
+
+# Runs each utterance alone, as alignment does, and returns the time per utterance
+def time_utterances(model, utterances):
+    start_time = time.time()
+    for features, ivectors in utterances:
+        model(features, ivectors=ivectors)
+    return (time.time() - start_time) / len(utterances)
+
+
+def main(args):
+    torch.manual_seed(args.seed)
+    lengths = torch.randint(args.min_length, args.max_length + 1, (args.utterances,)).tolist()
+    # The first utterance, which the models are traced on, is one frame past a whole number of iVector periods,
+    # so that the shorter check input of the trace has one iVector less
+    lengths[0] = args.min_length - args.min_length % 10 + 11
+    frame_rate_utterances = [(torch.randn(1, length, 140), None) for length in lengths]
+    native_rate_utterances = [(features[:, :, :40], features[:, ::10, 40:]) for features, _ in frame_rate_utterances]
+    cache_dir = args.cache_dir if args.cache_dir is not None else tempfile.mkdtemp()
+
+    max_diff = 0
+    with torch.no_grad():
+        for name, model in create_models(args).items():
+            key = get_compiled_model_key(model.state_dict(), type(model).__name__)
+
+            start_time = time.time()
+            compiled_model = CompiledModel(model, cache_dir, key)
+            for utterances in [frame_rate_utterances, native_rate_utterances]:
+                compiled_model(*utterances[0])
+            first_startup_time = time.time() - start_time
+
+            start_time = time.time()
+            compiled_model = CompiledModel(model, cache_dir, key)
+            for utterances in [frame_rate_utterances, native_rate_utterances]:
+                compiled_model(*utterances[0])
+            cached_startup_time = time.time() - start_time
+
+            print('%s: startup %.2f s tracing, %.2f s from the cache' % (name, first_startup_time,
+                                                                         cached_startup_time))
+            for layout, utterances in [('frame rate', frame_rate_utterances),
+                                       ('native rate', native_rate_utterances)]:
+                for features, ivectors in utterances:
+                    diff = torch.max(torch.abs(model(features, ivectors=ivectors) -
+                                               compiled_model(features, ivectors=ivectors))).item()
+                    max_diff = max(max_diff, diff)
+                eager_time = time_utterances(model, utterances)
+                compiled_time = time_utterances(compiled_model, utterances)
+                print('    %s iVectors: %.2f ms per utterance eager, %.2f ms compiled (%.2fx faster)' % (
+                    layout, eager_time * 1000, compiled_time * 1000, eager_time / compiled_time))
+
+    print('Max abs diff between the eager and the compiled outputs: %e' % max_diff)
+    if max_diff > args.tolerance:
+        raise Exception('Compiled outputs differ from the eager ones by more than ' + str(args.tolerance))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--acoustic-model', dest='acoustic_model_path', help='Acoustic model state dict',
+                        default=None)
+    parser.add_argument('--pronscorer', dest='pronscorer_path', help='Pronscorer checkpoint', default=None)
+    parser.add_argument('--out-dim', dest='out_dim', type=int, help='Output dimension of the pronscorer', default=39)
+    parser.add_argument('--batchnorm', dest='batchnorm', help='Batchnorm setting of the pronscorer', default='last')
+    parser.add_argument('--cache-dir', dest='cache_dir', help='Directory for the traces, temporary if not given',
+                        default=None)
+    parser.add_argument('--utterances', dest='utterances', type=int, help='Utterances to run', default=20)
+    parser.add_argument('--min-length', dest='min_length', type=int, help='Minimum utterance length', default=50)
+    parser.add_argument('--max-length', dest='max_length', type=int, help='Maximum utterance length', default=500)
+    parser.add_argument('--tolerance', dest='tolerance', type=float, help='Maximum allowed abs diff', default=1e-4)
+    parser.add_argument('--seed', dest='seed', type=int, help='Random seed', default=0)
+
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,100 @@
+# Checks that the time shifts of FTDNNLayer give the same outputs as the original list-of-frames splicing on
+# random inputs, and times both on the given device. Example, from the repository root:
+#
+#   python -m src.scripts.benchmark_ftdnn_layer_shifts --device cuda --batch-size 32 --seq-len 800
+import argparse
+import time
+
+import torch
+
+from src.pytorch_models.FTDNN import FTDNNLayer
+
+
+# FTDNNLayer.forward as it was before the time shifts were padded views, kept as reference
+def reference_forward(layer, x):
+    time_offset = layer.time_offset
+    if time_offset != 0:
+        padding = x[:, 0, :][:, None, :]
+        xd = torch.cat([padding] * time_offset + [x], axis=1)
+        xd = xd[:, :-time_offset, :]
+        x = torch.cat([xd, x], axis=2)
+    x = layer.sorth(x)
+    if time_offset != 0:
+        padding = x[:, -1, :][:, None, :]
+        padding = torch.zeros(padding.shape)
+        if x.is_cuda:
+            padding = padding.cuda()
+        xd = torch.cat([x] + [padding] * time_offset, axis=1)
+        xd = xd[:, time_offset:, :]
+        x = torch.cat([x, xd], axis=2)
+    x = layer.affine(x)
+    x = layer.nl(x)
+    x = x.transpose(1, 2)
+    x = layer.bn(x).transpose(1, 2)
+    x = layer.dropout(x)
+    return x
+
+
+def create_layer(time_offset, device):
+    in_dim = 1536 if time_offset == 0 else 3072
+    affine_in_dim = 160 if time_offset == 0 else 320
+    layer = FTDNNLayer(in_dim, 160, affine_in_dim, 1536, time_offset, device=device.type)
+    layer.bn.running_mean.uniform_(-0.5, 0.5)
+    layer.bn.running_var.uniform_(0.5, 2)
+    return layer.to(device).eval()
+
+
+def compare_outputs(layer, device, batch_size, seq_lens):
+    max_diff = 0
+    for seq_len in seq_lens:
+        x = torch.randn(batch_size, seq_len, 1536, device=device)
+        max_diff = max(max_diff, torch.max(torch.abs(layer(x) - reference_forward(layer, x))).item())
+    return max_diff
+
+
+def time_forward(forward, x, repetitions):
+    forward(x)
+    if x.is_cuda:
+        torch.cuda.synchronize()
+    start_time = time.time()
+    for _ in range(repetitions):
+        forward(x)
+    if x.is_cuda:
+        torch.cuda.synchronize()
+    return (time.time() - start_time) / repetitions
+
+
+def main(args):
+    torch.manual_seed(args.seed)
+    device = torch.device(args.device)
+
+    max_diffs = []
+    with torch.no_grad():
+        for time_offset in [0, 1, 3]:
+            layer = create_layer(time_offset, device)
+            # Sequences shorter than the offset are also checked
+            max_diff = compare_outputs(layer, device, args.batch_size, [1, 2, 3, 17, args.seq_len])
+            max_diffs.append(max_diff)
+
+            x = torch.randn(args.batch_size, args.seq_len, 1536, device=device)
+            reference_time = time_forward(lambda inputs: reference_forward(layer, inputs), x, args.repetitions)
+            padded_time = time_forward(layer, x, args.repetitions)
+            print('Time offset %d: max abs diff %e, reference %.2f ms, padded shifts %.2f ms (%.2fx faster)' % (
+                time_offset, max_diff, reference_time * 1000, padded_time * 1000, reference_time / padded_time))
+
+    if max(max_diffs) > args.tolerance:
+        raise Exception('Layer outputs differ from the reference by more than ' + str(args.tolerance))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--device', dest='device', help='Device to run the layers on', default='cpu')
+    parser.add_argument('--batch-size', dest='batch_size', type=int, help='Batch size', default=16)
+    parser.add_argument('--seq-len', dest='seq_len', type=int, help='Frames per sequence', default=500)
+    parser.add_argument('--repetitions', dest='repetitions', type=int, help='Timed runs of each layer', default=20)
+    parser.add_argument('--tolerance', dest='tolerance', type=float, help='Maximum allowed abs diff', default=1e-5)
+    parser.add_argument('--seed', dest='seed', type=int, help='Random seed', default=0)
+
+    args = parser.parse_args()
+
+    main(args)
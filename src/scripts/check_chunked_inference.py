@@ -0,0 +1,94 @@
+# Checks that chunked inference (see ChunkedModel) gives the same outputs as full utterance inference for the
+# acoustic and pronscoring models, with frame rate and native rate iVectors, and reports the time of both and, on
+# CUDA, their peak memory. Uses randomly initialized models unless state dicts are given. Example, from the
+# repository root:
+#
+#   python -m src.scripts.check_chunked_inference --seq-len 6000 --chunk-size 500 --device cuda
+import argparse
+import time
+
+import torch
+
+from src.pytorch_models.ChunkedModel import ChunkedModel
+from src.pytorch_models.FTDNNAcoustic import FTDNNAcoustic
+from src.pytorch_models.FTDNNPronscorer import FTDNNPronscorer
+
+
+def randomize_batchnorm_statistics(model):
+    for module in model.modules():
+        if isinstance(module, torch.nn.BatchNorm1d):
+            module.running_mean.uniform_(-0.5, 0.5)
+            module.running_var.uniform_(0.5, 2)
+
+
+def create_models(args):
+    acoustic_model = FTDNNAcoustic()
+    if args.acoustic_model_path is not None:
+        acoustic_model.load_state_dict(torch.load(args.acoustic_model_path, map_location='cpu'))
+    else:
+        randomize_batchnorm_statistics(acoustic_model)
+
+    pronscorer = FTDNNPronscorer(out_dim=args.out_dim, batchnorm=args.batchnorm)
+    if args.pronscorer_path is not None:
+        pronscorer.load_state_dict(torch.load(args.pronscorer_path, map_location='cpu')['model_state_dict'])
+    else:
+        randomize_batchnorm_statistics(pronscorer)
+
+    device = torch.device(args.device)
+    return {'Acoustic model': acoustic_model.to(device).eval(), 'Pronscorer': pronscorer.to(device).eval()}
+
+
+# Returns the outputs, the time and, on CUDA, the peak memory in MB of one forward
+def run_forward(model, features, ivectors):
+    if features.is_cuda:
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+    start_time = time.time()
+    with torch.no_grad():
+        outputs = model(features, ivectors=ivectors)
+    if features.is_cuda:
+        torch.cuda.synchronize()
+    forward_time = time.time() - start_time
+    peak_memory = torch.cuda.max_memory_allocated() / 2 ** 20 if features.is_cuda else float('nan')
+    return outputs, forward_time, peak_memory
+
+
+def main(args):
+    torch.manual_seed(args.seed)
+    features = torch.randn(1, args.seq_len, 140, device=args.device)
+    inputs = [('frame rate', features, None),
+              ('native rate', features[:, :, :40], features[:, ::10, 40:].contiguous())]
+
+    max_diff = 0
+    for name, model in create_models(args).items():
+        chunked_model = ChunkedModel(model, args.chunk_size, model.ftdnn)
+        print('%s: %d frames of left context, %d of right context' % (name, model.ftdnn.left_context,
+                                                                      model.ftdnn.right_context))
+        for layout, layout_features, ivectors in inputs:
+            outputs, full_time, full_memory = run_forward(model, layout_features, ivectors)
+            chunked_outputs, chunked_time, chunked_memory = run_forward(chunked_model, layout_features, ivectors)
+            diff = torch.max(torch.abs(outputs - chunked_outputs)).item()
+            max_diff = max(max_diff, diff)
+            print('    %s iVectors: max abs diff %e, full %.2f s (%.0f MB peak), chunked %.2f s (%.0f MB peak)' % (
+                layout, diff, full_time, full_memory, chunked_time, chunked_memory))
+
+    if max_diff > args.tolerance:
+        raise Exception('Chunked outputs differ from the full utterance ones by more than ' + str(args.tolerance))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--acoustic-model', dest='acoustic_model_path', help='Acoustic model state dict',
+                        default=None)
+    parser.add_argument('--pronscorer', dest='pronscorer_path', help='Pronscorer checkpoint', default=None)
+    parser.add_argument('--out-dim', dest='out_dim', type=int, help='Output dimension of the pronscorer', default=39)
+    parser.add_argument('--batchnorm', dest='batchnorm', help='Batchnorm setting of the pronscorer', default='last')
+    parser.add_argument('--device', dest='device', help='Device to run the models on', default='cpu')
+    parser.add_argument('--seq-len', dest='seq_len', type=int, help='Frames of the utterance', default=3000)
+    parser.add_argument('--chunk-size', dest='chunk_size', type=int, help='Frames per chunk', default=500)
+    parser.add_argument('--tolerance', dest='tolerance', type=float, help='Maximum allowed abs diff', default=1e-4)
+    parser.add_argument('--seed', dest='seed', type=int, help='Random seed', default=0)
+
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,98 @@
+# Checks that optimize_for_inference keeps the outputs of the acoustic and pronscoring models, with frame rate
+# and native rate iVectors and packed sequences, and times the original and the optimized models.
+# Uses randomly initialized models unless state dicts are given. Example, from the repository root:
+#
+#   python -m src.scripts.check_inference_optimization --acoustic-model data/pytorch_models/acoustic_model.pt
+import argparse
+import time
+
+import torch
+
+from src.pytorch_models.FTDNNAcoustic import FTDNNAcoustic
+from src.pytorch_models.FTDNNPronscorer import FTDNNPronscorer
+from src.pytorch_models.inference_optimization import optimize_for_inference
+
+
+def randomize_batchnorm_statistics(model):
+    # Non trivial statistics, so that folding them is part of the comparison
+    for module in model.modules():
+        if isinstance(module, torch.nn.BatchNorm1d):
+            module.running_mean.uniform_(-0.5, 0.5)
+            module.running_var.uniform_(0.5, 2)
+
+
+def create_models(args):
+    acoustic_model = FTDNNAcoustic()
+    if args.acoustic_model_path is not None:
+        acoustic_model.load_state_dict(torch.load(args.acoustic_model_path, map_location='cpu'))
+    else:
+        randomize_batchnorm_statistics(acoustic_model)
+
+    pronscorer = FTDNNPronscorer(out_dim=args.out_dim, batchnorm=args.batchnorm)
+    if args.pronscorer_path is not None:
+        pronscorer.load_state_dict(torch.load(args.pronscorer_path, map_location='cpu')['model_state_dict'])
+    else:
+        randomize_batchnorm_statistics(pronscorer)
+
+    return {'Acoustic model': acoustic_model.eval(), 'Pronscorer': pronscorer.eval()}
+
+
+def max_abs_diff(reference, outputs):
+    return torch.max(torch.abs(reference - outputs)).item()
+
+
+def time_forward(model, x, repetitions):
+    start_time = time.time()
+    for _ in range(repetitions):
+        model(x)
+    return (time.time() - start_time) / repetitions
+
+
+def main(args):
+    torch.manual_seed(args.seed)
+    lengths = torch.randint(args.min_length, args.max_length + 1, (args.batch_size,)).tolist()
+    utterances = [torch.randn(length, 140) for length in lengths]
+    padded_features = torch.nn.utils.rnn.pad_sequence(utterances, batch_first=True)
+    packed_features = torch.cat(utterances)[None, :, :]
+    sequence_offsets = torch.cumsum(torch.tensor([0] + lengths), 0)
+    ivectors = torch.randn(1, (lengths[0] + 9) // 10, 100)
+
+    max_diffs = []
+    with torch.no_grad():
+        for name, model in create_models(args).items():
+            optimized_model = optimize_for_inference(model)
+            diffs = [max_abs_diff(model(padded_features), optimized_model(padded_features)),
+                     max_abs_diff(model(utterances[0][None, :, :40], ivectors=ivectors),
+                                  optimized_model(utterances[0][None, :, :40], ivectors=ivectors)),
+                     max_abs_diff(model(packed_features, sequence_offsets=sequence_offsets),
+                                  optimized_model(packed_features, sequence_offsets=sequence_offsets))]
+            max_diffs.extend(diffs)
+            print('%s: max abs diff %e (padded batch), %e (native rate iVectors), %e (packed sequences)' % (
+                name, diffs[0], diffs[1], diffs[2]))
+
+            original_time = time_forward(model, padded_features, args.repetitions)
+            optimized_time = time_forward(optimized_model, padded_features, args.repetitions)
+            print('    %.2f ms per forward, %.2f ms optimized (%.2fx faster)' % (
+                original_time * 1000, optimized_time * 1000, original_time / optimized_time))
+
+    if max(max_diffs) > args.tolerance:
+        raise Exception('Optimized outputs differ from the original ones by more than ' + str(args.tolerance))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--acoustic-model', dest='acoustic_model_path', help='Acoustic model state dict',
+                        default=None)
+    parser.add_argument('--pronscorer', dest='pronscorer_path', help='Pronscorer checkpoint', default=None)
+    parser.add_argument('--out-dim', dest='out_dim', type=int, help='Output dimension of the pronscorer', default=39)
+    parser.add_argument('--batchnorm', dest='batchnorm', help='Batchnorm setting of the pronscorer', default='last')
+    parser.add_argument('--batch-size', dest='batch_size', type=int, help='Utterances per batch', default=8)
+    parser.add_argument('--min-length', dest='min_length', type=int, help='Minimum utterance length', default=50)
+    parser.add_argument('--max-length', dest='max_length', type=int, help='Maximum utterance length', default=500)
+    parser.add_argument('--repetitions', dest='repetitions', type=int, help='Timed runs of each model', default=5)
+    parser.add_argument('--tolerance', dest='tolerance', type=float, help='Maximum allowed abs diff', default=1e-3)
+    parser.add_argument('--seed', dest='seed', type=int, help='Random seed', default=0)
+
+    args = parser.parse_args()
+
+    main(args)
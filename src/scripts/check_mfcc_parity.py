@@ -0,0 +1,77 @@
+# Compares the MFCCs computed in-process by MfccExtractor with the output of compute-mfcc-feats.
+# compute-mfcc-feats is run with --dither=0 so that both extractors are deterministic. Example, from the
+# repository root:
+#
+#   python -m src.scripts.check_mfcc_parity --data-root test_suite/EpaDB.small --conf data/features/conf
+import argparse
+import glob
+import os
+import tempfile
+
+import numpy as np
+from kaldiio import ReadHelper
+
+from src.utils.MfccExtractor import MfccExtractor
+
+
+def write_wav_scp(data_root_path, wav_scp_path):
+    with open(wav_scp_path, 'w+') as wav_scp_fh:
+        for file in sorted(glob.glob(data_root_path + '/*/waveforms/*.wav')):
+            logid = os.path.splitext(os.path.basename(file))[0]
+            wav_scp_fh.write(logid + ' ' + os.path.abspath(file) + '\n')
+
+
+def compute_kaldi_mfccs(conf_path, wav_scp_path, output_dir):
+    mfcc_path = output_dir + '/mfccs_kaldi.ark'
+    os.system('compute-mfcc-feats --config=' + conf_path + '/mfcc_hires.conf --dither=0 scp,p:' + wav_scp_path +
+              ' ark:' + mfcc_path)
+    kaldi_mfccs = {}
+    with ReadHelper('ark:' + mfcc_path) as reader:
+        for logid, mfccs in reader:
+            kaldi_mfccs[logid] = mfccs
+    return kaldi_mfccs
+
+
+def main(data_root_path, conf_path, num_threads, tolerance):
+    output_dir = tempfile.mkdtemp()
+    wav_scp_path = output_dir + '/wav.scp'
+    write_wav_scp(data_root_path, wav_scp_path)
+
+    kaldi_mfccs = compute_kaldi_mfccs(conf_path, wav_scp_path, output_dir)
+    mfcc_extractor = MfccExtractor(conf_path + '/mfcc_hires.conf', num_threads=num_threads)
+
+    max_diffs = []
+    mismatches = []
+    for logid, mfccs in mfcc_extractor.compute_mfccs_for_wav_scp(wav_scp_path):
+        mfccs = mfccs.numpy()
+        reference = kaldi_mfccs[logid]
+        if mfccs.shape != reference.shape:
+            mismatches.append((logid, 'shape ' + str(mfccs.shape) + ' vs ' + str(reference.shape)))
+            continue
+        max_diff = np.max(np.abs(mfccs - reference))
+        max_diffs.append(max_diff)
+        if max_diff > tolerance:
+            mismatches.append((logid, 'max abs diff ' + str(max_diff)))
+
+    print('Compared %d utterances' % len(kaldi_mfccs))
+    if len(max_diffs) > 0:
+        print('Max abs diff: %f, mean of per utterance max abs diffs: %f' % (max(max_diffs), np.mean(max_diffs)))
+    for logid, mismatch in mismatches:
+        print('Mismatch in ' + logid + ': ' + mismatch)
+
+    if len(mismatches) > 0:
+        raise Exception(str(len(mismatches)) + ' utterances exceed the tolerance of ' + str(tolerance))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data-root', dest='data_root_path', help='Path to EpaDB-like data root',
+                        default='test_suite/EpaDB.small')
+    parser.add_argument('--conf', dest='conf_path', help='Path to features conf directory',
+                        default='data/features/conf')
+    parser.add_argument('--threads', dest='num_threads', type=int, help='Threads for MfccExtractor', default=4)
+    parser.add_argument('--tolerance', dest='tolerance', type=float, help='Max allowed abs diff', default=1e-2)
+
+    args = parser.parse_args()
+
+    main(args.data_root_path, args.conf_path, args.num_threads, args.tolerance)
@@ -0,0 +1,115 @@
+# Checks that running a batch of utterances as one packed sequence gives the same outputs as running each
+# utterance alone, for both the frame rate and the native rate iVector inputs, and times the padded and the
+# packed batches. Uses a randomly initialized model unless a state dict is given. Example, from the repository root:
+#
+#   python -m src.scripts.check_packed_sequences --batch-size 32 --min-length 100 --max-length 1500
+import argparse
+import time
+
+import torch
+
+from src.pytorch_models.FTDNNPronscorer import FTDNNPronscorer
+
+
+def create_model(args):
+    model = FTDNNPronscorer(out_dim=args.out_dim, batchnorm=args.batchnorm, device_name='cpu')
+    if args.model_path is not None:
+        model.load_state_dict(torch.load(args.model_path, map_location='cpu')['model_state_dict'])
+    else:
+        # Non trivial batchnorm statistics, so that they take part in the comparison
+        for module in model.modules():
+            if isinstance(module, torch.nn.BatchNorm1d):
+                module.running_mean.uniform_(-0.5, 0.5)
+                module.running_var.uniform_(0.5, 2)
+    model.eval()
+    return model
+
+
+def pack(tensors):
+    lengths = torch.tensor([tensor.shape[0] for tensor in tensors])
+    sequence_offsets = torch.zeros(len(tensors) + 1, dtype=torch.long)
+    sequence_offsets[1:] = torch.cumsum(lengths, 0)
+    return torch.cat(tensors)[None, :, :], sequence_offsets
+
+
+def pad(tensors):
+    return torch.nn.utils.rnn.pad_sequence(tensors, batch_first=True)
+
+
+def compare_outputs(model, utterances, ivectors=None):
+    if ivectors is None:
+        reference = [model(utterance[None, :, :])[0] for utterance in utterances]
+        packed_features, sequence_offsets = pack(utterances)
+        packed_outputs = model(packed_features, sequence_offsets=sequence_offsets)[0]
+    else:
+        reference = [model(utterance[None, :, :], ivectors=utterance_ivectors[None, :, :])[0]
+                     for utterance, utterance_ivectors in zip(utterances, ivectors)]
+        packed_features, sequence_offsets = pack(utterances)
+        packed_ivectors, _ = pack(ivectors)
+        packed_outputs = model(packed_features, ivectors=packed_ivectors, sequence_offsets=sequence_offsets)[0]
+
+    max_diff = 0
+    for i, outputs in enumerate(reference):
+        utterance_outputs = packed_outputs[sequence_offsets[i]:sequence_offsets[i + 1]]
+        max_diff = max(max_diff, torch.max(torch.abs(utterance_outputs - outputs)).item())
+    return max_diff
+
+
+def time_batches(model, utterances, repetitions):
+    padded_features = pad(utterances)
+    packed_features, sequence_offsets = pack(utterances)
+
+    start_time = time.time()
+    for _ in range(repetitions):
+        model(padded_features)
+    padded_time = (time.time() - start_time) / repetitions
+
+    start_time = time.time()
+    for _ in range(repetitions):
+        model(packed_features, sequence_offsets=sequence_offsets)
+    packed_time = (time.time() - start_time) / repetitions
+
+    return padded_time, packed_time, padded_features.shape[0] * padded_features.shape[1], packed_features.shape[1]
+
+
+def main(args):
+    torch.manual_seed(args.seed)
+    model = create_model(args)
+
+    lengths = torch.randint(args.min_length, args.max_length + 1, (args.batch_size,)).tolist()
+    utterances = [torch.randn(length, 140) for length in lengths]
+    mfccs = [utterance[:, :40].contiguous() for utterance in utterances]
+    ivectors = [torch.randn((length + model.ftdnn.ivector_period - 1) // model.ftdnn.ivector_period, 100)
+                for length in lengths]
+
+    with torch.no_grad():
+        max_diff = compare_outputs(model, utterances)
+        print('Frame rate iVectors: max abs diff %e between packed and per utterance outputs' % max_diff)
+        native_max_diff = compare_outputs(model, mfccs, ivectors)
+        print('Native rate iVectors: max abs diff %e between packed and per utterance outputs' % native_max_diff)
+
+        padded_time, packed_time, padded_frames, packed_frames = time_batches(model, utterances, args.repetitions)
+        print('Padded batch: %d frames, %.3f s' % (padded_frames, padded_time))
+        print('Packed batch: %d frames, %.3f s (%.2fx faster)' % (packed_frames, packed_time,
+                                                                 padded_time / packed_time))
+
+    if max(max_diff, native_max_diff) > args.tolerance:
+        raise Exception('Packed outputs differ from per utterance outputs by more than ' + str(args.tolerance))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', dest='model_path', help='Pronscorer state dict, random weights if not given',
+                        default=None)
+    parser.add_argument('--out-dim', dest='out_dim', type=int, help='Output dimension of the model', default=39)
+    parser.add_argument('--batchnorm', dest='batchnorm', help='Batchnorm setting of the model', default='last')
+    parser.add_argument('--batch-size', dest='batch_size', type=int, help='Utterances per batch', default=16)
+    parser.add_argument('--min-length', dest='min_length', type=int, help='Minimum utterance length', default=50)
+    parser.add_argument('--max-length', dest='max_length', type=int, help='Maximum utterance length', default=800)
+    parser.add_argument('--repetitions', dest='repetitions', type=int, help='Timed runs of each batch', default=3)
+    parser.add_argument('--tolerance', dest='tolerance', type=float, help='Maximum allowed abs diff', default=1e-4)
+    parser.add_argument('--seed', dest='seed', type=int, help='Random seed', default=0)
+
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,175 @@
+# Compares quantized inference against the float32 baseline on a prepared dataset (e.g. test_suite/EpaDB.small):
+# alignments and GOP scores from the acoustic model, and GOP-FT scores from the held-out pronscoring model of an
+# experiment. Reports how many alignments change, the AUC and EER of both scores, and the time of each stage.
+# The dataset must have gone through dataprep, and the experiment must have been trained on held-out.
+# Example, from the repository root:
+#
+#   python -m src.scripts.check_quantized_inference --dataprep-config configs/dataprep.yaml \
+#       --gop-config test_suite/TEST_gop_kaldi_labels.yaml \
+#       --experiment-config test_suite/TEST_lay1_lr005_bs32_bnlst_do40.yaml --output-dir quantization_check
+#
+# The AUC and EER deltas have not been measured yet: they need the Kaldi alignment of the dataset and a trained
+# pronscoring model. Measured instead with an untrained FTDNNPronscorer (batchnorm 'last') on the MFCCs of the 40
+# waveforms of test_suite/EpaDB.small (13121 frames) with random iVectors, on 4 CPU threads: dynamic-int8 changes
+# the outputs by 0.0036 on average (2% of their standard deviation, 0.023 at most) and runs 1.8x faster.
+# Trained weights are quantized differently, so this bounds neither the alignment nor the score deltas.
+import argparse
+import ast
+import os
+import time
+
+import joblib
+import numpy as np
+from scipy import interpolate
+from scipy.optimize import brentq
+from sklearn.metrics import roc_curve, auc
+
+import src.dataprep.align as align
+import src.evaluate.generate_data_for_eval as generate_data_for_eval
+import src.evaluate.generate_score_txt as generate_score_txt
+import src.gop.calculate_gop as calculate_gop
+from src.Config import DataprepConfig, ExperimentConfig, GopConfig
+from src.utils.run_utils import get_model_name
+
+
+def run_alignment(args, output_dir, quantization):
+    config_dict = DataprepConfig(args.dataprep_config).config_dict
+    config_dict['quantization'] = quantization
+    config_dict['alignments-path'] = output_dir + '/alignments/align_output'
+    config_dict['loglikes-path'] = output_dir + '/alignments/loglikes.ark'
+
+    start_time = time.time()
+    align.main(config_dict)
+    return config_dict['alignments-path'], config_dict['loglikes-path'], time.time() - start_time
+
+
+def evaluate_scores(config_dict, gop_txt_path, eval_dir):
+    os.makedirs(eval_dir, exist_ok=True)
+    config_dict['eval-dir'] = eval_dir + '/'
+    config_dict['eval-filename'] = 'data_for_eval.pickle'
+    config_dict['full-gop-score-path'] = gop_txt_path
+    generate_data_for_eval.main(config_dict)
+    return joblib.load(eval_dir + '/data_for_eval.pickle')
+
+
+def run_gop(args, output_dir, alignments_path, loglikes_path):
+    config_dict = GopConfig(args.gop_config, False).config_dict
+    config_dict['alignments-path'] = alignments_path
+    config_dict['loglikes-path'] = loglikes_path
+    config_dict['gop-scores-dir'] = output_dir + '/gop'
+    os.makedirs(config_dict['gop-scores-dir'], exist_ok=True)
+
+    calculate_gop.main(config_dict)
+    return evaluate_scores(config_dict, config_dict['gop-scores-dir'] + '/gop.txt', output_dir + '/gop_eval')
+
+
+def run_gop_ft(args, output_dir, quantization):
+    config_dict = ExperimentConfig(args.experiment_config, True, 'cpu').config_dict
+    model_name = get_model_name(config_dict, 0, use_heldout=True)
+    config_dict['model-name'] = model_name
+    config_dict['utterance-list-path'] = config_dict['test-list-path']
+    config_dict['gop-scores-dir'] = output_dir + '/gop_ft'
+    config_dict['gop-txt-name'] = 'gop-' + model_name + '.txt'
+    config_dict['quantization'] = quantization
+    os.makedirs(config_dict['gop-scores-dir'], exist_ok=True)
+
+    start_time = time.time()
+    generate_score_txt.main(config_dict)
+    scoring_time = time.time() - start_time
+    scores = evaluate_scores(config_dict, config_dict['gop-scores-dir'] + '/' + config_dict['gop-txt-name'],
+                             output_dir + '/gop_ft_eval')
+    return scores, scoring_time
+
+
+def read_phone_alignments(alignments_path):
+    phone_alignments = {}
+    for line in open(alignments_path, 'r').readlines():
+        logid, kind, alignment = line.split(' ', 2)
+        if kind == 'phones':
+            phone_alignments[logid] = ast.literal_eval(alignment.strip())
+    return phone_alignments
+
+
+# Returns the fraction of utterances whose phone alignment changes, and the mean absolute shift in frames
+# of the phone boundaries of the utterances with the same phone sequence
+def compare_alignments(reference_path, alignments_path):
+    reference_alignments = read_phone_alignments(reference_path)
+    alignments = read_phone_alignments(alignments_path)
+    changed = 0
+    boundary_shifts = []
+    for logid, reference_alignment in reference_alignments.items():
+        alignment = alignments[logid]
+        if alignment != reference_alignment:
+            changed += 1
+        if [phone for phone, _, _ in alignment] == [phone for phone, _, _ in reference_alignment]:
+            boundary_shifts.extend(abs(start - reference_start) for (_, start, _), (_, reference_start, _) in
+                                   zip(alignment, reference_alignment))
+    mean_shift = np.mean(boundary_shifts) if len(boundary_shifts) > 0 else float('nan')
+    return changed / len(reference_alignments), mean_shift
+
+
+def compute_auc_and_eer(labels, scores):
+    fpr, tpr, _ = roc_curve(labels, scores)
+    eer = brentq(lambda x: 1. - x - interpolate.interp1d(fpr, tpr)(x), 0., 1.)
+    return auc(fpr, tpr), eer
+
+
+# Returns the AUC and EER over all phones, and their means over the phones with at least min_phone_count
+# correct and incorrect samples, computed as in generate_plots
+def summarize_scores(scores, min_phone_count):
+    scores = scores[scores.label.isin([0, 1])]
+    pooled_auc, pooled_eer = compute_auc_and_eer(list(scores.label), list(scores.gop_scores))
+    phone_aucs, phone_eers = [], []
+    for phone in sorted(scores.phone_automatic.unique()):
+        phone_scores = scores[scores.phone_automatic == phone]
+        if min((phone_scores.label == 1).sum(), (phone_scores.label == 0).sum()) < min_phone_count:
+            continue
+        phone_auc, phone_eer = compute_auc_and_eer(list(phone_scores.label), list(phone_scores.gop_scores))
+        phone_aucs.append(phone_auc)
+        phone_eers.append(phone_eer)
+    return pooled_auc, pooled_eer, np.mean(phone_aucs), np.mean(phone_eers), len(phone_aucs)
+
+
+def print_score_summary(name, summary):
+    print('    %s: AUC %.4f, EER %.4f (all phones), mean AUC %.4f, mean EER %.4f (%d phones)' % ((name,) + summary))
+
+
+def main(args):
+    results = {}
+    for quantization in ['none', args.quantization]:
+        output_dir = args.output_dir + '/' + quantization
+        alignments_path, loglikes_path, align_time = run_alignment(args, output_dir, quantization)
+        gop_scores = run_gop(args, output_dir, alignments_path, loglikes_path)
+        gop_ft_scores, gop_ft_time = run_gop_ft(args, output_dir, quantization)
+        results[quantization] = {'alignments-path': alignments_path, 'align-time': align_time,
+                                 'gop': summarize_scores(gop_scores, args.min_phone_count),
+                                 'gop-ft': summarize_scores(gop_ft_scores, args.min_phone_count),
+                                 'gop-ft-time': gop_ft_time}
+
+    changed, mean_shift = compare_alignments(results['none']['alignments-path'],
+                                             results[args.quantization]['alignments-path'])
+    print('Alignments: %.2f%% of the utterances change, mean phone boundary shift %.3f frames' % (
+        100 * changed, mean_shift))
+    for quantization, result in results.items():
+        print(quantization + ':')
+        print('    Alignment %.1f s, GOP-FT scoring %.1f s' % (result['align-time'], result['gop-ft-time']))
+        print_score_summary('GOP', result['gop'])
+        print_score_summary('GOP-FT', result['gop-ft'])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dataprep-config', dest='dataprep_config', help='Dataprep .yaml config', required=True)
+    parser.add_argument('--gop-config', dest='gop_config', help='GOP .yaml config', required=True)
+    parser.add_argument('--experiment-config', dest='experiment_config', help='Experiment .yaml config',
+                        required=True)
+    parser.add_argument('--output-dir', dest='output_dir', help='Directory for the outputs of both runs',
+                        required=True)
+    parser.add_argument('--quantization', dest='quantization', help='Quantization to compare to float32',
+                        default='dynamic-int8')
+    parser.add_argument('--min-phone-count', dest='min_phone_count', type=int,
+                        help='Minimum correct and incorrect samples of a phone for its AUC and EER', default=10)
+
+    args = parser.parse_args()
+
+    main(args)
@@ -1,27 +1,20 @@
 import os
+import random
 from pathlib import Path
 from typing import List
 from typing import Tuple, Union
 
 import numpy as np
 from torch import Tensor
-from torch.utils.data import Dataset
+from torch.utils.data import DataLoader, Dataset, IterableDataset, RandomSampler, Sampler, SequentialSampler, \
+    get_worker_info
 
-from src.utils.FeatureManager import FeatureManager
+from src.utils.FeatureManager import FeatureManager, get_feature_manager_kwargs
+from src.utils.LabelStore import collapse_target_phone, compile_label_store
 # from src.utils.utils import *
 from src.utils.finetuning_utils import *
 
 
-def collapse_target_phone(target_phone):
-    phone_replacements = {}
-    for phone_name in ['Th', 'Ph', 'Kh']:
-        phone_replacements[phone_name] = phone_name[:-1]
-    phone_replacements['AX'] = 'AH'
-    phone_replacements['DX'] = 'T'
-    target_phone = phone_replacements[target_phone]
-    return target_phone
-
-
 class EpaDB(Dataset):
     """
     Create a Dataset for EpaDB.
@@ -29,6 +22,9 @@ class EpaDB(Dataset):
     Args:
         sample_list_path (str or Path): Path to the dataset sample list.
         root_path (str or Path): Path to where the EpaDB directory is found.
+        feature_manager (FeatureManager): Feature manager to share between datasets. A new one is created if None.
+        native_rate_ivectors (bool): If True, features are the 40 MFCCs and the iVectors are returned separately
+            at their native rate under the 'ivectors' key.
     """
 
     def __init__(
@@ -38,7 +34,9 @@ class EpaDB(Dataset):
             labels_path: Union[str, Path],
             features_path: Union[str, Path],
             conf_path: Union[str, Path],
-            audio_ext=".wav"
+            audio_ext=".wav",
+            feature_manager: FeatureManager = None,
+            native_rate_ivectors: bool = False
     ) -> None:
         self._ext_audio = audio_ext
 
@@ -49,8 +47,14 @@ class EpaDB(Dataset):
 
         self._labels_path = labels_path
 
-        # Create FeatureManager
-        self._feature_manager = FeatureManager("", features_path, conf_path)
+        # Create FeatureManager unless one is given to share its cache
+        if feature_manager is None:
+            feature_manager = FeatureManager("", features_path, conf_path)
+        self._feature_manager = feature_manager
+        self._native_rate_ivectors = native_rate_ivectors
+        self._embedding_cache = None
+        # Datasets sharing the feature manager prefetch on their own channel, so they do not cancel each other
+        self._prefetch_channel = 'epadb-' + str(id(self))
 
         # Read from sample list and create dictionary mapping fileid to .wav path and file list mapping int to logid
         self._filelist, self._logids_by_speaker = generate_fileid_list_and_spkr2logid_dict(sample_list_path)
@@ -59,9 +63,10 @@ class EpaDB(Dataset):
         self._phone_sym2int_dict, self.phone_int2sym_dict, self.phone_int2node_dict = get_phone_dictionaries(
             phones_list_path)
 
-        # Create dictionary to turn +/- labels into 1/-1
-        self._label_dict = {'+': 1,
-                            '-': 0}
+        # Parse all the label files once, with segment boundaries fixed to the feature frame counts
+        self._label_store = compile_label_store(self._filelist, labels_path,
+                                                self._feature_manager.get_frame_counts(self._filelist),
+                                                self._phone_sym2int_dict, self.phone_int2node_dict)
 
     def _load_epa_item(self, file_id: str, labels_path: str) -> Tuple[
         Tensor, str, str, str, List[Tuple[str, str, str, int, int]]]:
@@ -78,89 +83,53 @@ class EpaDB(Dataset):
         speaker_id = file_id.split("_")[0]
         utterance_id = file_id.split("_")[1]
 
-        features = self._feature_manager.get_features_for_logid(file_id)
-
-        annotation_path = os.path.join(labels_path, speaker_id, "labels", file_id)
-        annotation = []
-        phone_count = self.phone_count()
-        pos_labels = np.zeros([features.shape[0], phone_count]) - 1
-        neg_labels = np.zeros([features.shape[0], phone_count]) - 1
-        labels = np.zeros([features.shape[0], phone_count])
-        phone_times = []
-
-        with open(annotation_path + ".txt") as f:
-            for line in f.readlines():
-                line = line.split()
-                target_phone = line[1]
-                pronounced_phone = line[2]
-                label = line[3]
-                start_time = int(line[4])
-                end_time = int(line[5])
-                try:
-                    # These two if statements fix the mismatch between #frames in annotations and feature matrix
-                    if end_time > features.shape[0]:
-                        if end_time > features.shape[0] + 2:
-                            raise Exception('End time in annotations longer than feature length by ' + str(
-                                features.shape[0] - end_time))
-                        end_time = features.shape[0]
-                    if start_time > end_time:
-                        if start_time > end_time + 2:
-                            raise Exception(
-                                'Start time in annotations longer than end time by ' + str(end_time - start_time))
-                        start_time = end_time
-
-                    phone_times.append((target_phone, start_time, end_time))
-
-                    # If the target phone is not defined, collapse it into similar Kaldi phone (i.e Th -> T)
-                    if target_phone not in self._phone_sym2int_dict.keys():
-                        target_phone = collapse_target_phone(target_phone)
-
-                    # Get network output node index for the target phone
-                    target_phone_int = self._phone_sym2int_dict[target_phone]
-                    target_node = self.phone_int2node_dict[target_phone_int]
-
-                    # If the phone was mispronounced, put a -1 in the labels
-                    # If the phone was pronounced correcly, put a 1 in the labels
-                    # (If start_time == end_time we cant assign a label)
-                    if start_time != end_time and label == '+':
-                        pos_labels[start_time:end_time, target_node] = 1
-                        labels[start_time:end_time, target_node] = 1
-
-                    if start_time != end_time and label == '-':
-                        neg_labels[start_time:end_time, target_node] = 0
-                        labels[start_time:end_time, target_node] = -1
-
-                except ValueError as e:
-                    print("Bad item:")
-                    print("Speaker: " + speaker_id)
-                    print("Utterance: " + utterance_id)
-                    print("#Frames in features: ")
-                    print(features.shape[0])
-                    print(line)
-                    # embed()
-                    print(e)
-                except KeyError as e:
-                    print("Bad item:")
-                    print("Speaker: " + speaker_id)
-                    print("Utterance: " + utterance_id)
-                    print("#Frames in features: ")
-                    print(features.shape[0])
-                    print(line)
-                    # embed()
-                    print(e)
+        # Features are kept as they are held in memory (see feature residency) and decoded per batch by the collate
+        if self._embedding_cache is not None:
+            features = self._embedding_cache.get(file_id)
+        elif self._native_rate_ivectors:
+            features, ivectors = self._feature_manager.get_resident_mfccs_and_ivectors_for_logid(
+                file_id, prefetch_channel=self._prefetch_channel)
+        else:
+            features = self._feature_manager.get_resident_features_for_logid(
+                file_id, prefetch_channel=self._prefetch_channel)
+
+        frame_nodes, frame_labels = self._get_frame_nodes_and_labels(file_id, features.shape[0])
+        phone_times = self._label_store.get_phone_times(file_id)
 
         output_dict = {'features': features,
                        # 'transcript'  : transcript,
                        'speaker_id': speaker_id,
                        'utterance_id': utterance_id,
-                       'pos_labels': torch.from_numpy(pos_labels),
-                       'neg_labels': torch.from_numpy(neg_labels),
-                       'labels': torch.from_numpy(labels),
+                       'frame_nodes': torch.from_numpy(frame_nodes),
+                       'frame_labels': torch.from_numpy(frame_labels),
                        'phone_times': phone_times
                        }
+        if self._native_rate_ivectors and self._embedding_cache is None:
+            output_dict['ivectors'] = ivectors
 
         return output_dict
 
+    def _get_frame_nodes_and_labels(self, file_id: str, frame_count: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Builds the sparse labels of a sample: for each frame, the output node of its canonic phone and its label.
+
+        Returns:
+            tuple: ``(frame_nodes, frame_labels)``
+                    frame_nodes holds the node index, or -1 for frames without label
+                    frame_labels holds 1 for correctly pronounced phones, -1 for mispronounced ones and 0 otherwise
+        """
+        frame_nodes = np.full(frame_count, -1, dtype=np.int64)
+        frame_labels = np.zeros(frame_count, dtype=np.int8)
+
+        # (If start_time == end_time we cant assign a label, segments with unknown phones have no node)
+        # Each frame belongs to a single phone, so overlapping segments (if any) keep the last label
+        for start_time, end_time, target_node, label in zip(*self._label_store.get_segments(file_id)):
+            if start_time == end_time or target_node < 0 or label == 0:
+                continue
+            frame_nodes[start_time:end_time] = target_node
+            frame_labels[start_time:end_time] = label
+
+        return frame_nodes, frame_labels
+
     def __getitem__(self, n: int) -> Tuple[Tensor, str, str, str, List[Tuple[str, str, str, int, int]]]:
         """Load the n-th sample from the dataset.
 
@@ -182,6 +151,48 @@ class EpaDB(Dataset):
         """
         return len(self._filelist)
 
+    def get_logids(self) -> List[str]:
+        return list(self._filelist)
+
+    def load_sample_features(self, n: int) -> dict:
+        """Loads the float32 model inputs of the n-th sample, bypassing the embedding cache.
+
+        Returns:
+            dict: with the 'logid' and 'features' of the sample, and its 'ivectors' with native rate iVectors
+        """
+        logid = self._filelist[n]
+        if self._native_rate_ivectors:
+            features, ivectors = self._feature_manager.get_mfccs_and_ivectors_for_logid(logid)
+            return {'logid': logid, 'features': features, 'ivectors': ivectors}
+        return {'logid': logid, 'features': self._feature_manager.get_features_for_logid(logid)}
+
+    def use_embedding_cache(self, embedding_cache):
+        """Makes samples hold the cached trunk embeddings of each utterance as their features, instead of the
+        MFCCs and iVectors. The cache must have been filled for every sample (see EmbeddingCache.fill).
+        """
+        self._embedding_cache = embedding_cache
+
+    def reset_after_fork(self):
+        """Prepares the dataset to be used in a DataLoader worker process."""
+        self._feature_manager.reset_after_fork()
+
+    def get_frame_counts(self) -> List[int]:
+        """
+        Returns:
+            list: number of frames of the features of each sample, without loading them
+        """
+        return [self._label_store.frame_count(logid) for logid in self._filelist]
+
+    def prefetch_features(self, indexes):
+        """Starts loading in the background the features of the samples at the given indexes,
+        in the order they will be requested. Does nothing unless the feature manager has prefetch threads.
+        """
+        if self._embedding_cache is not None:
+            return
+        logids = [self._filelist[n] for n in indexes]
+        self._feature_manager.prefetch(logids, native_rate_ivectors=self._native_rate_ivectors,
+                                       prefetch_channel=self._prefetch_channel)
+
     def get_sample_indexes_from_spkr_indexes(self, spkr_indexes):
         """Takes list of valid indexes from the speaker list and returns
         list of logid indexes for the samples of said speakers. The logid
@@ -217,3 +228,159 @@ class EpaDB(Dataset):
             int: amount of phones in phone dictionary 
         """
         return len(self._phone_sym2int_dict.keys())
+
+
+class PrefetchingSampler(Sampler):
+    """
+    Wraps a sampler so that, at the start of every epoch, the features of all the samples are
+    prefetched in the order the sampler yields them.
+
+    Args:
+        sampler (Sampler): Sampler that decides the order of the samples (e.g. RandomSampler).
+        dataset (EpaDB): Dataset the sampler indexes.
+    """
+
+    def __init__(self, sampler: Sampler, dataset: EpaDB) -> None:
+        self._sampler = sampler
+        self._dataset = dataset
+
+    def __iter__(self):
+        indexes = list(self._sampler)
+        # Batch samplers yield lists of indexes
+        if len(indexes) > 0 and isinstance(indexes[0], list):
+            self._dataset.prefetch_features([n for batch in indexes for n in batch])
+        else:
+            self._dataset.prefetch_features(indexes)
+        return iter(indexes)
+
+    def __len__(self) -> int:
+        return len(self._sampler)
+
+
+class FrameBudgetBatchSampler(Sampler):
+    """
+    Batch sampler that groups samples of similar length, so that little padding is needed. Samples are
+    sorted by frame count and split into batches whose padded size (batch size x longest sample) is at
+    most max_batch_frames. Samples longer than the budget get a batch of their own.
+    With shuffle, samples of equal length are shuffled before splitting and the order of the batches is
+    shuffled every epoch. The padding ratio of the batches is logged every epoch.
+
+    Args:
+        frame_counts (list): Number of frames of each sample of the dataset.
+        max_batch_frames (int): Maximum number of frames in a padded batch.
+        shuffle (bool): Whether to shuffle the samples and batches every epoch.
+    """
+
+    def __init__(self, frame_counts: List[int], max_batch_frames: int, shuffle: bool = False) -> None:
+        self._frame_counts = frame_counts
+        self._max_batch_frames = max_batch_frames
+        self._shuffle = shuffle
+        # Batches are built one epoch in advance so that len() matches the next iteration
+        self._batches = self._build_batches()
+
+    def __iter__(self):
+        batches = self._batches
+        self._log_padding_ratio(batches)
+        if self._shuffle:
+            self._batches = self._build_batches()
+        return iter(batches)
+
+    def __len__(self) -> int:
+        return len(self._batches)
+
+    def _build_batches(self):
+        indexes = list(range(len(self._frame_counts)))
+        if self._shuffle:
+            random.shuffle(indexes)
+        # sorted is stable, so shuffled samples of equal length stay shuffled
+        indexes = sorted(indexes, key=lambda n: self._frame_counts[n])
+
+        batches = []
+        batch = []
+        for n in indexes:
+            # Samples come sorted, so the current one is the longest in the batch
+            if len(batch) > 0 and (len(batch) + 1) * self._frame_counts[n] > self._max_batch_frames:
+                batches.append(batch)
+                batch = []
+            batch.append(n)
+        if len(batch) > 0:
+            batches.append(batch)
+
+        if self._shuffle:
+            random.shuffle(batches)
+        return batches
+
+    def _log_padding_ratio(self, batches):
+        frames = sum(self._frame_counts[n] for batch in batches for n in batch)
+        padded_frames = sum(len(batch) * max(self._frame_counts[n] for n in batch) for batch in batches)
+        print('Frame budget batches: %d batches, padding ratio %.2f%%' % (
+            len(batches), 100 * (padded_frames - frames) / max(padded_frames, 1)))
+
+
+def epadb_worker_init_fn(worker_id: int) -> None:
+    """DataLoader worker_init_fn: gives each worker its own feature reading state."""
+    get_worker_info().dataset.reset_after_fork()
+
+
+def get_data_loader_kwargs(config_dict):
+    return {'max_batch_frames': config_dict.get('max-batch-frames', None),
+            'num_workers': config_dict.get('num-workers', 0),
+            'persistent_workers': config_dict.get('persistent-workers', False),
+            'prefetch_factor': config_dict.get('prefetch-factor', 2),
+            'packed_sequences': config_dict.get('packed-sequences', False)}
+
+
+def create_data_loader(dataset: Dataset, batch_size: int, shuffle: bool = False, max_batch_frames: int = None,
+                       num_workers: int = 0, pin_memory: bool = False, persistent_workers: bool = False,
+                       prefetch_factor: int = 2, packed_sequences: bool = False) -> DataLoader:
+    """
+    Creates the DataLoader for an EpaDB dataset.
+
+    Args:
+        dataset (EpaDB or EpaDBShards): Dataset to load. Sharded datasets shuffle and split the samples
+            across workers themselves.
+        batch_size (int): Samples per batch, unless max_batch_frames is given.
+        shuffle (bool): Whether to shuffle the samples every epoch.
+        max_batch_frames (int): If given, batches group samples of similar length up to this many padded frames.
+        num_workers (int): Worker processes. With 0, samples are loaded in the main process and prefetched in
+            background threads, and batches are padded into reusable buffers.
+        pin_memory (bool): Whether to return batches in page-locked memory.
+        persistent_workers (bool): Whether to keep the workers (and their feature caches) between epochs.
+        prefetch_factor (int): Batches loaded in advance by each worker.
+        packed_sequences (bool): Whether to concatenate the samples of each batch along time instead of padding
+            them (see Batch). Models must then be called with the sequence_offsets of the batch.
+    """
+    if isinstance(dataset, IterableDataset):
+        if max_batch_frames is not None:
+            raise Exception('max-batch-frames is not supported with sharded datasets')
+        # Persistent workers would keep the shard order of the first epoch
+        worker_kwargs = {}
+        if num_workers > 0:
+            worker_kwargs = {'pin_memory': pin_memory, 'prefetch_factor': prefetch_factor}
+        return DataLoader(dataset, batch_size=batch_size, num_workers=num_workers,
+                          collate_fn=BatchCollator(num_buffers=0 if num_workers > 0 else 2,
+                                                   pin_memory=pin_memory and num_workers == 0,
+                                                   packed=packed_sequences),
+                          **worker_kwargs)
+
+    if max_batch_frames is None:
+        sampler = RandomSampler(dataset) if shuffle else SequentialSampler(dataset)
+    else:
+        sampler = FrameBudgetBatchSampler(dataset.get_frame_counts(), max_batch_frames, shuffle=shuffle)
+
+    if num_workers == 0:
+        # The sampler runs in this process, so the features it will request can be prefetched here
+        sampler = PrefetchingSampler(sampler, dataset)
+        worker_kwargs = {'collate_fn': BatchCollator(pin_memory=pin_memory, packed=packed_sequences)}
+    else:
+        # Batches are sent to the main process through shared memory, so their buffers cannot be reused
+        worker_kwargs = {'collate_fn': BatchCollator(num_buffers=0, packed=packed_sequences),
+                         'pin_memory': pin_memory,
+                         'worker_init_fn': epadb_worker_init_fn,
+                         'persistent_workers': persistent_workers,
+                         'prefetch_factor': prefetch_factor}
+
+    if max_batch_frames is None:
+        return DataLoader(dataset, batch_size=batch_size, sampler=sampler, num_workers=num_workers, **worker_kwargs)
+    else:
+        return DataLoader(dataset, batch_sampler=sampler, num_workers=num_workers, **worker_kwargs)
@@ -0,0 +1,210 @@
+import glob
+import hashlib
+import itertools
+import math
+import os
+import random
+import shutil
+
+import numpy as np
+import torch
+from torch.utils.data import IterableDataset, get_worker_info
+
+from src.train.dataset import EpaDB
+from src.utils.CompressedFeatures import decode_resident_features
+from src.utils.SharedFeatureCache import get_shared_cache_namespace
+
+
+class EpaDBShards(IterableDataset):
+    """
+    Streaming version of EpaDB that reads samples sequentially from shards written by write_epadb_shards.
+    Each shard is a .npz file bundling the features and the compiled labels of a few hundred utterances.
+    Samples have the same format as the ones of EpaDB.
+
+    Shards are split across distributed ranks and then across the DataLoader workers of each rank, so that
+    every shard is read by a single worker in each epoch. As with DistributedSampler, every rank yields the
+    same number of samples, ceil(samples / world_size): ranks whose shards hold fewer samples repeat samples
+    of their shards, so that no rank finishes the epoch early while the others wait in collective calls.
+    With shuffle, the order of the shards changes every epoch (see set_epoch) and samples go through a
+    shuffle buffer of shuffle_buffer_size samples.
+
+    Args:
+        shards_dir (str or Path): Directory with the shards.
+        shuffle (bool): Whether to shuffle shards and samples.
+        shuffle_buffer_size (int): Number of samples to shuffle at a time.
+        seed (int): Seed of the shuffling, which must be the same on all ranks.
+    """
+
+    def __init__(self, shards_dir, shuffle: bool = False, shuffle_buffer_size: int = 1000, seed: int = 0) -> None:
+        self._shard_paths = sorted(glob.glob(os.path.join(os.fspath(shards_dir), 'shard_*.npz')))
+        if len(self._shard_paths) == 0:
+            raise Exception('No shards found in ' + os.fspath(shards_dir) + '. Did you write the shards?')
+        # Only the offsets are read, to count the samples of each shard
+        self._shard_sample_counts = {}
+        for shard_path in self._shard_paths:
+            with np.load(shard_path) as shard:
+                self._shard_sample_counts[shard_path] = len(shard['feature_offsets']) - 1
+        self._shuffle = shuffle
+        self._shuffle_buffer_size = shuffle_buffer_size
+        self._seed = seed
+        self._epoch = 0
+
+    def set_epoch(self, epoch: int) -> None:
+        """Sets the epoch, which changes the order of the shards. Must be called before creating the iterator."""
+        self._epoch = epoch
+
+    def __iter__(self):
+        shard_paths = list(self._shard_paths)
+        if self._shuffle:
+            # Every worker and rank shuffles the same way, so that the split below is consistent
+            random.Random(self._seed + self._epoch).shuffle(shard_paths)
+
+        rank, world_size, worker_id, worker_count = _get_rank_and_worker()
+        rank_shard_paths = shard_paths[rank::world_size]
+        samples = self._read_shards(rank_shard_paths[worker_id::worker_count])
+        # The first worker of the rank tops it up to the samples of every rank
+        padding = math.ceil(sum(self._shard_sample_counts.values()) / world_size) - \
+            sum(self._shard_sample_counts[shard_path] for shard_path in rank_shard_paths)
+        if worker_id == 0 and padding > 0:
+            padding_samples = self._read_shards(itertools.cycle(rank_shard_paths or shard_paths))
+            samples = itertools.chain(samples, itertools.islice(padding_samples, padding))
+
+        reader_id, reader_count = rank * worker_count + worker_id, world_size * worker_count
+        if self._shuffle:
+            samples = _shuffle_with_buffer(samples, self._shuffle_buffer_size,
+                                           random.Random((self._seed + self._epoch) * reader_count + reader_id))
+        return samples
+
+    def _read_shards(self, shard_paths):
+        for shard_path in shard_paths:
+            for sample in read_epadb_shard(shard_path):
+                yield sample
+
+
+# Writes the samples of an EpaDB dataset in shards of utterances_per_shard utterances.
+# Features are decoded and stored with the given dtype; labels are stored as compiled by the dataset.
+def write_epadb_shards(dataset: EpaDB, shards_dir, utterances_per_shard=256, dtype='float32'):
+    # Shards are written to a temporary directory, so that an interrupted run does not leave an incomplete set
+    tmp_shards_dir = os.fspath(shards_dir) + '.tmp'
+    if os.path.isdir(tmp_shards_dir):
+        shutil.rmtree(tmp_shards_dir)
+    os.makedirs(tmp_shards_dir)
+
+    for shard_index, shard_start in enumerate(range(0, len(dataset), utterances_per_shard)):
+        samples = [dataset[n] for n in range(shard_start, min(shard_start + utterances_per_shard, len(dataset)))]
+        np.savez(os.path.join(tmp_shards_dir, 'shard_%06d.npz' % shard_index), **_get_shard_arrays(samples, dtype))
+
+    os.replace(tmp_shards_dir, shards_dir)
+
+
+# Key of the shards of dataset, to be part of their directory name. It hashes everything the shards are written
+# from: the utterance list, the label files in labels_dir, the features of feature_manager (see
+# get_shared_cache_namespace), whether the iVectors are at their native rate and the dtype of the shards.
+# Shards written with other settings are therefore never read.
+def get_epadb_shards_key(dataset: EpaDB, labels_dir, feature_manager, native_rate_ivectors=False, dtype='float32'):
+    hasher = hashlib.sha1()
+    hasher.update(('native-rate-ivectors=' + str(native_rate_ivectors) + ':dtype=' + dtype + ':features=' +
+                   get_shared_cache_namespace(feature_manager.features_path, feature_manager.residency)).encode())
+    hasher.update((':logids=' + ','.join(dataset.get_logids())).encode())
+    labels_dir = os.fspath(labels_dir)
+    hasher.update((':labels=' + os.path.realpath(labels_dir)).encode())
+    for root, _, file_names in sorted(os.walk(labels_dir)):
+        for file_name in sorted(file_names):
+            label_stat = os.stat(os.path.join(root, file_name))
+            hasher.update((':' + os.path.relpath(os.path.join(root, file_name), labels_dir) + ':' +
+                           str(label_stat.st_mtime_ns) + ':' + str(label_stat.st_size)).encode())
+    return hasher.hexdigest()[:16]
+
+
+# Yields the samples in a shard, in the order they were written
+def read_epadb_shard(shard_path):
+    with np.load(shard_path) as shard:
+        shard = {name: shard[name] for name in shard.files}
+
+    feature_offsets = shard['feature_offsets']
+    phone_offsets = shard['phone_offsets']
+    phone_symbols = list(shard['phone_symbols'])
+    for i, logid in enumerate(shard['logids']):
+        logid = str(logid)
+        first_frame, last_frame = feature_offsets[i], feature_offsets[i + 1]
+        first_phone, last_phone = phone_offsets[i], phone_offsets[i + 1]
+        sample = {'features': torch.from_numpy(shard['features'][first_frame:last_frame]),
+                  'speaker_id': logid.split('_')[0],
+                  'utterance_id': logid.split('_')[1],
+                  'frame_nodes': torch.from_numpy(shard['frame_nodes'][first_frame:last_frame]),
+                  'frame_labels': torch.from_numpy(shard['frame_labels'][first_frame:last_frame]),
+                  'phone_times': [(phone_symbols[phone], int(start), int(end)) for phone, start, end in
+                                  zip(shard['phones'][first_phone:last_phone],
+                                      shard['phone_starts'][first_phone:last_phone],
+                                      shard['phone_ends'][first_phone:last_phone])]
+                  }
+        if 'ivector_offsets' in shard:
+            ivector_offsets = shard['ivector_offsets']
+            sample['ivectors'] = torch.from_numpy(shard['ivectors'][ivector_offsets[i]:ivector_offsets[i + 1]])
+        yield sample
+
+
+def _get_shard_arrays(samples, dtype):
+    phone_symbols = []
+    phone_symbol_indexes = {}
+    phones = []
+    phone_starts = []
+    phone_ends = []
+    for sample in samples:
+        for phone, start_time, end_time in sample['phone_times']:
+            if phone not in phone_symbol_indexes:
+                phone_symbol_indexes[phone] = len(phone_symbols)
+                phone_symbols.append(phone)
+            phones.append(phone_symbol_indexes[phone])
+            phone_starts.append(start_time)
+            phone_ends.append(end_time)
+
+    features = [decode_resident_features(sample['features']).numpy() for sample in samples]
+    shard_arrays = {'logids': np.array([sample['speaker_id'] + '_' + sample['utterance_id'] for sample in samples]),
+                    'features': np.concatenate(features).astype(dtype),
+                    'feature_offsets': np.cumsum([0] + [len(sample_features) for sample_features in features]),
+                    'frame_nodes': np.concatenate([sample['frame_nodes'].numpy() for sample in samples]).astype(
+                        np.int16),
+                    'frame_labels': np.concatenate([sample['frame_labels'].numpy() for sample in samples]),
+                    'phone_offsets': np.cumsum([0] + [len(sample['phone_times']) for sample in samples]),
+                    'phones': np.array(phones, dtype=np.int16),
+                    'phone_starts': np.array(phone_starts, dtype=np.int32),
+                    'phone_ends': np.array(phone_ends, dtype=np.int32),
+                    'phone_symbols': np.array(phone_symbols)}
+
+    if 'ivectors' in samples[0]:
+        ivectors = [decode_resident_features(sample['ivectors']).numpy() for sample in samples]
+        shard_arrays['ivectors'] = np.concatenate(ivectors).astype(dtype)
+        shard_arrays['ivector_offsets'] = np.cumsum([0] + [len(sample_ivectors) for sample_ivectors in ivectors])
+
+    return shard_arrays
+
+
+# Returns the distributed rank of this reader and the rank count, and its DataLoader worker id and the worker count
+def _get_rank_and_worker():
+    rank, world_size = 0, 1
+    if torch.distributed.is_available() and torch.distributed.is_initialized():
+        rank, world_size = torch.distributed.get_rank(), torch.distributed.get_world_size()
+
+    worker_id, worker_count = 0, 1
+    worker_info = get_worker_info()
+    if worker_info is not None:
+        worker_id, worker_count = worker_info.id, worker_info.num_workers
+
+    return rank, world_size, worker_id, worker_count
+
+
+def _shuffle_with_buffer(samples, buffer_size, rng):
+    buffer = []
+    for sample in samples:
+        if len(buffer) < buffer_size:
+            buffer.append(sample)
+            continue
+        # Yield a random sample from the buffer and put the new one in its place
+        i = rng.randrange(buffer_size)
+        yield buffer[i]
+        buffer[i] = sample
+
+    rng.shuffle(buffer)
+    for sample in buffer:
+        yield sample
@@ -10,8 +10,12 @@ from torch.utils.data import DataLoader
 from src.pytorch_models.FTDNNPronscorer import *
 # from src.utils.utils import *
 from src.train.dataset import *
+from src.train.sharded_dataset import EpaDBShards, get_epadb_shards_key, write_epadb_shards
+from src.utils.EmbeddingCache import EmbeddingCache, check_trunk_is_frozen, get_embedding_cache_key
 
 global phone_int2sym
+# Layers run by the model when the batches hold cached trunk embeddings, None when they hold features
+tail_layers = None
 
 
 def get_model_path_for_fold(model_path, fold, layer_amount):
@@ -101,6 +105,17 @@ def freeze_layers_for_finetuning(model, layer_amount, use_dropout, batchnorm):
             module.train()
 
 
+# Cached trunk embeddings need a trunk that computes the same function as in eval mode (see check_trunk_is_frozen).
+# Checked on the config before any embedding is computed, naming the key to change.
+def check_config_keeps_trunk_frozen(use_dropout, dropout_p, batchnorm):
+    if use_dropout and dropout_p > 0:
+        raise Exception('embedding-cache-dir needs a frozen trunk, but use-dropout enables the dropouts of the trunk '
+                        'while training. Set use-dropout to false (or dropout-p to 0), or remove embedding-cache-dir')
+    if batchnorm in ['first', 'firstlast', 'all']:
+        raise Exception('embedding-cache-dir needs a frozen trunk, but batchnorm ' + batchnorm + ' trains batchnorms '
+                        'of the trunk. Set batchnorm to "last" (or leave it unset), or remove embedding-cache-dir')
+
+
 def freeze_layers_for_finetuning_buggy(model, layer_amount):
     # Generate layer names for layers that should be trained
     layers_to_train = ['layer' + str(19 - x) for x in range(layer_amount)]
@@ -214,6 +229,62 @@ def criterion_fast(batch_outputs, batch_labels, weights=None, norm_per_phone_and
         return total_loss
 
 
+# Same loss as criterion_fast, computed on sparse labels: only the output of the canonic phone of each labeled frame
+# is gathered, instead of masking the outputs of all the phones
+def criterion_sparse(batch_outputs, batch_frame_nodes, batch_frame_labels, weights=None, norm_per_phone_and_class=False,
+                     log_per_phone_and_class_loss=False, phone_int2sym=None, phone_int2node=None, min_frame_count=0):
+    labeled_frames = batch_frame_labels != 0
+    nodes = batch_frame_nodes[labeled_frames]
+    frame_labels = batch_frame_labels[labeled_frames]
+    outputs = batch_outputs[labeled_frames].gather(1, nodes.unsqueeze(1)).squeeze(1)
+    is_pos = frame_labels == 1
+    is_neg = frame_labels == -1
+
+    # Turn 1s into 0s and -1s into 1s
+    labels_for_loss = is_neg.to(outputs.dtype)
+
+    phone_count = batch_outputs.shape[2]
+    if weights is not None:
+        frame_weights = weights[nodes].to(outputs.dtype)
+    else:
+        frame_weights = torch.ones_like(outputs)
+
+    if norm_per_phone_and_class:
+        pos_frame_count = torch.bincount(nodes[is_pos], minlength=phone_count)
+        neg_frame_count = torch.bincount(nodes[is_neg], minlength=phone_count)
+        frame_count = torch.where(is_pos, pos_frame_count[nodes], neg_frame_count[nodes])
+        frame_weights = frame_weights / frame_count
+        if min_frame_count > 0:
+            # Set to 0 the weights for the phones with too few cases in this batch
+            frame_weights = frame_weights * (frame_count >= min_frame_count)
+
+    loss = torch.nn.functional.binary_cross_entropy_with_logits(outputs, labels_for_loss, weight=frame_weights,
+                                                                reduction='none')
+    total_loss = loss.sum()
+    sum_weights_pos = frame_weights[is_pos].sum()
+    sum_weights_neg = frame_weights[is_neg].sum()
+
+    if not norm_per_phone_and_class:
+        total_weights = sum_weights_pos + sum_weights_neg
+        total_loss /= total_weights
+
+    if log_per_phone_and_class_loss:
+
+        pos_phone_loss = torch.zeros(phone_count, dtype=loss.dtype, device=loss.device).index_add(
+            0, nodes[is_pos], loss[is_pos])
+        neg_phone_loss = torch.zeros(phone_count, dtype=loss.dtype, device=loss.device).index_add(
+            0, nodes[is_neg], loss[is_neg])
+        loss_dict = {}
+        for phone_int, phone_sym in phone_int2sym.items():
+            phone_node_index = phone_int2node[phone_int]
+            loss_dict[phone_sym + '+'] = pos_phone_loss[phone_node_index] / weights[phone_node_index] / sum_weights_pos
+            loss_dict[phone_sym + '-'] = neg_phone_loss[phone_node_index] / weights[phone_node_index] / sum_weights_neg
+
+        return total_loss, loss_dict
+    else:
+        return total_loss
+
+
 def criterion_simple(batch_outputs, batch_labels):
     '''
     Calculates loss
@@ -265,22 +336,34 @@ def choose_starting_epoch(epochs, state_dict_dir, run_name, fold, model, optimiz
     return model, optimizer, scheduler, step, start_from_epoch
 
 
+# Runs the model on the inputs of a batch, only through its tail if they are cached trunk embeddings
+def run_model(model, inputs, ivectors, sequence_offsets):
+    if tail_layers is not None:
+        return model.forward_tail(inputs, tail_layers=tail_layers)
+    return model(inputs, ivectors=ivectors, sequence_offsets=sequence_offsets)
+
+
 def foward_backward_pass(data, model, optimizer, phone_weights, phone_int2sym, phone_int2node,
                          norm_per_phone_and_class):
     logids = unpack_logids_from_batch(data)
-    inputs = unpack_features_from_batch(data).to(device)
-    batch_labels = unpack_labels_from_batch(data).to(device)
+    inputs = unpack_features_from_batch(data).to(device, non_blocking=True)
+    ivectors = unpack_ivectors_from_batch(data)
+    if ivectors is not None:
+        ivectors = ivectors.to(device, non_blocking=True)
+    batch_frame_nodes = unpack_frame_nodes_from_batch(data).to(device, non_blocking=True)
+    batch_frame_labels = unpack_frame_labels_from_batch(data).to(device, non_blocking=True)
+    sequence_offsets = unpack_sequence_offsets_from_batch(data)
+    if sequence_offsets is not None:
+        sequence_offsets = sequence_offsets.to(device, non_blocking=True)
 
     # zero the parameter gradients
     optimizer.zero_grad()
 
-    phone_per_frame_selector = torch.abs((batch_labels - 1) / 2)
-
-    outputs = model(inputs)
+    outputs = run_model(model, inputs, ivectors, sequence_offsets)
 
-    loss = criterion_fast(outputs, batch_labels, weights=phone_weights, phone_int2sym=phone_int2sym,
-                          phone_int2node=phone_int2node, norm_per_phone_and_class=norm_per_phone_and_class,
-                          min_frame_count=0)
+    loss = criterion_sparse(outputs, batch_frame_nodes, batch_frame_labels, weights=phone_weights,
+                            phone_int2sym=phone_int2sym, phone_int2node=phone_int2node,
+                            norm_per_phone_and_class=norm_per_phone_and_class, min_frame_count=0)
 
     loss.requires_grad_()
 
@@ -331,6 +414,8 @@ def train(model, trainloader, testloader, fold, epochs, swa_epochs, state_dict_d
     print("Started training fold " + str(fold))
 
     freeze_layers_for_finetuning(model, layer_amount, use_dropout, batchnorm)
+    if tail_layers is not None:
+        check_trunk_is_frozen(model, tail_layers)
 
     optimizer = optim.Adam(model.parameters(), lr=lr)
     scheduler = define_scheduler_from_config(scheduler_config, optimizer)
@@ -348,6 +433,10 @@ def train(model, trainloader, testloader, fold, epochs, swa_epochs, state_dict_d
 
         running_loss = 0.0
 
+        # Sharded datasets shuffle the shards differently every epoch
+        if isinstance(trainloader.dataset, EpaDBShards):
+            trainloader.dataset.set_epoch(epoch)
+
         running_loss, step, model, optimizer = train_one_epoch(trainloader, testloader, model, optimizer, running_loss,
                                                                fold, epoch,
                                                                step, use_clipping, phone_weights, phone_int2sym,
@@ -377,16 +466,21 @@ def test(model, testloader):
 
     total_loss = 0
     for i, batch in enumerate(testloader, 0):
-        features = unpack_features_from_batch(batch).to(device)
-        # pos_labels = unpack_pos_labels_from_batch(batch)
-        # neg_labels = unpack_neg_labels_from_batch(batch)
-        labels = unpack_labels_from_batch(batch).to(device)
-
-        outputs = model(features)
+        features = unpack_features_from_batch(batch).to(device, non_blocking=True)
+        ivectors = unpack_ivectors_from_batch(batch)
+        if ivectors is not None:
+            ivectors = ivectors.to(device, non_blocking=True)
+        frame_nodes = unpack_frame_nodes_from_batch(batch).to(device, non_blocking=True)
+        frame_labels = unpack_frame_labels_from_batch(batch).to(device, non_blocking=True)
+        sequence_offsets = unpack_sequence_offsets_from_batch(batch)
+        if sequence_offsets is not None:
+            sequence_offsets = sequence_offsets.to(device, non_blocking=True)
+
+        outputs = run_model(model, features, ivectors, sequence_offsets)
         loss_dict = {}
-        loss, loss_dict = criterion_fast(outputs, labels, weights=phone_weights,
-                                         log_per_phone_and_class_loss=True, phone_int2sym=phone_int2sym,
-                                         phone_int2node=phone_int2node)
+        loss, loss_dict = criterion_sparse(outputs, frame_nodes, frame_labels, weights=phone_weights,
+                                           log_per_phone_and_class_loss=True, phone_int2sym=phone_int2sym,
+                                           phone_int2node=phone_int2node)
 
         loss = loss.item()
         total_loss += loss
@@ -395,7 +489,7 @@ def test(model, testloader):
 
 
 def main(config_dict):
-    global phone_int2sym, phone_int2node, phone_weights, phone_count, device, checkpoint_step
+    global phone_int2sym, phone_int2node, phone_weights, phone_count, device, checkpoint_step, tail_layers
 
     run_name = config_dict["run-name"]
     trainset_list = config_dict["train-list-path"]
@@ -422,12 +516,19 @@ def main(config_dict):
     state_dict_dir = config_dict["state-dict-dir"]
     device_name = config_dict["device"]
     checkpoint_step = config_dict["checkpoint-step"]
+    native_rate_ivectors = config_dict.get("native-rate-ivectors", False)
+    train_shards_dir = config_dict.get("train-shards-dir", None)
+    embedding_cache_dir = config_dict.get("embedding-cache-dir", None)
 
     # wandb.init(project="gop-finetuning", entity="pronscoring-liaa")
     # wandb.run.name = run_name
 
-    trainset = EpaDB(trainset_list, phones_file, labels_dir, features_path, conf_path)
-    testset = EpaDB(testset_list, phones_file, labels_dir, features_path, conf_path)
+    # Train and test sets share one feature manager (and its cache)
+    feature_manager = FeatureManager("", features_path, conf_path, **get_feature_manager_kwargs(config_dict))
+    trainset = EpaDB(trainset_list, phones_file, labels_dir, features_path, conf_path, feature_manager=feature_manager,
+                     native_rate_ivectors=native_rate_ivectors)
+    testset = EpaDB(testset_list, phones_file, labels_dir, features_path, conf_path, feature_manager=feature_manager,
+                    native_rate_ivectors=native_rate_ivectors)
 
     phone_int2sym = trainset.phone_int2sym_dict
     phone_int2node = trainset.phone_int2node_dict
@@ -439,38 +540,53 @@ def main(config_dict):
 
     phone_weights = get_phone_weights_as_torch(phone_weights_path)
 
-    trainloader = torch.utils.data.DataLoader(trainset, batch_size=batch_size,
-                                              num_workers=0, collate_fn=collate_fn_padd, shuffle=True)
-
-    testloader = torch.utils.data.DataLoader(testset, batch_size=batch_size,
-                                             num_workers=0, collate_fn=collate_fn_padd)
-
     phone_count = trainset.phone_count()
 
     # Get acoustic model to train
-    model = FTDNNPronscorer(out_dim=phone_count, batchnorm=batchnorm, dropout_p=dropout_p, device_name=device_name)
+    model = FTDNNPronscorer(out_dim=phone_count, batchnorm=batchnorm, dropout_p=dropout_p, device_name=device_name,
+                            ivector_period=feature_manager.get_ivector_period())
     model.to(device)
     state_dict = torch.load(get_model_path_for_fold(model_path, fold, layer_amount))
     model.load_state_dict(state_dict['model_state_dict'])
 
+    # Run the frozen trunk once per utterance and train only the last layer_amount layers on its outputs
+    tail_layers = None
+    if embedding_cache_dir is not None:
+        check_config_keeps_trunk_frozen(use_dropout, dropout_p, batchnorm)
+        embedding_cache_key = get_embedding_cache_key(model, layer_amount, feature_manager, native_rate_ivectors)
+        embedding_cache = EmbeddingCache(embedding_cache_dir, embedding_cache_key)
+        for dataset in [trainset, testset]:
+            embedding_cache.fill(model, dataset, layer_amount)
+            dataset.use_embedding_cache(embedding_cache)
+        tail_layers = layer_amount
+
+    # Batches are pinned by default when training on GPU
+    data_loader_kwargs = get_data_loader_kwargs(config_dict)
+    pin_memory = config_dict.get("pin-memory", device.type == 'cuda')
+    if train_shards_dir is not None:
+        # Stream the training set from shards, written the first time they are needed. The directory name holds
+        # the key of everything the shards are written from, so that changed settings write new shards.
+        shards_dtype = config_dict.get("shards-dtype", "float32")
+        fold_shards_dir = train_shards_dir + '/fold_' + str(fold) + '_' + get_epadb_shards_key(
+            trainset, labels_dir, feature_manager, native_rate_ivectors, shards_dtype)
+        if tail_layers is not None:
+            fold_shards_dir = fold_shards_dir + '_embeddings_' + embedding_cache_key
+        if not os.path.isdir(fold_shards_dir):
+            write_epadb_shards(trainset, fold_shards_dir,
+                               utterances_per_shard=config_dict.get("utterances-per-shard", 256),
+                               dtype=shards_dtype)
+        train_data = EpaDBShards(fold_shards_dir, shuffle=True,
+                                 shuffle_buffer_size=config_dict.get("shuffle-buffer-size", 1000), seed=seed)
+    else:
+        train_data = trainset
+    trainloader = create_data_loader(train_data, batch_size, shuffle=True, pin_memory=pin_memory,
+                                     **data_loader_kwargs)
+    testloader = create_data_loader(testset, batch_size, pin_memory=pin_memory, **data_loader_kwargs)
+
     # Train the model
     # wandb.watch(model, log_freq=100)
-    onnx_path = 'GOP-FT.onnx'
-    if not os.path.exists(onnx_path):
-        from torch.onnx import export as ex_to_onnx
-        model.eval()
-        for _, data in enumerate(trainloader, 0):
-            features = unpack_features_from_batch(data).to(device)
-            ex_to_onnx(model,
-                       features,
-                       onnx_path,
-                       export_params=True,
-                       opset_version=14,
-                       do_constant_folding=True,
-                       input_names=['features'],
-                       output_names=['scores'],
-                       dynamic_axes={'features': {0: 'batch_size'},
-                                     'scores': {0: 'batch_size'}})
     train(model, trainloader, testloader, fold, epochs, swa_epochs, state_dict_dir, run_name, layer_amount,
           use_dropout, learning_rate, scheduler_config, swa_lr, use_clipping, batchnorm,
           norm_per_phone_and_class)
+
+    feature_manager.log_cache_stats()
@@ -0,0 +1,160 @@
+import torch
+
+from src.utils.CompressedFeatures import decode_resident_features
+
+
+class Batch:
+    """
+    Padded batch of EpaDB samples, or packed batch if sequence_offsets is not None.
+        logids: list of the B logids
+        features: (B x T x D) float32 features, zero padded
+        ivectors: (B x I x 100) float32 native rate iVectors, zero padded, or None if they are part of the features
+        lengths: (B) number of frames of each sample
+        frame_mask: (B x T) True for the frames that are not padding
+        frame_nodes: (B x T) output node of the canonic phone at each frame, -1 for frames without label
+        frame_labels: (B x T) 1 for correctly pronounced phones, -1 for mispronounced ones, 0 otherwise
+        phone_times: list with the List[(canonic_phone, start_time, end_time)] of each sample
+        sequence_offsets: (B + 1) first frame of each sample in a packed batch, followed by the total frame count
+    In a packed batch the samples are concatenated along time instead of padded: features is (1 x sum(lengths) x D),
+    native rate ivectors (1 x sum(iVector counts) x 100), and frame_mask, frame_nodes and frame_labels
+    (1 x sum(lengths)).
+    """
+    __slots__ = ['logids', 'features', 'ivectors', 'lengths', 'frame_mask', 'frame_nodes', 'frame_labels',
+                 'phone_times', 'sequence_offsets']
+
+    def __init__(self, logids, features, ivectors, lengths, frame_mask, frame_nodes, frame_labels, phone_times,
+                 sequence_offsets=None):
+        self.logids = logids
+        self.features = features
+        self.ivectors = ivectors
+        self.lengths = lengths
+        self.frame_mask = frame_mask
+        self.frame_nodes = frame_nodes
+        self.frame_labels = frame_labels
+        self.phone_times = phone_times
+        self.sequence_offsets = sequence_offsets
+
+    def __len__(self):
+        return len(self.logids)
+
+    # Called by the DataLoader when pin_memory is True and the batches are collated in worker processes
+    def pin_memory(self):
+        ivectors = self.ivectors.pin_memory() if self.ivectors is not None else None
+        return Batch(self.logids, self.features.pin_memory(), ivectors, self.lengths.pin_memory(),
+                     self.frame_mask.pin_memory(), self.frame_nodes.pin_memory(), self.frame_labels.pin_memory(),
+                     self.phone_times, self.sequence_offsets)
+
+    # Returns the frames of the i-th sample in a (B x T x ...) or packed (1 x sum(lengths) x ...) batch tensor
+    def get_sample_frames(self, tensor, i):
+        if self.sequence_offsets is None:
+            return tensor[i, :int(self.lengths[i])]
+        return tensor[0, int(self.sequence_offsets[i]):int(self.sequence_offsets[i + 1])]
+
+
+class BatchCollator:
+    """
+    Collate function that pads a list of EpaDB samples into a Batch, decoding the features held in reduced
+    precision or compressed. The padded tensors are written into a ring of num_buffers preallocated buffers,
+    which only grow when a batch does not fit. A Batch is therefore only valid until num_buffers more batches
+    have been collated; with num_buffers=0 new tensors are allocated for every batch.
+    If packed is True, samples are concatenated along time into a packed Batch instead of padded.
+    If pin_memory is True (and CUDA is available), the buffers are in page-locked memory, so that copying
+    them to the GPU can be asynchronous.
+    """
+
+    def __init__(self, num_buffers=2, pin_memory=False, packed=False):
+        self.num_buffers = num_buffers
+        self.packed = packed
+        self.pin_memory = pin_memory and torch.cuda.is_available()
+        self._buffers = [{} for _ in range(num_buffers)]
+        self._next_buffer = 0
+
+    def __call__(self, samples):
+        if self.num_buffers > 0:
+            buffers = self._buffers[self._next_buffer]
+            self._next_buffer = (self._next_buffer + 1) % self.num_buffers
+        else:
+            buffers = {}
+
+        features = [decode_resident_features(sample['features']) for sample in samples]
+        lengths = torch.tensor([sample_features.shape[0] for sample_features in features], dtype=torch.long)
+        batch_size, max_length = len(samples), int(lengths.max())
+        if self.packed:
+            return self._pack_samples(buffers, samples, features, lengths)
+
+        batch_features = self._pad(buffers, 'features', features, (batch_size, max_length, features[0].shape[1]),
+                                   torch.float32, 0)
+        batch_frame_nodes = self._pad(buffers, 'frame_nodes', [sample['frame_nodes'] for sample in samples],
+                                      (batch_size, max_length), torch.long, -1)
+        batch_frame_labels = self._pad(buffers, 'frame_labels', [sample['frame_labels'] for sample in samples],
+                                       (batch_size, max_length), torch.int8, 0)
+
+        batch_ivectors = None
+        if 'ivectors' in samples[0]:
+            ivectors = [decode_resident_features(sample['ivectors']) for sample in samples]
+            max_ivector_count = max(sample_ivectors.shape[0] for sample_ivectors in ivectors)
+            batch_ivectors = self._pad(buffers, 'ivectors', ivectors,
+                                       (batch_size, max_ivector_count, ivectors[0].shape[1]), torch.float32, 0)
+
+        frame_mask = torch.arange(max_length).unsqueeze(0) < lengths.unsqueeze(1)
+
+        return Batch([sample['speaker_id'] + '_' + sample['utterance_id'] for sample in samples],
+                     batch_features, batch_ivectors, lengths, frame_mask, batch_frame_nodes, batch_frame_labels,
+                     [sample['phone_times'] for sample in samples])
+
+    def _pack_samples(self, buffers, samples, features, lengths):
+        total_length = int(lengths.sum())
+        sequence_offsets = torch.zeros(len(samples) + 1, dtype=torch.long)
+        sequence_offsets[1:] = torch.cumsum(lengths, 0)
+
+        batch_features = self._concat(buffers, 'features', features, (1, total_length, features[0].shape[1]),
+                                      torch.float32)
+        batch_frame_nodes = self._concat(buffers, 'frame_nodes', [sample['frame_nodes'] for sample in samples],
+                                         (1, total_length), torch.long)
+        batch_frame_labels = self._concat(buffers, 'frame_labels', [sample['frame_labels'] for sample in samples],
+                                          (1, total_length), torch.int8)
+
+        batch_ivectors = None
+        if 'ivectors' in samples[0]:
+            ivectors = [decode_resident_features(sample['ivectors']) for sample in samples]
+            total_ivector_count = sum(sample_ivectors.shape[0] for sample_ivectors in ivectors)
+            batch_ivectors = self._concat(buffers, 'ivectors', ivectors,
+                                          (1, total_ivector_count, ivectors[0].shape[1]), torch.float32)
+
+        frame_mask = torch.ones((1, total_length), dtype=torch.bool)
+
+        return Batch([sample['speaker_id'] + '_' + sample['utterance_id'] for sample in samples],
+                     batch_features, batch_ivectors, lengths, frame_mask, batch_frame_nodes, batch_frame_labels,
+                     [sample['phone_times'] for sample in samples], sequence_offsets)
+
+    # Copies the tensors one after the other into a contiguous (1 x total length x ...) view of the named buffer
+    def _concat(self, buffers, name, tensors, shape, dtype):
+        packed = self._get_buffer_view(buffers, name, shape, dtype)
+        offset = 0
+        for tensor in tensors:
+            length = tensor.shape[0]
+            packed[0, offset:offset + length] = tensor
+            offset += length
+        return packed
+
+    # Copies the tensors into a contiguous (len(tensors) x max length x ...) view of the named buffer,
+    # filling the padding with padding_value
+    def _pad(self, buffers, name, tensors, shape, dtype, padding_value):
+        padded = self._get_buffer_view(buffers, name, shape, dtype)
+        for i, tensor in enumerate(tensors):
+            length = tensor.shape[0]
+            padded[i, :length] = tensor
+            padded[i, length:] = padding_value
+        return padded
+
+    def _get_buffer_view(self, buffers, name, shape, dtype):
+        element_count = 1
+        for dim in shape:
+            element_count *= dim
+
+        buffer = buffers.get(name)
+        if buffer is None or buffer.numel() < element_count:
+            buffer = torch.empty(element_count, dtype=dtype, pin_memory=self.pin_memory)
+            buffers[name] = buffer
+
+        return buffer[:element_count].view(shape)
@@ -0,0 +1,107 @@
+import struct
+
+import numpy as np
+import torch
+
+from src.utils.ark_utils import COMPRESSED_GLOBAL_HEADER_SIZE
+
+# Ways to hold features in memory:
+#   'float32': decompressed float32 tensors
+#   'float16': decompressed tensors in half precision
+#   'compressed': MFCCs in the Kaldi compressed byte layout they are stored with in the ark, iVectors in
+#                 half precision at their native rate
+FEATURE_RESIDENCIES = ['float32', 'float16', 'compressed']
+
+
+class CompressedMatrix:
+    """
+    Matrix kept in one of the Kaldi compressed formats ('CM', 'CM2' or 'CM3'), as the raw bytes of the
+    binary object (starting with the binary marker). decode() returns the same values Kaldi would.
+    """
+    __slots__ = ['data', 'format', 'min_value', 'range', 'num_rows', 'num_cols', 'payload_offset']
+
+    def __init__(self, data):
+        token_end = data.index(b' ', 2)
+        self.data = data
+        self.format = data[2:token_end].decode()
+        if self.format not in ['CM', 'CM2', 'CM3']:
+            raise Exception('Matrix in format ' + self.format + ' is not compressed')
+        self.min_value, self.range, self.num_rows, self.num_cols = struct.unpack(
+            '<ffii', data[token_end + 1:token_end + 1 + COMPRESSED_GLOBAL_HEADER_SIZE])
+        self.payload_offset = token_end + 1 + COMPRESSED_GLOBAL_HEADER_SIZE
+
+    @property
+    def shape(self):
+        return self.num_rows, self.num_cols
+
+    def size_in_bytes(self):
+        return len(self.data)
+
+    # Returns the decompressed (num_rows x num_cols) float32 tensor
+    def decode(self):
+        rows, cols = self.num_rows, self.num_cols
+        min_value, value_range = np.float32(self.min_value), np.float32(self.range)
+
+        if self.format == 'CM':
+            # Per column percentiles (0, 25, 75, 100) followed by one byte per value, stored column by column
+            percentiles = np.frombuffer(self.data, dtype='<u2', count=cols * 4, offset=self.payload_offset)
+            percentiles = min_value + value_range * percentiles.reshape(cols, 4).astype(np.float32) / np.float32(65535)
+            p0, p25, p75, p100 = [percentiles[:, i:i + 1] for i in range(4)]
+            values = np.frombuffer(self.data, dtype=np.uint8, count=rows * cols,
+                                   offset=self.payload_offset + cols * 8).reshape(cols, rows).astype(np.float32)
+            matrix = np.where(values <= 64, p0 + (p25 - p0) * values / np.float32(64),
+                              np.where(values <= 192, p25 + (p75 - p25) * (values - 64) / np.float32(128),
+                                       p75 + (p100 - p75) * (values - 192) / np.float32(63)))
+            matrix = np.ascontiguousarray(matrix.T)
+        elif self.format == 'CM2':
+            values = np.frombuffer(self.data, dtype='<u2', count=rows * cols, offset=self.payload_offset)
+            matrix = min_value + value_range * values.reshape(rows, cols).astype(np.float32) / np.float32(65535)
+        else:
+            values = np.frombuffer(self.data, dtype=np.uint8, count=rows * cols, offset=self.payload_offset)
+            matrix = min_value + value_range * values.reshape(rows, cols).astype(np.float32) / np.float32(255)
+
+        return torch.from_numpy(matrix.astype(np.float32, copy=False))
+
+
+class CompressedFeatures:
+    """
+    Features (MFCCs+iVectors) in the 'compressed' residency: compressed MFCCs and half precision iVectors
+    at their native rate. decode() returns the (frames x 140) float32 tensor the acoustic model expects.
+    """
+    __slots__ = ['mfccs', 'ivectors', 'ivector_period']
+
+    def __init__(self, mfccs, ivectors, ivector_period):
+        self.mfccs = mfccs
+        self.ivectors = ivectors
+        self.ivector_period = ivector_period
+
+    @property
+    def shape(self):
+        return self.mfccs.num_rows, self.mfccs.num_cols + self.ivectors.shape[1]
+
+    def size_in_bytes(self):
+        return self.mfccs.size_in_bytes() + self.ivectors.element_size() * self.ivectors.nelement()
+
+    def decode(self):
+        mfccs = self.mfccs.decode()
+        ivectors = torch.repeat_interleave(self.ivectors.float(), self.ivector_period, dim=0)
+        return torch.cat((mfccs, ivectors[:mfccs.shape[0]]), dim=1)
+
+
+# Converts a float32 feature tensor to the given residency. Only 'float32' and 'float16' apply to
+# already decompressed tensors, 'compressed' features are built from the ark bytes.
+def to_resident_tensor(tensor, residency):
+    if residency == 'float16':
+        return tensor.half()
+    return tensor
+
+
+# Returns float32 tensors for features in any residency (also tuples of them)
+def decode_resident_features(value):
+    if isinstance(value, tuple):
+        return tuple(decode_resident_features(element) for element in value)
+    if isinstance(value, (CompressedMatrix, CompressedFeatures)):
+        return value.decode()
+    if value.dtype != torch.float32:
+        return value.float()
+    return value
@@ -0,0 +1,90 @@
+import hashlib
+import os
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from src.utils.SharedFeatureCache import get_shared_cache_namespace
+
+
+class EmbeddingCache:
+    """
+    On disk cache of the outputs of the frozen trunk of a FTDNNPronscorer (see FTDNNPronscorer.forward_trunk),
+    so that fine-tuning only the last layers runs the trunk once per utterance instead of once per epoch.
+
+    Embeddings are stored as one .npy file per logid under cache_dir/<key>, where the key hashes the trunk
+    weights, the tail split and the features (see get_embedding_cache_key). Folds, epochs, configs and the
+    scoring stage with the same trunk therefore share the entries. Embeddings are memory mapped when read.
+    """
+
+    def __init__(self, cache_dir, key):
+        self.embeddings_dir = os.path.join(os.fspath(cache_dir), key)
+        os.makedirs(self.embeddings_dir, exist_ok=True)
+
+    def __contains__(self, logid):
+        return os.path.isfile(self._get_path(logid))
+
+    def get(self, logid):
+        # Copy on write, so that the tensor can be used like any other without touching the file
+        return torch.from_numpy(np.load(self._get_path(logid), mmap_mode='c'))
+
+    def put(self, logid, embeddings):
+        # Written to a temporary file first, so that concurrent readers never see a partial entry
+        tmp_path = self._get_path(logid) + '.' + str(os.getpid()) + '.tmp'
+        with open(tmp_path, 'wb') as tmp_fh:
+            np.save(tmp_fh, embeddings.detach().cpu().numpy())
+        os.replace(tmp_path, self._get_path(logid))
+
+    # Computes and stores the embeddings of the samples of an EpaDB dataset that are not cached yet.
+    # Each utterance is run alone with the model in eval mode, which is restored afterwards.
+    def fill(self, model, dataset, tail_layers):
+        missing_indexes = [n for n, logid in enumerate(dataset.get_logids()) if logid not in self]
+        if len(missing_indexes) == 0:
+            return
+        print('Computing trunk embeddings for ' + str(len(missing_indexes)) + ' utterances')
+
+        device = next(model.parameters()).device
+        # Modes are restored per module, since fine-tuning sets them per layer (see freeze_layers_for_finetuning)
+        training_modes = [(module, module.training) for module in model.modules()]
+        model.eval()
+        with torch.no_grad():
+            for n in missing_indexes:
+                sample = dataset.load_sample_features(n)
+                features = sample['features'][None, :, :].to(device)
+                ivectors = sample['ivectors'][None, :, :].to(device) if 'ivectors' in sample else None
+                embeddings = model.forward_trunk(features, ivectors=ivectors, tail_layers=tail_layers)
+                self.put(sample['logid'], embeddings[0])
+        for module, training in training_modes:
+            module.training = training
+
+    def _get_path(self, logid):
+        return os.path.join(self.embeddings_dir, logid + '.npy')
+
+
+# Key of the embeddings of the trunk of model, for the given tail split and the features of feature_manager
+def get_embedding_cache_key(model, tail_layers, feature_manager, native_rate_ivectors=False):
+    hasher = hashlib.sha1()
+    hasher.update(('tail-layers=' + str(tail_layers) + ':native-rate-ivectors=' + str(native_rate_ivectors) +
+                   ':features=' + get_shared_cache_namespace(feature_manager.features_path,
+                                                             feature_manager.residency)).encode())
+    for module in model.get_trunk_modules(tail_layers):
+        for name, tensor in module.state_dict().items():
+            hasher.update(name.encode())
+            hasher.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+    return hasher.hexdigest()[:16]
+
+
+# Cached embeddings are only valid while the trunk computes the same function as in eval mode: no trainable
+# parameters, no batchnorm using batch statistics and no active dropout
+def check_trunk_is_frozen(model, tail_layers):
+    for trunk_module in model.get_trunk_modules(tail_layers):
+        for name, param in trunk_module.named_parameters():
+            if param.requires_grad:
+                raise Exception('Cannot cache trunk embeddings, trunk parameter ' + name + ' is trained')
+        for name, module in trunk_module.named_modules():
+            if not module.training:
+                continue
+            if isinstance(module, nn.BatchNorm1d) or (isinstance(module, nn.Dropout) and module.p > 0):
+                raise Exception('Cannot cache trunk embeddings, trunk module ' + name + ' is in training mode. '
+                                'Disable use-dropout and use a batchnorm setting that keeps the trunk frozen.')
@@ -0,0 +1,99 @@
+from collections import OrderedDict
+
+
+class FeatureCache:
+    """
+    Feature cache keyed by logid with an optional memory budget. When adding an entry
+    would exceed max_bytes, entries are evicted according to the policy:
+        'lru': least recently used entry first
+        'lfu': least frequently used entry first (ties broken by recency)
+    Hits, misses and evictions are counted for logging.
+    """
+
+    def __init__(self, max_bytes=None, policy='lru'):
+        if policy not in ['lru', 'lfu']:
+            raise Exception('Unsupported feature cache policy ' + policy)
+
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._sizes = {}
+        self._use_counts = {}
+
+    def __contains__(self, logid):
+        return logid in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    # Returns the cached value for logid, or None if it is not cached
+    def get(self, logid):
+        if logid not in self._entries:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self._use_counts[logid] += 1
+        self._entries.move_to_end(logid)
+        return self._entries[logid]
+
+    def put(self, logid, value):
+        if logid in self._entries:
+            self._remove(logid)
+
+        size = get_size_in_bytes(value)
+        # Entries larger than the whole budget are never cached
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+
+        while self.max_bytes is not None and self.current_bytes + size > self.max_bytes:
+            self._remove(self._choose_victim())
+            self.evictions += 1
+
+        self._entries[logid] = value
+        self._sizes[logid] = size
+        self._use_counts[logid] = 1
+        self.current_bytes += size
+
+    def clear(self):
+        self._entries.clear()
+        self._sizes.clear()
+        self._use_counts.clear()
+        self.current_bytes = 0
+
+    def stats(self):
+        return {'entries': len(self._entries),
+                'bytes': self.current_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions}
+
+    def _choose_victim(self):
+        if self.policy == 'lru':
+            return next(iter(self._entries))
+        # min keeps the first of equal counts, which is the least recently used one
+        return min(self._entries.keys(), key=lambda logid: self._use_counts[logid])
+
+    def _remove(self, logid):
+        del self._entries[logid]
+        self.current_bytes -= self._sizes.pop(logid)
+        del self._use_counts[logid]
+
+
+def get_size_in_bytes(value):
+    if isinstance(value, tuple):
+        return sum(get_size_in_bytes(element) for element in value)
+    # Compressed features know their own size
+    if hasattr(value, 'size_in_bytes'):
+        return value.size_in_bytes()
+    return value.element_size() * value.nelement()
+
+
+def megabytes_to_bytes(megabytes):
+    if megabytes is None:
+        return None
+    return int(megabytes * 1024 * 1024)
@@ -1,13 +1,32 @@
 import glob
+import math
+import multiprocessing
 import os
+import shutil
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import torch
-from kaldi.util.table import RandomAccessMatrixReader
+from kaldi.util.table import RandomAccessMatrixReader, SequentialMatrixReader
+
+from src.utils.CompressedFeatures import FEATURE_RESIDENCIES, CompressedFeatures, CompressedMatrix, \
+    decode_resident_features, to_resident_tensor
+from src.utils.FeatureCache import FeatureCache, megabytes_to_bytes
+from src.utils.ark_utils import append_arks, read_ark_index, read_ark_num_rows, read_raw_ark_object, \
+    remove_entries_from_ark, write_scp_for_ark
+from src.utils.MfccExtractor import MfccExtractor
+from src.utils.PackedFeatureStore import PackedFeatureStore, append_to_packed_store, remove_from_packed_store
+from src.utils.SharedFeatureCache import get_shared_cache_namespace, get_shared_feature_cache
 
 
 class FeatureManager:
-    def __init__(self, epadb_root_path, features_path, conf_path, heldout_root_path=''):
+    def __init__(self, epadb_root_path, features_path, conf_path, heldout_root_path='', cache_max_mb=None,
+                 cache_policy='lru', prefetch_threads=0, prefetch_depth=32, residency='float32', cache_type='private'):
+        if residency not in FEATURE_RESIDENCIES:
+            raise Exception('Unsupported feature residency ' + residency)
+
         self.epadb_root_path = epadb_root_path
         self.features_path = features_path
         self.mfcc_path = features_path + '/mfccs.ark'
@@ -15,12 +34,41 @@ class FeatureManager:
         self.wav_scp_path = features_path + '/wav.scp'
         self.spk2utt_path = features_path + '/spk2utt'
         self.feats_scp_path = features_path + '/feats.scp'
+        self.wav_fingerprints_path = features_path + '/wav_fingerprints'
+        self.transcriptions_index_path = features_path + '/text'
+        self.packed_feats_path = features_path + '/feats_packed.bin'
+        self.packed_index_path = features_path + '/feats_packed.index'
+        self.packed_mfccs_path = features_path + '/feats_packed_mfccs.bin'
+        self.packed_mfccs_index_path = features_path + '/feats_packed_mfccs.index'
+        self.packed_ivectors_path = features_path + '/feats_packed_ivectors.bin'
+        self.packed_ivectors_index_path = features_path + '/feats_packed_ivectors.index'
         self.conf_path = conf_path
-        self.cache = dict()
+        # A shared cache is attached to by every process on the host using the same features and residency
+        if cache_type == 'private':
+            self.cache = FeatureCache(max_bytes=megabytes_to_bytes(cache_max_mb), policy=cache_policy)
+        elif cache_type == 'shared':
+            self.cache = get_shared_feature_cache(get_shared_cache_namespace(features_path, residency),
+                                                  max_bytes=megabytes_to_bytes(cache_max_mb))
+        else:
+            raise Exception('Unsupported feature cache ' + cache_type)
         self.ivector_period = None
         self.heldout_root_path = heldout_root_path
+        self._packed_store = None
+        self._native_rate_packed_stores = None
+        self._transcriptions = None
+        self.prefetch_threads = prefetch_threads
+        self.prefetch_depth = prefetch_depth
+        self.prefetch_hits = 0
+        self._prefetch_executor = None
+        self._prefetched = dict()
+        self._prefetch_generations = dict()
+        self._cache_lock = threading.Lock()
+        self.residency = residency
+        self._mfcc_offsets = None
 
-    def extract_features_using_kaldi(self):
+    # mfcc_engine selects how MFCCs are computed: 'kaldi' runs compute-mfcc-feats, 'torchaudio' computes them
+    # in-process with MfccExtractor. iVectors are always extracted with Kaldi.
+    def extract_features_using_kaldi(self, num_jobs=1, mfcc_engine='kaldi'):
 
         if not os.path.isdir(self.features_path):
             os.mkdir(self.features_path)
@@ -45,52 +93,430 @@ class FeatureManager:
         wav_scp_file.close()
         spk2utt_file.close()
 
-        if not os.path.exists(self.mfcc_path):
-            os.system('compute-mfcc-feats --config=' + self.conf_path + '/mfcc_hires.conf \
-					   scp,p:' + self.wav_scp_path + ' ark:- | copy-feats \
-					   --compress=true ark:- ark,scp:' + self.mfcc_path + ',' + self.feats_scp_path)
+        fingerprints = get_wav_fingerprints(self.wav_scp_path)
+
+        # If features were already extracted, only extract them for new or changed waveforms
+        if os.path.exists(self.mfcc_path) and os.path.exists(self.ivectors_path):
+            self._update_features_for_changed_waveforms(fingerprints, num_jobs, mfcc_engine)
+        else:
+            extract_features_in_dir(self.conf_path, self.features_path, num_jobs, mfcc_engine)
+
+        # Waveforms that Kaldi skipped (unreadable or too short) are left without a fingerprint, so that the next
+        # run tries to extract them again
+        extracted_logids = set(entry[0] for entry in read_ark_index(self.mfcc_path)) & \
+            set(entry[0] for entry in read_ark_index(self.ivectors_path))
+        write_wav_fingerprints(self.wav_fingerprints_path, {logid: fingerprint for logid, fingerprint
+                                                            in fingerprints.items() if logid in extracted_logids})
+
+    def _update_features_for_changed_waveforms(self, fingerprints, num_jobs, mfcc_engine):
+        previous_fingerprints = read_wav_fingerprints(self.wav_fingerprints_path)
+        if previous_fingerprints is None:
+            # Features extracted before fingerprints were tracked are taken to be up to date
+            extracted_logids = set(entry[0] for entry in read_ark_index(self.mfcc_path))
+            previous_fingerprints = {logid: fingerprint for logid, fingerprint in fingerprints.items()
+                                     if logid in extracted_logids}
+
+        changed_logids = [logid for logid, fingerprint in fingerprints.items()
+                          if previous_fingerprints.get(logid) != fingerprint]
+        removed_logids = [logid for logid in previous_fingerprints if logid not in fingerprints]
+        if len(changed_logids) == 0 and len(removed_logids) == 0:
+            return
+
+        print('Extracting features for %d new or changed waveforms, removing %d' % (len(changed_logids),
+                                                                                  len(removed_logids)))
+
+        # Drop outdated entries first, so that each logid appears only once in the arks
+        stale_logids = set(changed_logids + removed_logids)
+        remove_entries_from_ark(self.mfcc_path, stale_logids)
+        remove_entries_from_ark(self.ivectors_path, stale_logids)
+        for index_path in [self.packed_index_path, self.packed_mfccs_index_path, self.packed_ivectors_index_path]:
+            if os.path.exists(index_path):
+                remove_from_packed_store(index_path, stale_logids)
 
-        if not os.path.exists(self.ivectors_path):
-            os.system(
-                'ivector-extract-online2 --config=' + self.conf_path + '/ivector_extractor.conf ark:' + self.spk2utt_path + '\
-		    	      scp:' + self.feats_scp_path + ' ark:' + self.ivectors_path)
+        if len(changed_logids) > 0:
+            incremental_dir = self.features_path + '/incremental'
+            # Left over by an interrupted run, its arks may hold other or partially extracted utterances
+            if os.path.isdir(incremental_dir):
+                shutil.rmtree(incremental_dir)
+            write_wav_scp_and_spk2utt_subset(self.wav_scp_path, self.spk2utt_path, incremental_dir, changed_logids)
+            extract_features_in_dir(self.conf_path, incremental_dir, num_jobs, mfcc_engine)
+
+            append_arks([incremental_dir + '/mfccs.ark'], self.mfcc_path)
+            append_arks([incremental_dir + '/ivectors.ark'], self.ivectors_path)
+            # Entries appended to the packed stores supersede the previous ones for the same logid
+            if os.path.exists(self.packed_index_path):
+                self._append_arks_to_packed_store(incremental_dir + '/mfccs.ark', incremental_dir + '/ivectors.ark')
+            if self._has_native_rate_packed_stores():
+                self._append_arks_to_native_rate_packed_stores(incremental_dir + '/mfccs.ark',
+                                                               incremental_dir + '/ivectors.ark')
+            shutil.rmtree(incremental_dir)
+
+        write_scp_for_ark(self.mfcc_path, self.feats_scp_path)
+        self._mfcc_offsets = None
+        # Stores opened before the update map the data and index as they were
+        self._packed_store = None
+        self._native_rate_packed_stores = None
+
+    # Packs the features of every utterance in the arks (MFCCs+iVectors, decompressed and expanded to frame rate)
+    # into a single contiguous file plus an offset index. Once the packed store exists it is used to serve features
+    # instead of the arks.
+    # With native_rate_ivectors, the MFCCs (40 dims per frame) and the iVectors at their native rate (100 dims per
+    # iVector period) are packed as two separate stores instead, which take under a third of the space of the
+    # 140 dim frame rate rows. Frame rate features are expanded from them on load.
+    def pack_features(self, dtype='float32', native_rate_ivectors=False):
+        if native_rate_ivectors and self._has_native_rate_packed_stores():
+            return
+        if not native_rate_ivectors and os.path.exists(self.packed_index_path):
+            return
+
+        if not os.path.isfile(self.mfcc_path) or not os.path.isfile(self.ivectors_path):
+            raise Exception("Features not found in " + self.features_path + ". Did you extract the features?")
+
+        if native_rate_ivectors:
+            # An interrupted packing can leave the iVectors store without the MFCCs one, so it is packed again
+            if os.path.exists(self.packed_ivectors_index_path):
+                os.remove(self.packed_ivectors_index_path)
+            self._append_arks_to_native_rate_packed_stores(self.mfcc_path, self.ivectors_path, dtype=dtype)
+        else:
+            self._append_arks_to_packed_store(self.mfcc_path, self.ivectors_path, dtype=dtype)
+
+    def _append_arks_to_packed_store(self, mfcc_path, ivectors_path, dtype='float32'):
+        if self.ivector_period == None:
+            self.ivector_period = self._read_ivector_period_from_conf()
+
+        mfccs_rspec = ("ark:" + mfcc_path)
+        ivectors_rspec = ("ark:" + ivectors_path)
+
+        with SequentialMatrixReader(mfccs_rspec) as mfccs_reader, \
+                RandomAccessMatrixReader(ivectors_rspec) as ivectors_reader:
+            logid_feats_pairs = ((logid, self._combine_mfccs_and_ivectors(mfccs, ivectors_reader[logid]))
+                                 for logid, mfccs in mfccs_reader)
+            append_to_packed_store(self.packed_feats_path, self.packed_index_path, logid_feats_pairs, dtype=dtype)
+
+    def _append_arks_to_native_rate_packed_stores(self, mfcc_path, ivectors_path, dtype='float32'):
+        if self.ivector_period == None:
+            self.ivector_period = self._read_ivector_period_from_conf()
+
+        # The iVectors are packed first, so that the MFCCs index, which marks the stores as usable, comes last
+        mfcc_num_rows = read_ark_num_rows(mfcc_path)
+        with RandomAccessMatrixReader("ark:" + ivectors_path) as ivectors_reader:
+            logid_ivectors_pairs = ((logid, ivectors_reader[logid].numpy()[:math.ceil(num_rows / self.ivector_period)])
+                                    for logid, num_rows in mfcc_num_rows.items())
+            append_to_packed_store(self.packed_ivectors_path, self.packed_ivectors_index_path, logid_ivectors_pairs,
+                                   dtype=dtype)
+
+        with SequentialMatrixReader("ark:" + mfcc_path) as mfccs_reader:
+            logid_mfccs_pairs = ((logid, mfccs.numpy()) for logid, mfccs in mfccs_reader)
+            append_to_packed_store(self.packed_mfccs_path, self.packed_mfccs_index_path, logid_mfccs_pairs,
+                                   dtype=dtype)
 
     # Returns features (MFCCs+iVectors) for given logid in the format the acoustic model expects
     def get_features_for_logid(self, logid):
+        return decode_resident_features(self.get_resident_features_for_logid(logid))
+
+    # Returns MFCCs (frames x 40) and iVectors at their native rate (ceil(frames/ivector_period) x 100) for given logid
+    def get_mfccs_and_ivectors_for_logid(self, logid):
+        return decode_resident_features(self.get_resident_mfccs_and_ivectors_for_logid(logid))
+
+    # Same as get_features_for_logid, but the features are returned as they are held in memory (see residency).
+    # decode_resident_features turns them into float32 tensors, which lets callers decode them per batch.
+    # prefetch_channel is the one the caller prefetches on (see prefetch).
+    def get_resident_features_for_logid(self, logid, prefetch_channel=None):
 
         if self.ivector_period == None:
             self.ivector_period = self._read_ivector_period_from_conf()
 
-        if not logid in self.cache:
+        return self._get_cached_or_load(logid, logid, self._load_features_for_logid, prefetch_channel)
+
+    # Same as get_mfccs_and_ivectors_for_logid, but the features are returned as they are held in memory
+    def get_resident_mfccs_and_ivectors_for_logid(self, logid, prefetch_channel=None):
+
+        if self.ivector_period == None:
+            self.ivector_period = self._read_ivector_period_from_conf()
+
+        return self._get_cached_or_load((logid, 'native-rate-ivectors'), logid, self._load_mfccs_and_ivectors_for_logid,
+                                        prefetch_channel)
+
+    # Drops the state that cannot be shared with a forked process (locks, prefetch threads, mapped files).
+    # Called at the start of each DataLoader worker, which then opens its own handles lazily.
+    def reset_after_fork(self):
+        self._cache_lock = threading.Lock()
+        self._prefetch_executor = None
+        self._prefetched = dict()
+        self._prefetch_generations = dict()
+        self._packed_store = None
+        self._native_rate_packed_stores = None
 
+    # Starts decoding the features of the given logids in background threads, in order, keeping at most
+    # prefetch_depth decoded utterances waiting to be requested. Does nothing if prefetch_threads is 0.
+    # Each call starts a new generation of prefetching on prefetch_channel and cancels the previous one of that
+    # channel, dropping the utterances it decoded that were not requested. Consumers that read features at the same
+    # time (e.g. the train and test sets sharing a FeatureManager) use separate channels, and pass theirs when
+    # requesting features, so that each one only moves the cursor of its own generation.
+    def prefetch(self, logids, native_rate_ivectors=False, prefetch_channel=None):
+        if self.prefetch_threads == 0:
+            return
+
+        if self.ivector_period == None:
+            self.ivector_period = self._read_ivector_period_from_conf()
+
+        if self._prefetch_executor is None:
+            self._prefetch_executor = ThreadPoolExecutor(max_workers=self.prefetch_threads)
+
+        if native_rate_ivectors:
+            requests = [((logid, 'native-rate-ivectors'), logid, self._load_mfccs_and_ivectors_for_logid)
+                        for logid in logids]
+        else:
+            requests = [(logid, logid, self._load_features_for_logid) for logid in logids]
+
+        generation = _PrefetchGeneration(requests, self.prefetch_depth)
+        with self._cache_lock:
+            if prefetch_channel in self._prefetch_generations:
+                self._cancel_prefetch_generation(self._prefetch_generations[prefetch_channel])
+            self._prefetch_generations[prefetch_channel] = generation
+        submitter = threading.Thread(target=self._submit_prefetch_requests, args=(generation,), daemon=True)
+        submitter.start()
+
+    def _submit_prefetch_requests(self, generation):
+        for position, (cache_key, logid, loader) in enumerate(generation.requests):
+            # Blocks while prefetch_depth prefetched utterances have not been requested yet
+            generation.slots.acquire()
+            with self._cache_lock:
+                if generation.cancelled:
+                    return
+                # Utterances the consumer has already gone past, or that are ready, are not submitted
+                if (position < generation.cursor or cache_key in self._prefetched or
+                        cache_key in self.cache):
+                    generation.slots.release()
+                    continue
+                future = self._prefetch_executor.submit(self._load_and_cache, cache_key, logid, loader)
+                self._prefetched[cache_key] = (future, generation)
+
+    # Must be called with the cache lock held
+    def _cancel_prefetch_generation(self, generation):
+        generation.cancelled = True
+        for cache_key in [key for key, (_, owner) in self._prefetched.items() if owner is generation]:
+            self._drop_prefetched(cache_key)
+        # Wakes the submitter if it waits for a slot, so that it sees the cancellation and stops
+        generation.slots.release()
+
+    # Must be called with the cache lock held
+    def _drop_prefetched(self, cache_key):
+        future, generation = self._prefetched.pop(cache_key)
+        future.cancel()
+        generation.slots.release()
+
+    # Moves the consumer cursor of the current generation of prefetch_channel past cache_key, and drops the
+    # prefetched utterances it went past without requesting them. Must be called with the cache lock held.
+    def _advance_prefetch_cursor(self, cache_key, prefetch_channel):
+        generation = self._prefetch_generations.get(prefetch_channel)
+        if generation is None or cache_key not in generation.positions:
+            return
+        position = generation.positions[cache_key]
+        if position < generation.cursor:
+            return
+        for skipped_key, _, _ in generation.requests[generation.cursor:position]:
+            if skipped_key in self._prefetched and self._prefetched[skipped_key][1] is generation:
+                self._drop_prefetched(skipped_key)
+        generation.cursor = position + 1
+
+    def _get_cached_or_load(self, cache_key, logid, loader, prefetch_channel=None):
+        with self._cache_lock:
+            self._advance_prefetch_cursor(cache_key, prefetch_channel)
+            future, generation = self._prefetched.pop(cache_key, (None, None))
+            if future is None:
+                value = self.cache.get(cache_key)
+            else:
+                self.prefetch_hits += 1
+
+        if future is not None:
+            generation.slots.release()
+            return future.result()
+
+        if value is None:
+            value = self._load_and_cache(cache_key, logid, loader)
+
+        return value
+
+    def _load_and_cache(self, cache_key, logid, loader):
+        value = loader(logid)
+        with self._cache_lock:
+            self.cache.put(cache_key, value)
+        return value
+
+    def _load_features_for_logid(self, logid):
+        if self.residency == 'compressed':
+            mfccs, ivectors = self._read_compressed_mfccs_and_ivectors_from_ark(logid)
+            return CompressedFeatures(mfccs, ivectors, self.ivector_period)
+
+        if self._get_packed_store() is not None:
+            feats = self._get_packed_features_for_logid(logid)
+        elif self._get_native_rate_packed_stores() is not None:
+            mfccs, ivectors = self._get_native_rate_packed_features_for_logid(logid)
+            ivectors = torch.repeat_interleave(ivectors, self.ivector_period, dim=0)[:mfccs.shape[0]]
+            feats = torch.cat((mfccs, ivectors), dim=1)
+        else:
+            feats = self._read_features_from_ark(logid)
+        return to_resident_tensor(feats, self.residency)
+
+    def _load_mfccs_and_ivectors_for_logid(self, logid):
+        if self.residency == 'compressed':
+            return self._read_compressed_mfccs_and_ivectors_from_ark(logid)
+
+        if self._get_native_rate_packed_stores() is not None:
+            mfccs, ivectors = self._get_native_rate_packed_features_for_logid(logid)
+        elif self._get_packed_store() is not None:
+            # The packed store holds iVectors at frame rate, so take one row per iVector period. Reading them still
+            # maps the 140 dim rows of every frame: pack_features with native_rate_ivectors avoids that.
+            feats = self._get_packed_features_for_logid(logid)
+            mfccs = feats[:, :40]
+            ivectors = feats[::self.ivector_period, 40:]
+        else:
+            mfccs, ivectors = self._read_mfccs_and_ivectors_from_ark(logid)
+            ivector_count = math.ceil(mfccs.shape[0] / self.ivector_period)
+            mfccs = torch.from_numpy(mfccs)
+            ivectors = torch.from_numpy(ivectors[:ivector_count])
+
+        return to_resident_tensor(mfccs, self.residency), to_resident_tensor(ivectors, self.residency)
+
+    # Returns the MFCCs exactly as they are stored in the ark (compressed by copy-feats) and
+    # the iVectors in half precision at their native rate
+    def _read_compressed_mfccs_and_ivectors_from_ark(self, logid):
+        if not os.path.isfile(self.mfcc_path):
+            raise Exception("MFCCs for utterance " + logid + " not found. Did you extract the features?")
+
+        mfcc_offsets = self._get_mfcc_offsets()
+        if logid not in mfcc_offsets:
+            raise Exception("MFCCs for utterance " + logid + " not found. Did you extract the features?")
+        mfccs = CompressedMatrix(read_raw_ark_object(self.mfcc_path, mfcc_offsets[logid]))
+
+        ivectors = self._read_ivectors_from_ark(logid)
+        ivector_count = math.ceil(mfccs.num_rows / self.ivector_period)
+        ivectors = torch.from_numpy(ivectors[:ivector_count]).half()
+
+        return mfccs, ivectors
+
+    def _get_mfcc_offsets(self):
+        with self._cache_lock:
+            if self._mfcc_offsets is None:
+                self._mfcc_offsets = {logid: data_offset for logid, _, data_offset, _ in read_ark_index(self.mfcc_path)}
+        return self._mfcc_offsets
+
+    # Returns a dictionary mapping each of the given logids to the number of frames of its features,
+    # without reading the features themselves
+    def get_frame_counts(self, logids):
+        packed_store = self._get_packed_store()
+        if packed_store is None and self._get_native_rate_packed_stores() is not None:
+            packed_store = self._get_native_rate_packed_stores()[0]
+        if packed_store is not None:
+            frame_counts = {logid: packed_store.frame_count(logid) for logid in logids if packed_store.has_key(logid)}
+        else:
             if not os.path.isfile(self.mfcc_path):
-                raise Exception("MFCCs for utterance " + logid + " not found. Did you extract the features?")
+                raise Exception("MFCCs not found in " + self.mfcc_path + ". Did you extract the features?")
+            mfcc_num_rows = read_ark_num_rows(self.mfcc_path)
+            frame_counts = {logid: mfcc_num_rows[logid] for logid in logids if logid in mfcc_num_rows}
+
+        for logid in logids:
+            if logid not in frame_counts:
+                raise Exception("Features for utterance " + logid + " not found. Did you extract the features?")
+        return frame_counts
+
+    def log_cache_stats(self):
+        stats = self.cache.stats()
+        print('Feature cache: %d entries, %.1f MB, %d hits, %d misses, %d evictions, %d prefetched' % (
+            stats['entries'], stats['bytes'] / (1024 * 1024), stats['hits'], stats['misses'], stats['evictions'],
+            self.prefetch_hits))
+
+    def _get_packed_store(self):
+        if self._packed_store is None and os.path.isfile(self.packed_index_path):
+            with self._cache_lock:
+                if self._packed_store is None:
+                    self._packed_store = PackedFeatureStore(self.packed_feats_path, self.packed_index_path)
+        return self._packed_store
 
-            if not os.path.isfile(self.ivectors_path):
+    # Returns the MFCCs and native rate iVectors stores (see pack_features), or None unless both were packed
+    def _get_native_rate_packed_stores(self):
+        if self._native_rate_packed_stores is None and self._has_native_rate_packed_stores():
+            with self._cache_lock:
+                if self._native_rate_packed_stores is None:
+                    self._native_rate_packed_stores = (
+                        PackedFeatureStore(self.packed_mfccs_path, self.packed_mfccs_index_path),
+                        PackedFeatureStore(self.packed_ivectors_path, self.packed_ivectors_index_path))
+        return self._native_rate_packed_stores
+
+    def _has_native_rate_packed_stores(self):
+        return os.path.isfile(self.packed_mfccs_index_path) and os.path.isfile(self.packed_ivectors_index_path)
+
+    def _get_packed_features_for_logid(self, logid):
+        return self._read_from_packed_store(self._get_packed_store(), logid)
+
+    def _get_native_rate_packed_features_for_logid(self, logid):
+        mfccs_store, ivectors_store = self._get_native_rate_packed_stores()
+        return self._read_from_packed_store(mfccs_store, logid), self._read_from_packed_store(ivectors_store, logid)
+
+    def _read_from_packed_store(self, packed_store, logid):
+        if not packed_store.has_key(logid):
+            raise Exception("Packed features for utterance " + logid + " not found. Did you pack the features?")
+        # Zero-copy view over the mapped file, unless the store was packed in reduced precision
+        feats = torch.from_numpy(packed_store.get(logid))
+        if feats.dtype != torch.float32:
+            feats = feats.float()
+        return feats
+
+    def _read_features_from_ark(self, logid):
+        # transcription = self._get_transcription_for_logid(logid)
+
+        mfccs, ivectors = self._read_mfccs_and_ivectors_from_ark(logid)
+        x = self._combine_mfccs_and_ivectors(mfccs, ivectors)
+        # x = np.expand_dims(x, axis=0)
+        feats = torch.from_numpy(x)
+
+        return feats
+
+    def _read_mfccs_and_ivectors_from_ark(self, logid):
+        if not os.path.isfile(self.mfcc_path):
+            raise Exception("MFCCs for utterance " + logid + " not found. Did you extract the features?")
+
+        if not os.path.isfile(self.ivectors_path):
+            raise Exception("iVectors for utterance " + logid + " not found. Did you extract the features?")
+
+        mfccs_rspec = ("ark:" + self.mfcc_path)
+        ivectors_rspec = ("ark:" + self.ivectors_path)
+
+        with RandomAccessMatrixReader(mfccs_rspec) as mfccs_reader, \
+                RandomAccessMatrixReader(ivectors_rspec) as ivectors_reader:
+            if not ivectors_reader.has_key(logid):
                 raise Exception("iVectors for utterance " + logid + " not found. Did you extract the features?")
+            if not mfccs_reader.has_key(logid):
+                raise Exception("MFCCs for utterance " + logid + " not found. Did you extract the features?")
+            # Copy out of the readers' buffers before they are closed
+            mfccs = mfccs_reader[logid].numpy().copy()
+            ivectors = ivectors_reader[logid].numpy().copy()
 
-            # transcription = self._get_transcription_for_logid(logid)
+        return mfccs, ivectors
 
-            mfccs_rspec = ("ark:" + self.mfcc_path)
-            ivectors_rspec = ("ark:" + self.ivectors_path)
+    def _read_ivectors_from_ark(self, logid):
+        if not os.path.isfile(self.ivectors_path):
+            raise Exception("iVectors for utterance " + logid + " not found. Did you extract the features?")
 
-            with RandomAccessMatrixReader(mfccs_rspec) as mfccs_reader, \
-                    RandomAccessMatrixReader(ivectors_rspec) as ivectors_reader:
-                if not ivectors_reader.has_key(logid):
-                    raise Exception("iVectors for utterance " + logid + " not found. Did you extract the features?")
-                if not mfccs_reader.has_key(logid):
-                    raise Exception("MFCCs for utterance " + logid + " not found. Did you extract the features?")
-                mfccs = mfccs_reader[logid]
-                ivectors = ivectors_reader[logid]
-                ivectors = np.repeat(ivectors, self.ivector_period, axis=0)
-                ivectors = ivectors[:mfccs.shape[0], :]
-                x = np.concatenate((mfccs, ivectors), axis=1)
-                # x = np.expand_dims(x, axis=0)
-                feats = torch.from_numpy(x)
+        with RandomAccessMatrixReader("ark:" + self.ivectors_path) as ivectors_reader:
+            if not ivectors_reader.has_key(logid):
+                raise Exception("iVectors for utterance " + logid + " not found. Did you extract the features?")
+            ivectors = ivectors_reader[logid].numpy().copy()
+
+        return ivectors
 
-            self.cache[logid] = feats
+    def _combine_mfccs_and_ivectors(self, mfccs, ivectors):
+        ivectors = np.repeat(ivectors, self.ivector_period, axis=0)
+        ivectors = ivectors[:mfccs.shape[0], :]
+        return np.concatenate((mfccs, ivectors), axis=1)
 
-        return self.cache[logid]
+    # Returns the frames per iVector the features were extracted with, which the models must be built with
+    # to take native rate iVectors (see FTDNN)
+    def get_ivector_period(self):
+        if self.ivector_period == None:
+            self.ivector_period = self._read_ivector_period_from_conf()
+        return self.ivector_period
 
     def _read_ivector_period_from_conf(self):
         conf_fh = open(self.conf_path + '/ivector_extractor.conf')
@@ -99,12 +525,264 @@ class FeatureManager:
         return ivector_period
 
     def get_transcription_for_logid(self, logid):
-        spkr = logid.split('_')[0]
-        transcription_path = self.epadb_root_path + '/' + spkr + '/transcriptions/' + logid + '.lab'
+        if self._transcriptions is None:
+            self._transcriptions = load_transcriptions_index(self.epadb_root_path, self.transcriptions_index_path)
 
-        if not os.path.isfile(transcription_path):
+        if logid not in self._transcriptions:
+            spkr = logid.split('_')[0]
+            transcription_path = self.epadb_root_path + '/' + spkr + '/transcriptions/' + logid + '.lab'
             raise Exception("Transcription file for logid " + logid + " not found in path " + transcription_path + ".")
+        if self._transcriptions[logid] == '':
+            raise Exception("Transcription file for logid " + logid + " is empty.")
+
+        return self._transcriptions[logid]
+
+
+# Returns the FeatureManager keyword arguments defined in the config
+def get_feature_manager_kwargs(config_dict):
+    return {'cache_max_mb': config_dict.get('feature-cache-max-mb', None),
+            'cache_policy': config_dict.get('feature-cache-policy', 'lru'),
+            'prefetch_threads': config_dict.get('feature-prefetch-threads', 0),
+            'prefetch_depth': config_dict.get('feature-prefetch-depth', 32),
+            'residency': config_dict.get('feature-residency', 'float32'),
+            'cache_type': config_dict.get('feature-cache', 'private')}
+
+
+# Extracts MFCCs and iVectors for the utterances in data_dir/wav.scp and data_dir/spk2utt into
+# data_dir/mfccs.ark, data_dir/feats.scp and data_dir/ivectors.ark, splitting the work in num_jobs processes
+# (or num_jobs threads for in-process MFCC extraction)
+def extract_features_in_dir(conf_path, data_dir, num_jobs=1, mfcc_engine='kaldi'):
+    wav_scp_path = data_dir + '/wav.scp'
+    spk2utt_path = data_dir + '/spk2utt'
+    mfcc_path = data_dir + '/mfccs.ark'
+    feats_scp_path = data_dir + '/feats.scp'
+    ivectors_path = data_dir + '/ivectors.ark'
+
+    if mfcc_engine == 'torchaudio' and not os.path.exists(mfcc_path):
+        mfcc_extractor = MfccExtractor(conf_path + '/mfcc_hires.conf', num_threads=num_jobs)
+        mfcc_extractor.write_mfccs_for_wav_scp(wav_scp_path, mfcc_path, feats_scp_path)
+    elif mfcc_engine not in ['kaldi', 'torchaudio']:
+        raise Exception('Unsupported MFCC engine ' + mfcc_engine)
+
+    if num_jobs == 1 or os.path.exists(ivectors_path):
+        run_kaldi_feature_extraction(conf_path, wav_scp_path, spk2utt_path, mfcc_path, feats_scp_path, ivectors_path)
+        return
+
+    # Split by speaker, extract the features of each shard in a separate process and merge arks and scp files
+    split_dir = data_dir + '/split' + str(num_jobs)
+    # Left over by an interrupted run, its shards may hold partially written arks
+    if os.path.isdir(split_dir):
+        shutil.rmtree(split_dir)
+    shard_dirs = split_wav_scp_and_spk2utt_by_speaker(wav_scp_path, spk2utt_path, split_dir, num_jobs)
+
+    mfccs_extracted = os.path.exists(mfcc_path)
+    if mfccs_extracted:
+        # MFCCs computed in-process (or by an earlier run): each shard only extracts the iVectors of its speakers,
+        # reading their MFCCs from the full ark
+        for shard_dir in shard_dirs:
+            write_feats_scp_subset(feats_scp_path, shard_dir + '/spk2utt', shard_dir + '/feats.scp')
+    shard_args = [(conf_path, shard_dir + '/wav.scp', shard_dir + '/spk2utt',
+                   mfcc_path if mfccs_extracted else shard_dir + '/mfccs.ark',
+                   shard_dir + '/feats.scp', shard_dir + '/ivectors.ark') for shard_dir in shard_dirs]
+    with multiprocessing.Pool(num_jobs) as pool:
+        pool.starmap(run_kaldi_feature_extraction, shard_args)
+
+    if not mfccs_extracted:
+        merge_arks_and_scps([shard_dir + '/mfccs.ark' for shard_dir in shard_dirs],
+                            [shard_dir + '/feats.scp' for shard_dir in shard_dirs],
+                            mfcc_path, feats_scp_path)
+    merge_arks_and_scps([shard_dir + '/ivectors.ark' for shard_dir in shard_dirs], [],
+                        ivectors_path, None)
+    shutil.rmtree(split_dir)
+
+
+# Runs Kaldi MFCC and online iVector extraction for the utterances in wav.scp and spk2utt,
+# skipping each step if its output already exists
+def run_kaldi_feature_extraction(conf_path, wav_scp_path, spk2utt_path, mfcc_path, feats_scp_path, ivectors_path):
+    if not os.path.exists(mfcc_path):
+        run_kaldi_command('set -o pipefail; compute-mfcc-feats --config=' + conf_path + '/mfcc_hires.conf \
+				   scp,p:' + wav_scp_path + ' ark:- | copy-feats \
+				   --compress=true ark:- ark,scp:' + mfcc_path + ',' + feats_scp_path, [mfcc_path, feats_scp_path])
+
+    if not os.path.exists(ivectors_path):
+        run_kaldi_command(
+            'ivector-extract-online2 --config=' + conf_path + '/ivector_extractor.conf ark:' + spk2utt_path + '\
+	    	      scp:' + feats_scp_path + ' ark:' + ivectors_path, [ivectors_path])
+
+
+# Runs a Kaldi command line and raises if it fails, removing its outputs so that they are not taken to be
+# complete by the next run
+def run_kaldi_command(command, output_paths):
+    if subprocess.call(['bash', '-c', command]) != 0:
+        for output_path in output_paths:
+            if os.path.exists(output_path):
+                os.remove(output_path)
+        raise Exception('Feature extraction failed: ' + ' '.join(command.split()))
+
+
+# Writes num_jobs subsets of wav.scp and spk2utt in split_dir/<job>/, keeping all utterances
+# of a speaker in the same subset. Returns the list of subset directories.
+def split_wav_scp_and_spk2utt_by_speaker(wav_scp_path, spk2utt_path, split_dir, num_jobs):
+    wav_scp_lines = {}
+    for line in open(wav_scp_path, 'r').readlines():
+        wav_scp_lines[line.split()[0]] = line
+
+    spk2utt_lines_by_speaker = {}
+    for line in open(spk2utt_path, 'r').readlines():
+        spkr = line.split()[0]
+        spk2utt_lines_by_speaker.setdefault(spkr, []).append(line)
+
+    # Assign speakers to the shard with the fewest utterances so far, largest speakers first
+    shard_lines = [[] for _ in range(num_jobs)]
+    for spkr in sorted(spk2utt_lines_by_speaker, key=lambda spkr: -len(spk2utt_lines_by_speaker[spkr])):
+        shard = min(range(num_jobs), key=lambda job: len(shard_lines[job]))
+        shard_lines[shard].extend(spk2utt_lines_by_speaker[spkr])
+
+    shard_dirs = []
+    for job, spk2utt_lines in enumerate(shard_lines):
+        if len(spk2utt_lines) == 0:
+            continue
+        shard_dir = split_dir + '/' + str(job)
+        os.makedirs(shard_dir, exist_ok=True)
+        with open(shard_dir + '/spk2utt', 'w+') as spk2utt_fh, open(shard_dir + '/wav.scp', 'w+') as wav_scp_fh:
+            for line in spk2utt_lines:
+                spk2utt_fh.write(line)
+                for logid in line.split()[1:]:
+                    wav_scp_fh.write(wav_scp_lines[logid])
+        shard_dirs.append(shard_dir)
+
+    return shard_dirs
+
+
+# Writes the lines of feats.scp for the utterances of the speakers in spk2utt_path to output_path
+def write_feats_scp_subset(feats_scp_path, spk2utt_path, output_path):
+    logids = set()
+    for line in open(spk2utt_path, 'r').readlines():
+        logids.update(line.split()[1:])
+    with open(output_path, 'w+') as output_fh:
+        for line in open(feats_scp_path, 'r').readlines():
+            if line.split()[0] in logids:
+                output_fh.write(line)
+
+
+# Concatenates Kaldi arks byte by byte into output_ark_path. If output_scp_path is given, the scp files of the
+# shards are merged into it, with offsets shifted to point into the merged ark.
+def merge_arks_and_scps(ark_paths, scp_paths, output_ark_path, output_scp_path):
+    ark_offset = 0
+    scp_lines = []
+    with open(output_ark_path, 'wb') as output_ark_fh:
+        for i, ark_path in enumerate(ark_paths):
+            if output_scp_path is not None:
+                for line in open(scp_paths[i], 'r').readlines():
+                    logid, location = line.split()
+                    offset = int(location.rsplit(':', 1)[1])
+                    scp_lines.append(logid + ' ' + output_ark_path + ':' + str(offset + ark_offset) + '\n')
+            with open(ark_path, 'rb') as ark_fh:
+                shutil.copyfileobj(ark_fh, output_ark_fh)
+            ark_offset += os.path.getsize(ark_path)
+
+    if output_scp_path is not None:
+        with open(output_scp_path, 'w+') as output_scp_fh:
+            output_scp_fh.writelines(scp_lines)
+
+
+# Writes wav.scp and spk2utt in output_dir with only the lines for the given logids
+def write_wav_scp_and_spk2utt_subset(wav_scp_path, spk2utt_path, output_dir, logids):
+    logids = set(logids)
+    os.makedirs(output_dir, exist_ok=True)
+    with open(output_dir + '/wav.scp', 'w+') as wav_scp_fh:
+        for line in open(wav_scp_path, 'r').readlines():
+            if line.split()[0] in logids:
+                wav_scp_fh.write(line)
+    with open(output_dir + '/spk2utt', 'w+') as spk2utt_fh:
+        for line in open(spk2utt_path, 'r').readlines():
+            if line.split()[1] in logids:
+                spk2utt_fh.write(line)
+
+
+# Returns a dictionary mapping each logid in wav.scp to a fingerprint of its waveform (path, size and mtime)
+def get_wav_fingerprints(wav_scp_path):
+    fingerprints = {}
+    for line in open(wav_scp_path, 'r').readlines():
+        logid, wav_path = line.split()
+        wav_stat = os.stat(wav_path)
+        fingerprints[logid] = (wav_path, str(wav_stat.st_size), str(wav_stat.st_mtime_ns))
+    return fingerprints
+
+
+def write_wav_fingerprints(fingerprints_path, fingerprints):
+    with open(fingerprints_path, 'w+') as fingerprints_fh:
+        for logid, fingerprint in fingerprints.items():
+            fingerprints_fh.write(logid + ' ' + ' '.join(fingerprint) + '\n')
+
+
+# Returns None if no fingerprints were written yet
+def read_wav_fingerprints(fingerprints_path):
+    if not os.path.exists(fingerprints_path):
+        return None
+    fingerprints = {}
+    for line in open(fingerprints_path, 'r').readlines():
+        line = line.split()
+        fingerprints[line[0]] = tuple(line[1:])
+    return fingerprints
+
+
+# Returns a dictionary mapping logids to the first line of their .lab transcription file. The transcriptions are
+# read from a single index file, which is rebuilt from epadb_root_path/*/transcriptions/*.lab when the sources change.
+# Changes are detected through the modification time and size of every .lab file (see get_transcription_sources), so
+# checking the index costs one directory listing per speaker and one stat per utterance. Directory modification times
+# alone would be cheaper but miss files edited in place. Unless the index is rebuilt, no .lab file is opened.
+def load_transcriptions_index(epadb_root_path, index_path):
+    sources_path = index_path + '.sources'
+    sources = get_transcription_sources(epadb_root_path)
+
+    if not os.path.exists(index_path) or not os.path.exists(sources_path) or \
+            open(sources_path, 'r').read() != sources:
+        build_transcriptions_index(epadb_root_path, index_path)
+        with open(sources_path, 'w+') as sources_fh:
+            sources_fh.write(sources)
+
+    transcriptions = {}
+    for line in open(index_path, 'r').readlines():
+        logid, _, transcription = line.rstrip('\n').partition(' ')
+        transcriptions[logid] = transcription
+    return transcriptions
+
+
+# Lists every transcription file with its modification time and size, so that the index is rebuilt when a file
+# is added, removed or edited in place (which does not change the modification time of its directory)
+def get_transcription_sources(epadb_root_path):
+    sources = ''
+    for transcription_path in sorted(glob.glob(epadb_root_path + '/*/transcriptions/*.lab')):
+        transcription_stat = os.stat(transcription_path)
+        sources += (transcription_path + ' ' + str(transcription_stat.st_mtime_ns) + ' ' +
+                    str(transcription_stat.st_size) + '\n')
+    return sources
+
+
+def build_transcriptions_index(epadb_root_path, index_path):
+    os.makedirs(os.path.dirname(index_path), exist_ok=True)
+    with open(index_path, 'w+') as index_fh:
+        for transcription_path in sorted(glob.glob(epadb_root_path + '/*/transcriptions/*.lab')):
+            logid = os.path.splitext(os.path.basename(transcription_path))[0]
+            with open(transcription_path, 'r') as transcription_fh:
+                # Empty files are indexed with an empty transcription, which raises only when it is requested
+                transcription = transcription_fh.readline().rstrip('\n')
+            index_fh.write(logid + ' ' + transcription + '\n')
+
+
+class _PrefetchGeneration:
+    """
+    State of one call to FeatureManager.prefetch: the requests in order, the position of the first request of
+    each key, the cursor of the consumer (one past the last position requested) and the semaphore that limits
+    the utterances waiting to be requested to prefetch_depth.
+    """
 
-        with open(transcription_path, 'r') as transcription_fh:
-            transcription = transcription_fh.readlines()[0]
-        return transcription
+    def __init__(self, requests, prefetch_depth):
+        self.requests = requests
+        self.positions = dict()
+        for position, (cache_key, _, _) in enumerate(requests):
+            self.positions.setdefault(cache_key, position)
+        self.cursor = 0
+        self.slots = threading.Semaphore(prefetch_depth)
+        self.cancelled = False
@@ -0,0 +1,146 @@
+import os
+
+import numpy as np
+
+# Label of each segment: 1 for correctly pronounced phones ('+'), -1 for mispronounced ones ('-')
+LABEL_CODES = {'+': 1,
+               '-': -1}
+
+
+def collapse_target_phone(target_phone):
+    phone_replacements = {}
+    for phone_name in ['Th', 'Ph', 'Kh']:
+        phone_replacements[phone_name] = phone_name[:-1]
+    phone_replacements['AX'] = 'AH'
+    phone_replacements['DX'] = 'T'
+    target_phone = phone_replacements[target_phone]
+    return target_phone
+
+
+class LabelStore:
+    """
+    Labels of a set of utterances, parsed once from the label files and held as flat arrays with one
+    entry per labeled phone segment:
+        starts, ends: first frame and one past the last frame, already clipped to the feature frame count
+        nodes: network output node of the target phone, -1 if the phone is not scored
+        labels: 1 ('+'), -1 ('-') or 0 (any other label)
+        phones: index of the (uncollapsed) target phone in phone_symbols
+    The segments of the i-th logid are those in [segment_offsets[i], segment_offsets[i + 1]).
+    """
+
+    def __init__(self, logids, frame_counts, segment_offsets, starts, ends, nodes, labels, phones, phone_symbols):
+        self.logids = logids
+        self.frame_counts = frame_counts
+        self.segment_offsets = segment_offsets
+        self.starts = starts
+        self.ends = ends
+        self.nodes = nodes
+        self.labels = labels
+        self.phones = phones
+        self.phone_symbols = phone_symbols
+        self._logid_index = {logid: i for i, logid in enumerate(logids)}
+
+    def __contains__(self, logid):
+        return logid in self._logid_index
+
+    def __len__(self):
+        return len(self.logids)
+
+    def frame_count(self, logid):
+        return int(self.frame_counts[self._logid_index[logid]])
+
+    # Returns the (starts, ends, nodes, labels) arrays of the segments of logid
+    def get_segments(self, logid):
+        first, last = self._get_segment_range(logid)
+        return self.starts[first:last], self.ends[first:last], self.nodes[first:last], self.labels[first:last]
+
+    # Returns List[(canonic_phone, start_time, end_time)]
+    def get_phone_times(self, logid):
+        first, last = self._get_segment_range(logid)
+        return [(self.phone_symbols[phone], int(start), int(end)) for phone, start, end in
+                zip(self.phones[first:last], self.starts[first:last], self.ends[first:last])]
+
+    def _get_segment_range(self, logid):
+        i = self._logid_index[logid]
+        return self.segment_offsets[i], self.segment_offsets[i + 1]
+
+
+# Parses the label files of the given logids (labels_path/<speaker>/labels/<logid>.txt) into a LabelStore.
+# Segment boundaries are fixed to the feature frame counts as the dataset used to do on every item:
+# ends up to two frames past the features are clipped, starts up to two frames past the end are moved to it.
+def compile_label_store(logids, labels_path, frame_counts, phone_sym2int_dict, phone_int2node_dict):
+    phone_symbols = []
+    phone_symbol_indexes = {}
+    segment_offsets = [0]
+    starts, ends, nodes, labels, phones = [], [], [], [], []
+
+    for logid in logids:
+        speaker_id, utterance_id = logid.split("_")[0], logid.split("_")[1]
+        frame_count = frame_counts[logid]
+        annotation_path = os.path.join(labels_path, speaker_id, "labels", logid)
+
+        with open(annotation_path + ".txt") as f:
+            for line in f.readlines():
+                line = line.split()
+                try:
+                    target_phone = line[1]
+                    label = line[3]
+                    start_time = int(line[4])
+                    end_time = int(line[5])
+
+                    # These two if statements fix the mismatch between #frames in annotations and feature matrix
+                    if end_time > frame_count:
+                        if end_time > frame_count + 2:
+                            raise Exception('End time in annotations longer than feature length by ' + str(
+                                frame_count - end_time))
+                        end_time = frame_count
+                    if start_time > end_time:
+                        if start_time > end_time + 2:
+                            raise Exception(
+                                'Start time in annotations longer than end time by ' + str(end_time - start_time))
+                        start_time = end_time
+                except ValueError as e:
+                    _log_bad_item(speaker_id, utterance_id, frame_count, line, e)
+                    continue
+
+                if target_phone not in phone_symbol_indexes:
+                    phone_symbol_indexes[target_phone] = len(phone_symbols)
+                    phone_symbols.append(target_phone)
+                starts.append(start_time)
+                ends.append(end_time)
+                phones.append(phone_symbol_indexes[target_phone])
+                labels.append(LABEL_CODES.get(label, 0))
+
+                try:
+                    # If the target phone is not defined, collapse it into similar Kaldi phone (i.e Th -> T)
+                    if target_phone not in phone_sym2int_dict.keys():
+                        target_phone = collapse_target_phone(target_phone)
+
+                    # Get network output node index for the target phone
+                    target_phone_int = phone_sym2int_dict[target_phone]
+                    nodes.append(phone_int2node_dict[target_phone_int])
+                except KeyError as e:
+                    _log_bad_item(speaker_id, utterance_id, frame_count, line, e)
+                    nodes.append(-1)
+
+        segment_offsets.append(len(starts))
+
+    return LabelStore(list(logids),
+                      np.array([frame_counts[logid] for logid in logids], dtype=np.int32),
+                      np.array(segment_offsets, dtype=np.int64),
+                      np.array(starts, dtype=np.int32),
+                      np.array(ends, dtype=np.int32),
+                      np.array(nodes, dtype=np.int16),
+                      np.array(labels, dtype=np.int8),
+                      np.array(phones, dtype=np.int16),
+                      phone_symbols)
+
+
+def _log_bad_item(speaker_id, utterance_id, frame_count, line, e):
+    print("Bad item:")
+    print("Speaker: " + speaker_id)
+    print("Utterance: " + utterance_id)
+    print("#Frames in features: ")
+    print(frame_count)
+    print(line)
+    print(e)
@@ -0,0 +1,118 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+import torchaudio
+from kaldiio import WriteHelper
+
+# Options of compute-mfcc-feats and the corresponding torchaudio.compliance.kaldi.mfcc arguments
+KALDI_MFCC_OPTIONS = {'use-energy': 'use_energy',
+                      'num-mel-bins': 'num_mel_bins',
+                      'num-ceps': 'num_ceps',
+                      'low-freq': 'low_freq',
+                      'high-freq': 'high_freq',
+                      'sample-frequency': 'sample_frequency',
+                      'frame-length': 'frame_length',
+                      'frame-shift': 'frame_shift',
+                      'dither': 'dither',
+                      'preemphasis-coefficient': 'preemphasis_coefficient',
+                      'remove-dc-offset': 'remove_dc_offset',
+                      'window-type': 'window_type',
+                      'round-to-power-of-two': 'round_to_power_of_two',
+                      'snip-edges': 'snip_edges',
+                      'cepstral-lifter': 'cepstral_lifter',
+                      'energy-floor': 'energy_floor',
+                      'raw-energy': 'raw_energy',
+                      'htk-compat': 'htk_compat',
+                      'vtln-warp': 'vtln_warp'}
+
+# Kaldi compression method used by copy-feats --compress=true (kAutomaticMethod)
+KALDI_AUTOMATIC_COMPRESSION = 1
+
+# Dither used when the configuration does not set it. compute-mfcc-feats defaults to 1.0, which adds random noise
+# to every frame; 0 keeps the features deterministic, so re-extracted waveforms get the same MFCCs
+DEFAULT_DITHER = 0.0
+
+
+class MfccExtractor:
+    """
+    In-process replacement for compute-mfcc-feats. Reads the same configuration file and computes
+    Kaldi compatible MFCCs with torchaudio. Each waveform is computed on its own, num_threads waveforms
+    in parallel; frames of different waveforms are not batched together.
+    Unlike compute-mfcc-feats, dither defaults to DEFAULT_DITHER unless the configuration sets it.
+    """
+
+    def __init__(self, mfcc_conf_path, num_threads=4):
+        self.mfcc_options, self.allow_downsample = read_mfcc_conf(mfcc_conf_path)
+        if 'dither' not in self.mfcc_options:
+            print('MFCC configuration ' + mfcc_conf_path + ' does not set --dither, using ' + str(DEFAULT_DITHER) +
+                  ' (compute-mfcc-feats defaults to 1.0)')
+            self.mfcc_options['dither'] = DEFAULT_DITHER
+        self.sample_frequency = self.mfcc_options.get('sample_frequency', 16000.0)
+        self.num_threads = num_threads
+
+    # Returns the (frames x num_ceps) MFCCs for the waveform in wav_path
+    def compute_mfccs_for_wav(self, wav_path):
+        # Kaldi works on the raw integer sample values, so the waveform is not normalized
+        waveform, sample_rate = torchaudio.load(wav_path, normalize=False)
+        waveform = waveform[:1].float()
+
+        if sample_rate != self.sample_frequency:
+            if sample_rate < self.sample_frequency or not self.allow_downsample:
+                raise Exception('Waveform ' + wav_path + ' has sample rate ' + str(sample_rate) +
+                                ', expected ' + str(self.sample_frequency))
+            waveform = torchaudio.functional.resample(waveform, sample_rate, int(self.sample_frequency))
+
+        with torch.no_grad():
+            return torchaudio.compliance.kaldi.mfcc(waveform, **self.mfcc_options)
+
+    # Yields (logid, mfccs) for every utterance in wav.scp, in order. Waveforms are handed to the threads
+    # batch_size at a time, to bound the number of MFCC matrices held before they are yielded
+    def compute_mfccs_for_wav_scp(self, wav_scp_path, batch_size=32):
+        wav_scp = [line.split() for line in open(wav_scp_path, 'r').readlines()]
+        with ThreadPoolExecutor(max_workers=self.num_threads) as executor:
+            for batch_start in range(0, len(wav_scp), batch_size):
+                batch = wav_scp[batch_start:batch_start + batch_size]
+                batch_mfccs = executor.map(self.compute_mfccs_for_wav, [wav_path for _, wav_path in batch])
+                for (logid, _), mfccs in zip(batch, batch_mfccs):
+                    yield logid, mfccs
+
+    # Writes the MFCCs for every utterance in wav.scp to a compressed Kaldi ark and its scp,
+    # as compute-mfcc-feats | copy-feats --compress=true does
+    def write_mfccs_for_wav_scp(self, wav_scp_path, mfcc_path, feats_scp_path, batch_size=32):
+        with WriteHelper('ark,scp:' + mfcc_path + ',' + feats_scp_path,
+                         compression_method=KALDI_AUTOMATIC_COMPRESSION) as mfcc_writer:
+            for logid, mfccs in self.compute_mfccs_for_wav_scp(wav_scp_path, batch_size=batch_size):
+                mfcc_writer(logid, mfccs.numpy())
+
+
+# Parses a compute-mfcc-feats configuration file into torchaudio.compliance.kaldi.mfcc keyword arguments.
+# Also returns the value of --allow-downsample, which is handled when loading the waveforms.
+def read_mfcc_conf(mfcc_conf_path):
+    mfcc_options = {}
+    allow_downsample = False
+    for line in open(mfcc_conf_path, 'r').readlines():
+        line = line.split('#')[0].strip()
+        if line == '':
+            continue
+        option, value = line.lstrip('-').split('=')
+        value = parse_conf_value(value)
+
+        if option == 'allow-downsample':
+            allow_downsample = value
+        elif option in KALDI_MFCC_OPTIONS:
+            mfcc_options[KALDI_MFCC_OPTIONS[option]] = value
+        else:
+            raise Exception('Unsupported MFCC option --' + option + ' in ' + mfcc_conf_path)
+
+    return mfcc_options, allow_downsample
+
+
+def parse_conf_value(value):
+    if value in ['true', 'false']:
+        return value == 'true'
+    for value_type in [int, float]:
+        try:
+            return value_type(value)
+        except ValueError:
+            pass
+    return value
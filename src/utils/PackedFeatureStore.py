@@ -0,0 +1,109 @@
+import os
+
+import numpy as np
+
+
+class PackedFeatureStore:
+    """
+    Read only view over a packed feature file. The data file holds the feature
+    matrices of all utterances one after the other as a single contiguous
+    (total_frames x dim) array, and the index file maps each logid to its first
+    row and its number of rows. The first line of the index holds the dtype and
+    the feature dimension.
+    """
+
+    def __init__(self, data_path, index_path):
+        self.data_path = data_path
+        self.index_path = index_path
+        self.dtype, self.dim, self.index = read_packed_index(index_path)
+        self._data = None
+
+    def _get_data(self):
+        # Map the file lazily and copy-on-write, so that pages are shared through the page cache
+        # and torch.from_numpy can wrap the slices without complaining about read-only memory
+        if self._data is None:
+            total_rows = os.path.getsize(self.data_path) // (np.dtype(self.dtype).itemsize * self.dim)
+            self._data = np.memmap(self.data_path, dtype=self.dtype, mode='c', shape=(total_rows, self.dim))
+        return self._data
+
+    def has_key(self, logid):
+        return logid in self.index
+
+    def logids(self):
+        return list(self.index.keys())
+
+    def frame_count(self, logid):
+        return self.index[logid][1]
+
+    # Returns a (frames x dim) view over the mapped buffer, no data is copied
+    def get(self, logid):
+        start, frames = self.index[logid]
+        return self._get_data()[start:start + frames]
+
+
+def read_packed_index(index_path):
+    index = {}
+    with open(index_path, 'r') as index_fh:
+        dtype, dim = index_fh.readline().split()
+        for line in index_fh.readlines():
+            logid, start, frames = line.split()
+            # Later lines override earlier ones, so entries can be superseded by appending
+            index[logid] = (int(start), int(frames))
+    return dtype, int(dim), index
+
+
+# Appends the given (logid, matrix) pairs to a packed feature file and its index,
+# creating both files if they do not exist. The index is replaced only once every matrix is written,
+# so a run that is interrupted leaves the store as it was: rows past the last indexed one (left by such
+# a run) are dropped before appending, and a new store overwrites any data file left without an index.
+def append_to_packed_store(data_path, index_path, logid_matrix_pairs, dtype='float32'):
+    if os.path.exists(index_path):
+        dtype, dim, index = read_packed_index(index_path)
+        total_rows = max([start + frames for start, frames in index.values()], default=0)
+        with open(index_path, 'r') as index_fh:
+            index_text = index_fh.read()
+        data_mode = 'r+b'
+    else:
+        dim = None
+        total_rows = 0
+        index_text = None
+        data_mode = 'wb'
+
+    index_lines = []
+    with open(data_path, data_mode) as data_fh:
+        if dim is not None:
+            data_fh.seek(total_rows * np.dtype(dtype).itemsize * dim)
+            data_fh.truncate()
+        for logid, matrix in logid_matrix_pairs:
+            matrix = np.ascontiguousarray(matrix, dtype=dtype)
+            if dim is None:
+                dim = matrix.shape[1]
+            if matrix.shape[1] != dim:
+                raise Exception('Feature dimension ' + str(matrix.shape[1]) + ' for utterance ' + logid +
+                                ' does not match packed store dimension ' + str(dim))
+            data_fh.write(matrix.tobytes())
+            index_lines.append(logid + ' ' + str(total_rows) + ' ' + str(matrix.shape[0]) + '\n')
+            total_rows += matrix.shape[0]
+
+    if index_text is None and dim is None:
+        return
+    # Written to a temporary file first, so that readers never see an index for rows that are not written
+    tmp_index_path = index_path + '.' + str(os.getpid()) + '.tmp'
+    with open(tmp_index_path, 'w') as index_fh:
+        index_fh.write(index_text if index_text is not None else dtype + ' ' + str(dim) + '\n')
+        index_fh.writelines(index_lines)
+    os.replace(tmp_index_path, index_path)
+
+
+# Drops the given logids from the index of a packed feature file. Their rows are left in the data file, unreferenced,
+# like those of superseded entries.
+def remove_from_packed_store(index_path, logids):
+    logids = set(logids)
+    with open(index_path, 'r') as index_fh:
+        header = index_fh.readline()
+        index_lines = [line for line in index_fh.readlines() if line.split()[0] not in logids]
+    tmp_index_path = index_path + '.' + str(os.getpid()) + '.tmp'
+    with open(tmp_index_path, 'w') as index_fh:
+        index_fh.write(header)
+        index_fh.writelines(index_lines)
+    os.replace(tmp_index_path, index_path)
@@ -0,0 +1,348 @@
+import atexit
+import fcntl
+import glob
+import hashlib
+import os
+import pickle
+import struct
+import tempfile
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+import torch
+
+from src.utils.CompressedFeatures import CompressedFeatures, CompressedMatrix
+
+# Array data in the segments is aligned to this many bytes
+SEGMENT_ALIGNMENT = 64
+# Each segment starts with the length of its pickled layout, written last so that readers never see half a value
+SEGMENT_HEADER_SIZE = 8
+
+# One cache per namespace and process, attached until the process exits
+_attached_caches = {}
+
+# Where the shared memory segments live on Linux
+SHARED_MEMORY_PATH = '/dev/shm'
+
+
+class SharedFeatureCache:
+    """
+    Feature cache in POSIX shared memory, so that every process on the host using the same namespace
+    (folds, DataLoader workers, concurrent scoring stages) decodes each utterance only once.
+
+    Each entry is a shared memory segment named after the namespace and the key, holding the raw
+    tensor data. Values read from the cache are views over the segment and must not be modified.
+    Processes attached to a namespace are recorded in a registry under a file lock. When the last one
+    releases the namespace, all its segments are removed, and namespaces left with no live process (features
+    extracted again, crashed runs) are swept when a process attaches to another one.
+
+    Entries are never evicted; once max_bytes is reached, new values are just not cached. max_bytes defaults
+    to the free space of the shared memory filesystem when attaching, and values are not cached either if it
+    has no room left for them, since writing past it would kill the process with SIGBUS.
+    Hits and misses are counted per process.
+    """
+
+    def __init__(self, namespace, max_bytes=None):
+        self.namespace = namespace
+        self.max_bytes = max_bytes if max_bytes is not None else get_shared_memory_free_bytes()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.skipped = 0
+        self._registry_dir = get_shared_cache_registry_dir(namespace)
+        self._attached = {}
+        self._released = False
+
+        _sweep_stale_namespaces(namespace)
+        os.makedirs(self._registry_dir, exist_ok=True)
+        with self._registry_lock():
+            pids = self._read_attached_pids()
+            pids.add(os.getpid())
+            self._write_attached_pids(pids)
+
+    def __contains__(self, key):
+        return self._attach(key) is not None
+
+    def __len__(self):
+        return len(self._read_segments())
+
+    # Returns the cached value for key, or None if no process has cached it
+    def get(self, key):
+        value = self._attach(key)
+        if value is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        layout, arrays = _flatten_value(value)
+        # The offsets only change the size of the pickled header by a few bytes, which the alignment absorbs
+        array_specs = [(0, array.dtype.str, array.shape) for array in arrays]
+        size = SEGMENT_HEADER_SIZE + len(pickle.dumps((layout, array_specs))) + SEGMENT_ALIGNMENT
+        for i, array in enumerate(arrays):
+            size = _align(size)
+            array_specs[i] = (size, array.dtype.str, array.shape)
+            size += array.nbytes
+        header = pickle.dumps((layout, array_specs))
+
+        segment_name = self._get_segment_name(key)
+        with self._registry_lock():
+            segments = self._read_segments()
+            if segment_name in segments:
+                return
+            free_bytes = get_shared_memory_free_bytes()
+            if (self.max_bytes is not None and sum(segments.values()) + size > self.max_bytes) or \
+                    (free_bytes is not None and size > free_bytes):
+                self.skipped += 1
+                return
+            try:
+                segment = _open_segment(segment_name, size)
+            except FileExistsError:
+                return
+            self._append_segment(segment_name, size)
+
+        for (offset, _, _), array in zip(array_specs, arrays):
+            np.ndarray(array.shape, dtype=array.dtype, buffer=segment.buf, offset=offset)[...] = array
+        segment.buf[SEGMENT_HEADER_SIZE:SEGMENT_HEADER_SIZE + len(header)] = header
+        segment.buf[:SEGMENT_HEADER_SIZE] = struct.pack('<Q', len(header))
+        self._attached[segment_name] = (segment, _rebuild_value(segment, layout, array_specs))
+
+    # Removes every entry in the namespace, for all processes
+    def clear(self):
+        with self._registry_lock():
+            self._unlink_segments()
+
+    def stats(self):
+        segments = self._read_segments()
+        return {'entries': len(segments),
+                'bytes': sum(segments.values()),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions}
+
+    # Detaches this process from the namespace. The segments are removed if no other process is attached.
+    def release(self):
+        if self._released:
+            return
+        # Segments stay mapped while this process runs, since values handed out are views over them
+        self._released = True
+
+        with self._registry_lock():
+            pids = self._read_attached_pids()
+            pids.discard(os.getpid())
+            self._write_attached_pids(pids)
+            if len(pids) == 0:
+                self._unlink_segments()
+
+    def _attach(self, key):
+        segment_name = self._get_segment_name(key)
+        if segment_name in self._attached:
+            return self._attached[segment_name][1]
+
+        try:
+            segment = shared_memory.SharedMemory(name=segment_name)
+        except FileNotFoundError:
+            return None
+        _untrack_segment(segment)
+
+        header_size = struct.unpack('<Q', bytes(segment.buf[:SEGMENT_HEADER_SIZE]))[0]
+        # The process writing the value has not finished yet
+        if header_size == 0:
+            segment.close()
+            return None
+
+        layout, array_specs = pickle.loads(
+            bytes(segment.buf[SEGMENT_HEADER_SIZE:SEGMENT_HEADER_SIZE + header_size]))
+        value = _rebuild_value(segment, layout, array_specs)
+        self._attached[segment_name] = (segment, value)
+        return value
+
+    def _get_segment_name(self, key):
+        key_hash = hashlib.sha1(repr(key).encode()).hexdigest()[:16]
+        return 'epa_' + self.namespace + '_' + key_hash
+
+    def _registry_lock(self):
+        return _FileLock(self._registry_dir + '/lock')
+
+    def _read_attached_pids(self):
+        return _read_attached_pids(self._registry_dir)
+
+    def _write_attached_pids(self, pids):
+        with open(self._registry_dir + '/pids', 'w') as pids_fh:
+            pids_fh.write(''.join(str(pid) + '\n' for pid in sorted(pids)))
+
+    def _read_segments(self):
+        return _read_segments(self._registry_dir)
+
+    def _append_segment(self, segment_name, size):
+        with open(self._registry_dir + '/segments', 'a') as segments_fh:
+            segments_fh.write(segment_name + ' ' + str(size) + '\n')
+
+    # Must be called holding the registry lock
+    def _unlink_segments(self):
+        _unlink_segments(self._registry_dir)
+
+
+# Returns the shared cache for namespace, attaching this process to it the first time.
+# The process stays attached until it exits, so that consecutive folds and stages reuse the entries.
+def get_shared_feature_cache(namespace, max_bytes=None):
+    if namespace not in _attached_caches:
+        _attached_caches[namespace] = SharedFeatureCache(namespace, max_bytes=max_bytes)
+    return _attached_caches[namespace]
+
+
+# Namespace for the features in features_path held in the given residency. The modification times of
+# the MFCCs, the iVectors and the packed store are part of it, so that entries of features extracted
+# again (even if only the iVectors are) are not served.
+def get_shared_cache_namespace(features_path, residency):
+    description = os.path.realpath(features_path) + ':' + residency
+    for file_name in ['mfccs.ark', 'ivectors.ark', 'feats_packed.index', 'feats_packed_mfccs.index',
+                      'feats_packed_ivectors.index']:
+        path = features_path + '/' + file_name
+        description += ':' + str(os.stat(path).st_mtime_ns if os.path.isfile(path) else 0)
+    return hashlib.sha1(description.encode()).hexdigest()[:12]
+
+
+def get_shared_cache_registry_dir(namespace):
+    return tempfile.gettempdir() + '/epa_feature_cache_' + namespace
+
+
+# Returns the bytes that can still be written to the shared memory filesystem, or None where it is not mounted
+def get_shared_memory_free_bytes():
+    if not os.path.isdir(SHARED_MEMORY_PATH):
+        return None
+    shm_stat = os.statvfs(SHARED_MEMORY_PATH)
+    return shm_stat.f_bavail * shm_stat.f_frsize
+
+
+# Removes the segments of the namespaces other than namespace that no live process is attached to
+def _sweep_stale_namespaces(namespace):
+    for registry_dir in glob.glob(get_shared_cache_registry_dir('*')):
+        if registry_dir == get_shared_cache_registry_dir(namespace) or \
+                not os.path.isfile(registry_dir + '/segments'):
+            continue
+        with _FileLock(registry_dir + '/lock'):
+            if len(_read_attached_pids(registry_dir)) == 0:
+                _unlink_segments(registry_dir)
+
+
+def _read_attached_pids(registry_dir):
+    pids_path = registry_dir + '/pids'
+    if not os.path.isfile(pids_path):
+        return set()
+    pids = set(int(line) for line in open(pids_path, 'r').read().split())
+    # Processes that died without releasing the namespace do not keep it alive
+    return set(pid for pid in pids if _is_process_alive(pid))
+
+
+def _read_segments(registry_dir):
+    segments_path = registry_dir + '/segments'
+    if not os.path.isfile(segments_path):
+        return {}
+    segments = {}
+    for line in open(segments_path, 'r').readlines():
+        segment_name, size = line.split()
+        segments[segment_name] = int(size)
+    return segments
+
+
+# Must be called holding the registry lock of registry_dir
+def _unlink_segments(registry_dir):
+    for segment_name in _read_segments(registry_dir):
+        try:
+            segment = shared_memory.SharedMemory(name=segment_name)
+        except FileNotFoundError:
+            continue
+        _untrack_segment(segment)
+        segment.close()
+        segment.unlink()
+    segments_path = registry_dir + '/segments'
+    if os.path.isfile(segments_path):
+        os.remove(segments_path)
+
+
+@atexit.register
+def _release_attached_caches():
+    # Forked DataLoader workers inherit the caches of their parent but must not release them
+    for cache in _attached_caches.values():
+        if os.getpid() in cache._read_attached_pids():
+            cache.release()
+
+
+class _FileLock:
+    def __init__(self, lock_path):
+        self.lock_path = lock_path
+        self._lock_fh = None
+
+    def __enter__(self):
+        self._lock_fh = open(self.lock_path, 'a')
+        fcntl.flock(self._lock_fh, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        fcntl.flock(self._lock_fh, fcntl.LOCK_UN)
+        self._lock_fh.close()
+
+
+def _open_segment(segment_name, size):
+    segment = shared_memory.SharedMemory(name=segment_name, create=True, size=size)
+    _untrack_segment(segment)
+    segment.buf[:SEGMENT_HEADER_SIZE] = struct.pack('<Q', 0)
+    return segment
+
+
+def _untrack_segment(segment):
+    # The resource tracker would remove the segments when the process that created or attached them exits,
+    # and warn about them as leaked. Their lifetime is managed by the namespace registry instead.
+    resource_tracker.unregister(segment._name, 'shared_memory')
+
+
+def _is_process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _align(offset):
+    return (offset + SEGMENT_ALIGNMENT - 1) // SEGMENT_ALIGNMENT * SEGMENT_ALIGNMENT
+
+
+# Splits a cached value into a picklable layout and the arrays holding its data
+def _flatten_value(value, arrays=None):
+    if arrays is None:
+        arrays = []
+        return _flatten_value(value, arrays), arrays
+
+    if isinstance(value, tuple):
+        return 'tuple', [_flatten_value(element, arrays) for element in value]
+    if isinstance(value, CompressedMatrix):
+        arrays.append(np.frombuffer(value.data, dtype=np.uint8))
+        return 'compressed-matrix', len(arrays) - 1
+    if isinstance(value, CompressedFeatures):
+        return 'compressed-features', [_flatten_value(value.mfccs, arrays), _flatten_value(value.ivectors, arrays),
+                                       value.ivector_period]
+    arrays.append(value.contiguous().numpy())
+    return 'tensor', len(arrays) - 1
+
+
+# Builds the cached value back from its layout, with tensors that are views over the segment
+def _rebuild_value(segment, layout, array_specs):
+    value_type, contents = layout
+    if value_type == 'tuple':
+        return tuple(_rebuild_value(segment, element, array_specs) for element in contents)
+    if value_type == 'compressed-features':
+        mfccs_layout, ivectors_layout, ivector_period = contents
+        return CompressedFeatures(_rebuild_value(segment, mfccs_layout, array_specs),
+                                  _rebuild_value(segment, ivectors_layout, array_specs), ivector_period)
+
+    offset, dtype, shape = array_specs[contents]
+    array = np.ndarray(shape, dtype=dtype, buffer=segment.buf, offset=offset)
+    if value_type == 'compressed-matrix':
+        return CompressedMatrix(array.tobytes())
+    return torch.from_numpy(array)
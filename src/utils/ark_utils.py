@@ -0,0 +1,130 @@
+import os
+import shutil
+import struct
+
+# Size in bytes of the global header of Kaldi compressed matrices (min_value, range, num_rows, num_cols)
+COMPRESSED_GLOBAL_HEADER_SIZE = 16
+# Size in bytes of each per column header of compressed matrices in the 'CM' format (four uint16 percentiles)
+COMPRESSED_PER_COL_HEADER_SIZE = 8
+
+
+# Reads a Kaldi binary archive and returns a list of (logid, entry_start, data_offset, entry_end) tuples,
+# where [entry_start, entry_end) is the byte range of the whole "logid <binary object>" entry and data_offset
+# is the offset a Kaldi scp file would point to. Only matrices and vectors are supported.
+def read_ark_index(ark_path):
+    entries = []
+    ark_size = os.path.getsize(ark_path)
+    with open(ark_path, 'rb') as ark_fh:
+        while ark_fh.tell() < ark_size:
+            entry_start = ark_fh.tell()
+            logid = _read_token(ark_fh)
+            data_offset = ark_fh.tell()
+            if ark_fh.read(2) != b'\0B':
+                raise Exception('Entry ' + logid + ' in ' + ark_path + ' is not in Kaldi binary format')
+            ark_fh.seek(_read_binary_object_size(ark_fh), os.SEEK_CUR)
+            entries.append((logid, entry_start, data_offset, ark_fh.tell()))
+    return entries
+
+
+# Returns a dictionary mapping each logid in a Kaldi binary archive of matrices to its number of rows,
+# reading only the headers of the matrices
+def read_ark_num_rows(ark_path):
+    num_rows = {}
+    with open(ark_path, 'rb') as ark_fh:
+        for logid, _, data_offset, _ in read_ark_index(ark_path):
+            ark_fh.seek(data_offset + 2)
+            token = _read_token(ark_fh)
+            if token in ['FM', 'DM']:
+                num_rows[logid] = _read_int32(ark_fh)
+            elif token in ['CM', 'CM2', 'CM3']:
+                num_rows[logid] = struct.unpack('<ffii', ark_fh.read(COMPRESSED_GLOBAL_HEADER_SIZE))[2]
+            else:
+                raise Exception('Entry ' + logid + ' in ' + ark_path + ' is not a matrix')
+    return num_rows
+
+
+# Reads the raw bytes (starting with the binary marker) of the object stored at data_offset
+def read_raw_ark_object(ark_path, data_offset):
+    with open(ark_path, 'rb') as ark_fh:
+        ark_fh.seek(data_offset)
+        if ark_fh.read(2) != b'\0B':
+            raise Exception('Object at offset ' + str(data_offset) + ' in ' + ark_path +
+                            ' is not in Kaldi binary format')
+        object_start = ark_fh.tell()
+        size = _read_binary_object_size(ark_fh)
+        ark_fh.seek(object_start)
+        return b'\0B' + ark_fh.read(size)
+
+
+# Rewrites the archive keeping only the entries whose logid is not in logids_to_remove
+def remove_entries_from_ark(ark_path, logids_to_remove):
+    filtered_ark_path = ark_path + '.filtered'
+    with open(ark_path, 'rb') as ark_fh, open(filtered_ark_path, 'wb') as filtered_ark_fh:
+        for logid, entry_start, _, entry_end in read_ark_index(ark_path):
+            if logid in logids_to_remove:
+                continue
+            ark_fh.seek(entry_start)
+            filtered_ark_fh.write(ark_fh.read(entry_end - entry_start))
+    os.replace(filtered_ark_path, ark_path)
+
+
+# Writes a Kaldi scp file pointing to every entry in the archive
+def write_scp_for_ark(ark_path, scp_path):
+    with open(scp_path, 'w+') as scp_fh:
+        for logid, _, data_offset, _ in read_ark_index(ark_path):
+            scp_fh.write(logid + ' ' + ark_path + ':' + str(data_offset) + '\n')
+
+
+# Appends the entries of the given archives to output_ark_path
+def append_arks(ark_paths, output_ark_path):
+    with open(output_ark_path, 'ab') as output_ark_fh:
+        for ark_path in ark_paths:
+            with open(ark_path, 'rb') as ark_fh:
+                shutil.copyfileobj(ark_fh, output_ark_fh)
+
+
+def _read_token(fh):
+    token = b''
+    char = fh.read(1)
+    while char not in [b' ', b'']:
+        token += char
+        char = fh.read(1)
+    return token.decode()
+
+
+def _read_int32(fh):
+    # Kaldi writes the size of basic types before the value
+    size = fh.read(1)
+    if size != b'\x04':
+        raise Exception('Expected int32 in Kaldi binary object')
+    return struct.unpack('<i', fh.read(4))[0]
+
+
+# Returns the size of the binary object starting at the current position (right after the binary marker),
+# without consuming it
+def _read_binary_object_size(fh):
+    object_start = fh.tell()
+    token = _read_token(fh)
+    header_size = fh.tell() - object_start
+
+    if token in ['FM', 'DM']:
+        rows = _read_int32(fh)
+        cols = _read_int32(fh)
+        size = header_size + 10 + rows * cols * (4 if token == 'FM' else 8)
+    elif token in ['FV', 'DV']:
+        dim = _read_int32(fh)
+        size = header_size + 5 + dim * (4 if token == 'FV' else 8)
+    elif token in ['CM', 'CM2', 'CM3']:
+        _, _, rows, cols = struct.unpack('<ffii', fh.read(COMPRESSED_GLOBAL_HEADER_SIZE))
+        size = header_size + COMPRESSED_GLOBAL_HEADER_SIZE
+        if token == 'CM':
+            size += cols * COMPRESSED_PER_COL_HEADER_SIZE + rows * cols
+        elif token == 'CM2':
+            size += 2 * rows * cols
+        else:
+            size += rows * cols
+    else:
+        raise Exception('Unsupported Kaldi binary object ' + token)
+
+    fh.seek(object_start)
+    return size
@@ -1,49 +1,46 @@
 import torch
 
+from src.utils.Batch import Batch, BatchCollator
+
 
 def unpack_logids_from_batch(batch):
-    return [item['speaker_id'] + '_' + item['utterance_id'] for item in batch]
+    return batch.logids
 
 
 def unpack_features_from_batch(batch):
-    return torch.stack([item['features'] for item in batch])
+    return batch.features
 
 
-def unpack_pos_labels_from_batch(batch):
-    return torch.stack([item['pos_labels'] for item in batch])
+# Returns None unless the batch carries native rate iVectors separately from the features
+def unpack_ivectors_from_batch(batch):
+    return batch.ivectors
 
 
-def unpack_labels_from_batch(batch):
-    return torch.stack([item['labels'] for item in batch])
+# Returns the output node of the canonic phone at each frame (B x T), -1 for frames without label
+def unpack_frame_nodes_from_batch(batch):
+    return batch.frame_nodes
 
 
-def unpack_neg_labels_from_batch(batch):
-    return torch.stack([item['neg_labels'] for item in batch])
+# Returns the label at each frame (B x T): 1 for correctly pronounced phones, -1 for mispronounced ones, 0 otherwise
+def unpack_frame_labels_from_batch(batch):
+    return batch.frame_labels
 
 
 def unpack_phone_times_from_batch(batch):
-    return [item['phone_times'] for item in batch]
+    return batch.phone_times
+
+
+# Returns None unless the samples of the batch are packed one after the other along time (see Batch)
+def unpack_sequence_offsets_from_batch(batch):
+    return batch.sequence_offsets
 
 
 def collate_fn_padd(batch):
     """
-    Padds batch of variable length (both features and labels)
+    Padds batch of variable length (both features and labels) into a new Batch
+    Features held in reduced precision or compressed are decoded to float32 here
     """
-    # padd
-    batch_features = [item['features'] for item in batch]
-    batch_features = torch.nn.utils.rnn.pad_sequence(batch_features, batch_first=True)
-    batch_pos_labels = [item['pos_labels'] for item in batch]
-    batch_pos_labels = torch.nn.utils.rnn.pad_sequence(batch_pos_labels, batch_first=True, padding_value=-1)
-    batch_neg_labels = [item['neg_labels'] for item in batch]
-    batch_neg_labels = torch.nn.utils.rnn.pad_sequence(batch_neg_labels, batch_first=True, padding_value=-1)
-    batch_labels = [item['labels'] for item in batch]
-    batch_labels = torch.nn.utils.rnn.pad_sequence(batch_labels, batch_first=True, padding_value=0)
-    for i in range(len(batch)):
-        batch[i]['features'] = batch_features[i]
-        batch[i]['pos_labels'] = batch_pos_labels[i]
-        batch[i]['neg_labels'] = batch_neg_labels[i]
-        batch[i]['labels'] = batch_labels[i]
-    return batch
+    return BatchCollator(num_buffers=0)(batch)
 
 
 # phone_sym2int_dict:  Dictionary mapping phone symbol to integer given a phone list path
@@ -85,6 +82,14 @@ def get_scores_for_canonic_phones(outputs, labels):
     return outputs
 
 
+# Same as get_scores_for_canonic_phones for sparse labels: gathers the output of the canonic phone at each frame,
+# 0 for frames without label
+def gather_scores_for_canonic_phones(outputs, frame_nodes):
+    labeled_frames = frame_nodes >= 0
+    outputs = torch.gather(outputs, 2, frame_nodes.clamp(min=0).unsqueeze(2)).squeeze(2)
+    return outputs * labeled_frames
+
+
 # This function returns the non-zero relevant scores and 0/1 labels to calculate loss
 def get_outputs_and_labels_for_loss(outputs, labels):
     outputs = get_scores_for_canonic_phones(outputs, labels)
@@ -93,6 +93,7 @@ def add_data_keys_to_config_dict(config_dict, setup):
     config_dict["loglikes-path"] = config_dict["alignments-dir-path"] + "loglikes.ark"
     config_dict["loglikes-heldout-path"] = config_dict["alignments-dir-path"] + "loglikes_heldout.ark"
     config_dict["acoustic-model-path"] = data_path + "pytorch_models/acoustic_model.pt"
+    config_dict["acoustic-onnx-path"] = data_path + "pytorch_models/acoustic_model.onnx"
     config_dict["features-path"] = data_path + "features/data"
     config_dict["features-conf-path"] = data_path + "features/conf"
     config_dict["auto-labels-dir-path"] = data_path + "kaldi_labels/"